@@ -0,0 +1,63 @@
+"""Times HR_A derivation (process_hr_a_data) on synthetic multi-day sessions.
+
+HR and PR numerics come once a second, PR with dropouts of up to 10 minutes
+and -1/-2 codes. The vectorized _hr_a_sorted runs on the whole session; the
+original _hr_a_loop is quadratic, so it only runs on the first --loop-rows
+HR rows, and its output is compared with _hr_a_sorted on those rows.
+
+    python -m benchmarks.hr_a --days 1 3 7 --loop-rows 5000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from sotera.analysis.triage import _hr_a_loop, _hr_a_sorted
+
+
+def make_session(days, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(days * 86400)
+    t0 = 1.6e9
+    hr_t = t0 + np.arange(n, dtype=float)
+    pr_t = t0 + np.arange(n, dtype=float) + rng.choice([0.0, 0.5], size=n)
+    keep = np.ones(n, dtype=bool)
+    for start in rng.integers(0, n, size=max(1, n // 3600)):
+        keep[start : start + rng.integers(10, 600)] = False
+    pr_t = pr_t[keep]
+    HR = np.c_[np.arange(n), hr_t, rng.integers(50, 120, size=n)]
+    PR = np.c_[
+        np.arange(pr_t.shape[0]),
+        pr_t,
+        rng.choice([-2, -1, 70], p=[0.05, 0.05, 0.9], size=pr_t.shape[0]),
+    ]
+    return HR.astype(float), PR.astype(float)
+
+
+def timed(f, *args):
+    t = time.perf_counter()
+    out = f(*args)
+    return out, time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=float, nargs="+", default=[1, 3, 7])
+    parser.add_argument("--loop-rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    for days in args.days:
+        HR, PR = make_session(days)
+        aHR, t_sorted = timed(_hr_a_sorted, HR, PR)
+        line = f"{days:g} days, {HR.shape[0]} HR / {PR.shape[0]} PR rows: "
+        line += f"sorted {t_sorted:.3f} s"
+        if args.loop_rows > 0:
+            n = min(args.loop_rows, HR.shape[0])
+            loop, t_loop = timed(_hr_a_loop, HR[:n], PR)
+            same = np.array_equal(loop, _hr_a_sorted(HR[:n], PR))
+            line += f", loop {t_loop:.1f} s on {n} HR rows (identical: {same})"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,7 @@
 import logging
 from json import dumps
 from IPython.display import clear_output
-from sotera.aws import get_boto3_session
+from sotera.aws import get_boto3_client
 from analytics.lib.utils import get_string_from_timestamp
 from sotera.cluster.control import cluster_decorate, add_analysis
 
@@ -62,79 +62,26 @@ def print_analysis_status(pgsql_, aid):
 
 @cluster_decorate()
 def cluster_block_convert(pgsql_, aid, jobid, job):
-    from uuid import uuid1
-    from shutil import rmtree
-    from tempfile import mkdtemp
-    from os.path import join as joinpath, basename
-    from sotera.io import find_tier, make_key
-    from sotera.io.local import save_block
-    from sotera.io.visi.convert import convert_block
-    from sotera.io.cloud import download_file, upload_indexed_file
-
-    fnlist = []
-    dst = None
-    chunk_tmpdir = None
-    blockmap = job["block"].copy()
-    chunk_tmpdir = mkdtemp()
-    for chunk in blockmap["chunks"]:
-        key_name = f"{job['hid']}/{chunk['file']}"
-        localfn = joinpath(chunk_tmpdir, chunk["file"])
-        download_file(job["bucket"], key_name, localfn)
-        chunk["file"] = localfn
-
-    data = convert_block(blockmap)
-    dst = mkdtemp()
-    metafn = f"meta-{uuid1()}.json"
-    fnlist = save_block(dst, data, use_compression=True, metafn=metafn)
-
-    for fn in fnlist:
-        bfn = basename(fn)
-        file_ext = fn.split(".")[-1]
-        tier = find_tier(bfn)
-        key_name = make_key(job["hid"], job["block"]["num"], bfn, tier)
-        upload_indexed_file(
-            fn,
-            job["bucket"],
-            key_name,
-            job["hid"],
-            block=job["block"]["num"],
-            file_class="partial_metadata" if file_ext == "json" else "block_array",
-            pgsql_=pgsql_,
-        )
+    from sotera.analysis.convert import convert_blocks
 
-    if "TIME_SYNC" in data["__meta__"]["ARRAYS"].keys():
-        with pgsql_, pgsql_.cursor() as cursor:
-            cursor.execute(
-                f"""UPDATE aa_blocks
-                        SET device_id={data['__meta__']['DEVICES'][0]},
-                            unix_start={int(data['__meta__']['T0'])},
-                            unix_stop={int(data['__meta__']['T1'])},
-                            session_guid = '{job['session_guid']}'
-                    WHERE hid={job['hid']}
-                        AND block_number={job['block']['num']}"""
-            )
-
-    if dst is not None:
-        rmtree(dst, ignore_errors=True)
-    if chunk_tmpdir is not None:
-        rmtree(chunk_tmpdir, ignore_errors=True)
-
-    return fnlist
+    return convert_blocks(pgsql_, aid, jobid, job)
 
 
 def make_metadata_merge_analysis(pgsql_, aid, name="convert-merge-metadata"):
     aid1 = add_analysis(pgsql_, name=name)
     s = f"""
     with y as ( WITH x AS (
-       SELECT (args->>'hid')::int AS hid, (args->'block'->>'num')::int AS block,
+       SELECT (args->>'hid')::int AS hid, (b->>'num')::int AS block,
               jsonb_array_elements_text("returns") AS fn
-       FROM analysis_jobs
+       FROM analysis_jobs,
+            jsonb_array_elements(
+                COALESCE(args->'blocks', jsonb_build_array(args->'block'))) AS b
        WHERE aid = {aid} AND is_complete=true)
      SELECT x.hid, x.block, min(fi.bucket) as bucket, jsonb_agg(fi.key) as partials
      FROM x
      INNER JOIN file_info fi ON fi.hid = x.hid AND fi.block = x.block
      WHERE x.fn LIKE '%meta%.json'
-     AND  fi.key LIKE '%'||split_part(fn, '/', 4)||'%'
+     AND  fi.key LIKE '%'||regexp_replace(fn, '^.*/', '')||'%'
      AND fi.file_class = 'partial_metadata'
      GROUP BY x.hid, x.block )
     INSERT INTO analysis.analysis_jobs (aid,args)
@@ -363,8 +310,10 @@ def update_lucene_index_status(pgsql_, aid0, STEP=20000):
     with pgsql_, pgsql_.cursor() as cursor:
         cursor.execute(
             f""" SELECT aj.args->'hid',
-            aj.args->'block'->'chunks'->0->'file'
-                FROM analysis_jobs aj
+            b->'chunks'->0->'file'
+                FROM analysis_jobs aj,
+                     jsonb_array_elements(COALESCE(
+                         aj.args->'blocks', jsonb_build_array(aj.args->'block'))) b
                 WHERE aid = {aid0}"""
         )
         list_ = []
@@ -385,10 +334,13 @@ def update_lucene_index_status(pgsql_, aid0, STEP=20000):
             FROM lucene_indexes
             WHERE status='waiting_for_conversion'
             AND (hid, session_guid, index_class) IN ({tmp})"""
+        # one row per converted block, jobs may have several "blocks"
         sql2 = """ SELECT jobid, is_complete
-                    FROM analysis_jobs
+                    FROM analysis_jobs,
+                         jsonb_array_elements(COALESCE(
+                             args->'blocks', jsonb_build_array(args->'block'))) b
                     WHERE aid = {} AND args @> '{{"hid":  {} }}'
-                        AND args->'block'->'chunks'->0->>'file' LIKE '{}-{}%'
+                        AND b->'chunks'->0->>'file' LIKE '{}-{}%'
                         AND is_complete IS true"""
 
         sql3 = """UPDATE lucene_indexes set status='converted' where
@@ -494,9 +446,11 @@ def populate_delete_vchk_analysis(pgsql_, aid0, aid):
             f"""WITH a AS ( WITH z AS ( WITH y AS ( WITH x AS (
               SELECT args->>'bucket' AS bucket,
                      args->>'hid'||'/'||(json_array_elements(
-                         (args->'block'->'chunks')::json)->>'file'
+                         (b->'chunks')::json)->>'file'
                      )::varchar AS key
-                FROM analysis_jobs
+                FROM analysis_jobs,
+                     jsonb_array_elements(COALESCE(
+                         args->'blocks', jsonb_build_array(args->'block'))) b
                WHERE aid = {aid0}
                  AND is_complete IS TRUE
               )
@@ -528,10 +482,6 @@ def populate_delete_vchk_analysis(pgsql_, aid0, aid):
 
 @cluster_decorate()
 def cluster_delete_vchk(pgsql_, aid, jobid, job):
-    return (
-        get_boto3_session()
-        .client("s3")
-        .delete_objects(
-            Bucket=job["bucket"], Delete={"Objects": [{"Key": i} for i in job["keys"]]}
-        )
+    return get_boto3_client("s3").delete_objects(
+        Bucket=job["bucket"], Delete={"Objects": [{"Key": i} for i in job["keys"]]}
     )
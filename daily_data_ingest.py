@@ -38,7 +38,7 @@ from sotera.aws.ipcluster import (
 )
 
 # import sotera.analysis.convert
-from sotera.cluster.control import add_analysis, job_generator
+from sotera.cluster.control import add_analysis, add_job_lease_columns, job_worker
 from sotera.db.db_api import get_bucket_by_hid
 from analytics.ingest.convert import (
     downloads_on,
@@ -50,7 +50,6 @@ from analytics.ingest.convert import (
     cluster_merge_metadata,
     get_max_block_num,
     insert_block,
-    make_job,
     update_block_numbers,
     update_lucene_index_status_only,
     update_lucene_index_status,
@@ -59,6 +58,7 @@ from analytics.ingest.convert import (
     cluster_delete_vchk,
 )
 from analytics.ingest.triage import post_session_triage
+from sotera.analysis.convert import DEFAULT_PACK_BYTES, make_block_jobs
 from analytics.ingest.site_health import populate_lir_table
 
 logging.getLogger().setLevel(logging.INFO)
@@ -165,10 +165,9 @@ for li in archived_lucene_indexes_data[1:]:
             # insert into aa_blocks
             insert_block(pgsql_, hid=li["hid"], block_number=current_block_num)
             block["num"] = current_block_num
-            args["block"] = block
-            # create the job in analysis_jobs
-            make_job(pgsql_, aid, args)
             current_block_num += 1
+    # create the jobs in analysis_jobs, small blocks share a job
+    make_block_jobs(pgsql_, aid, args, blocks, pack_bytes=DEFAULT_PACK_BYTES)
 
     # update lucene_indexes table
     update_block_numbers(pgsql_, li["session_guid"], "data", li["pds_id"], blocks)
@@ -188,7 +187,8 @@ print(len(archived_lucene_indexes_data), len(archived_lucene_indexes_waveform))
 downloads_on(pgsql_)
 
 # + tags=[]
-lview = cluster_get_client(cluster_name).load_balanced_view()
+client = cluster_get_client(cluster_name)
+lview = client.load_balanced_view()
 while len(lview) < 0.9 * ninstances * nodes_per_instance:
     sleep(10)
 sleep(60)
@@ -198,7 +198,9 @@ print(aid0, len(lview))
 len(lview)
 
 # + tags=[]
-result = lview.map_async(cluster_block_convert, job_generator(pgsql_, aid0))
+# every engine claims jobs until none are left
+add_job_lease_columns(pgsql_)
+result = client[:].apply_async(job_worker, cluster_block_convert, aid0)
 
 # + tags=[] jupyter={"outputs_hidden": true}
 with suppress(KeyboardInterrupt):
@@ -209,7 +211,7 @@ print_analysis_status(pgsql_, aid0)
 
 print(aid1 := make_metadata_merge_analysis(pgsql_, aid))
 
-result = lview.map_async(cluster_merge_metadata, job_generator(pgsql_, aid1))
+result = client[:].apply_async(job_worker, cluster_merge_metadata, aid1)
 
 # + tags=[] jupyter={"outputs_hidden": true}
 with suppress(KeyboardInterrupt):
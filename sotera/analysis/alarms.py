@@ -1,5 +1,6 @@
 import numpy as np
 from psycopg2.extras import DictCursor
+from sotera.db.batch import batch_writer
 
 AA_PARAMS = {
     "SPO2": ["LOW"],
@@ -168,10 +169,16 @@ bin_labels = [
 ]
 
 
-def time_in_alarms_histogram(pg_write_cursor, hid, kind, name, Alarms):
-    sql = """INSERT INTO aa_time_in_alarm_histograms
-             (hid, param, alarm_type, bin_id, frequency, time_over_threshold)
-             VALUES (%s,%s,%s,%s,%s,%s)"""
+def time_in_alarms_histogram(writer, hid, kind, name, Alarms):
+    table = "aa_time_in_alarm_histograms"
+    columns = (
+        "hid",
+        "param",
+        "alarm_type",
+        "bin_id",
+        "frequency",
+        "time_over_threshold",
+    )
 
     alarm_durations = Alarms[:, 1] - Alarms[:, 0] - Alarms[:, 2]
     frequencies, bins = np.histogram(alarm_durations, bins=bin_defaults)
@@ -183,8 +190,9 @@ def time_in_alarms_histogram(pg_write_cursor, hid, kind, name, Alarms):
                     (alarm_durations >= bins[i - 1]) * (alarm_durations < bins[i])
                 ]
             )
-            pg_write_cursor.execute(
-                sql,
+            writer.add(
+                table,
+                columns,
                 (
                     hid,
                     name,
@@ -498,11 +506,10 @@ def find_spo2_times(param, update_rate=3, slop=0.1):
     return time, xx_times, reset_times, dropout_times, off_times
 
 
-def time_in_xx_histogram(pg_write_cursor, hid, name, xx_times):
+def time_in_xx_histogram(writer, hid, name, xx_times):
 
-    sql = """INSERT INTO aa_time_in_xx_histograms
-             (hid, param, bin_id, frequency, time_in_xx, dropout_time)
-             VALUES (%s,%s,%s,%s,%s,%s)"""
+    table = "aa_time_in_xx_histograms"
+    columns = ("hid", "param", "bin_id", "frequency", "time_in_xx", "dropout_time")
 
     if xx_times.shape[0] > 0:
         xx_durations = xx_times[:, 1] - xx_times[:, 0]
@@ -513,8 +520,9 @@ def time_in_xx_histogram(pg_write_cursor, hid, name, xx_times):
                 idx = (xx_durations >= bins[i - 1]) * (xx_durations < bins[i])
                 bin_time = np.sum(xx_durations[idx])
                 drop_time = np.sum(xx_times[idx, 2])
-                pg_write_cursor.execute(
-                    sql,
+                writer.add(
+                    table,
+                    columns,
                     (
                         hid,
                         name,
@@ -526,11 +534,10 @@ def time_in_xx_histogram(pg_write_cursor, hid, name, xx_times):
                 )
 
 
-def time_in_dropout_histogram(pg_write_cursor, hid, name, dropout_times):
+def time_in_dropout_histogram(writer, hid, name, dropout_times):
 
-    sql = """INSERT INTO aa_time_in_dropout_histograms
-             (hid, param, bin_id, frequency, time_in_dropout)
-             VALUES (%s,%s,%s,%s,%s)"""
+    table = "aa_time_in_dropout_histograms"
+    columns = ("hid", "param", "bin_id", "frequency", "time_in_dropout")
 
     if dropout_times.shape[0] > 0:
         dropout_durations = dropout_times[:, 1] - dropout_times[:, 0]
@@ -543,8 +550,9 @@ def time_in_dropout_histogram(pg_write_cursor, hid, name, dropout_times):
                         * (dropout_durations < bins[i])
                     ]
                 )
-                pg_write_cursor.execute(
-                    sql,
+                writer.add(
+                    table,
+                    columns,
                     (
                         hid,
                         name,
@@ -556,28 +564,29 @@ def time_in_dropout_histogram(pg_write_cursor, hid, name, dropout_times):
 
 
 def find_alarms(
-    pg_write_cursor, hid, kind, name, param, limit_range, delay_range, save_list=()
+    writer, hid, kind, name, param, limit_range, delay_range, save_list=()
 ):
 
-    sql = """INSERT INTO aa_alarms
-             (hid, param, alarm_type, threshold, delay, alarms, time_over_threshold)
-             VALUES (%s,%s,%s,%s,%s,%s,%s)"""
+    table = "aa_alarms"
+    columns = (
+        "hid",
+        "param",
+        "alarm_type",
+        "threshold",
+        "delay",
+        "alarms",
+        "time_over_threshold",
+    )
 
-    Alarms = {}
-    for limit in range(limit_range[0], limit_range[1] + limit_range[2], limit_range[2]):
-        a = process_aa_limit_fcn(kind, param, limit)
-        if limit in save_list:
-            Alarms[limit] = None if a is None else a.copy()
-        for delay in range(
-            delay_range[0], delay_range[1] + delay_range[2], delay_range[2]
-        ):
-            num_alarms, time_over_threshold = process_aa_delay_fcn(a, delay)
-            if num_alarms > 0:
-                pg_write_cursor.execute(
-                    sql,
-                    (hid, name, kind, limit, delay, num_alarms, time_over_threshold),
-                )
-    return Alarms
+    limits = range(limit_range[0], limit_range[1] + limit_range[2], limit_range[2])
+    delays = range(delay_range[0], delay_range[1] + delay_range[2], delay_range[2])
+    alarms = find_alarm_episodes(kind, param, limits)
+    writer.add_rows(
+        table,
+        columns,
+        ((hid, name, kind) + tuple(row) for row in alarm_table(alarms, delays)),
+    )
+    return {limit: alarms[limit] for limit in limits if limit in save_list}
 
 
 def process_aa_limit_fcn(kind, param, ALARM_LIMIT):
@@ -787,7 +796,156 @@ def process_aa_delay_fcn(Alarms, delay):
     return num_alarms, time_over_threshold
 
 
-def patient_alarms(pgsql_, hid, site, data, cr_data):
+ALARMING_STATE, NORM_STATE, XX_STATE, NO_STATE = 1, 0, -1, 2
+
+
+def alarm_states(kind, values, limits):
+    """State of every numeric value for every alarm limit, as classified by
+    process_aa_limit_fcn: a (limits, values) int8 array of ALARMING_STATE,
+    NORM_STATE, XX_STATE, or NO_STATE for values that are none of them."""
+    v = values[None, :]
+    lim = np.asarray(limits)[:, None]
+    xx = (values == -1) | (values == -2) | (values == -3)
+    if kind == "HIGH":
+        alarm = (v >= lim) | (v == -4)
+        norm = ((v < lim) & (v >= 0)) | (v == -5)
+    elif kind == "LOW":
+        alarm = ((v <= lim) & (v >= 0)) | (v == -5)
+        norm = v > lim
+    else:
+        raise ValueError("Unknown alarm type {}".format(kind))
+    states = np.full(alarm.shape, NO_STATE, dtype=np.int8)
+    states[norm] = NORM_STATE
+    states[:, xx] = XX_STATE
+    states[alarm] = ALARMING_STATE
+    return states
+
+
+def find_alarm_episodes(kind, param, limits):
+    """The alarms of process_aa_limit_fcn for all `limits` in one pass.
+
+    Returns {limit: Alarms}, where Alarms has the [start, stop, xx time,
+    bucket] rows process_aa_limit_fcn returns for that limit, or is None.
+
+    The condition array entries (the first value of each run of a state)
+    of all limits are found at once and merged into runs of one state. An
+    alarm run starts an alarm unless it follows a single XX entry that
+    follows an alarm run, which is bridged. An alarm ends, and is checked,
+    when its alarm run or bridging XX run is followed by a normal run or the
+    end of the data. The bucket is filled by the alarm time of each alarm
+    and leaked at LEAKRATE over every normal run followed by another state,
+    never dropping below zero, which is computed with cumulative sums.
+    """
+    LEAKRATE = 30  # seconds/second
+    limits = list(limits)
+    episodes = dict.fromkeys(limits)
+    if param.shape[0] == 0:
+        return episodes
+    states = alarm_states(kind, param[:, 2], limits)
+    has_alarm = np.any(states == ALARMING_STATE, axis=1)
+    states = states[has_alarm, :]
+    limits = [limit for limit, a in zip(limits, has_alarm) if a]
+    if not limits:
+        return episodes
+    t = param[:, 1].astype(float)
+
+    # condition array entries of every limit, in (limit, index) order
+    start = states != NO_STATE
+    start[:, 1:] &= states[:, 1:] != states[:, :-1]
+    el, ej = np.nonzero(start)
+    es = states[el, ej]
+    del start, states
+
+    # merge repeated entries of a state (split by values of no state) into
+    # runs; a run ends at the start of the next one or the last value
+    k = np.flatnonzero(np.r_[True, (el[1:] != el[:-1]) | (es[1:] != es[:-1])])
+    rl, rs, rt = el[k], es[k], t[ej[k]]
+    count = np.diff(np.r_[k, el.shape[0]])
+    has_next = np.r_[rl[1:] == rl[:-1], False]
+    has_prev = np.r_[False, has_next[:-1]]
+    rt_next = np.where(has_next, np.r_[rt[1:], 0.0], t[-1])
+    rs_next = np.where(has_next, np.r_[rs[1:], NO_STATE], NO_STATE)
+    rs_prev = np.where(has_prev, np.r_[NO_STATE, rs[:-1]], NO_STATE)
+
+    bridge = (rs == XX_STATE) & (count == 1) & (rs_prev == ALARMING_STATE)
+    begins = (rs == ALARMING_STATE) & ~(np.r_[False, bridge[:-1]] & has_prev)
+    ends = ((rs == ALARMING_STATE) | bridge) & (
+        (rs_next == NORM_STATE) | ~has_next
+    )
+    i = np.flatnonzero(ends)
+    b = np.flatnonzero(begins)[np.cumsum(begins)[i] - 1]
+    xx_time = np.cumsum(np.where(bridge, rt_next - rt, 0.0))
+    start_alrm = rt[b]
+    stop_alrm = rt_next[i]
+    xx_time = xx_time[i] - xx_time[b]
+
+    # leaky bucket, bucket = max(0, bucket + x) for every run
+    x = np.zeros(rs.shape)
+    x[i] = stop_alrm - start_alrm - xx_time
+    leak = (rs == NORM_STATE) & has_next
+    x[leak] = -LEAKRATE * (rt_next[leak] - rt[leak])
+    bucket = np.empty(rs.shape)
+    bounds = np.flatnonzero(np.r_[True, ~has_next])
+    for r0, r1 in zip(bounds[:-1], bounds[1:]):
+        S = np.cumsum(x[r0:r1])
+        bucket[r0:r1] = S - np.minimum(np.minimum.accumulate(S), 0)
+
+    Alarms = np.c_[start_alrm, stop_alrm, xx_time, bucket[i]]
+    bounds = np.searchsorted(rl[i], np.arange(len(limits) + 1))
+    for g, limit in enumerate(limits):
+        if bounds[g + 1] > bounds[g]:
+            episodes[limit] = Alarms[bounds[g] : bounds[g + 1], :]
+    return episodes
+
+
+def alarm_table(alarms, delays):
+    """(threshold, delay, num_alarms, time_over_threshold) rows for the
+    {limit: Alarms} `alarms` and every delay, like process_aa_delay_fcn,
+    leaving out the rows without alarms."""
+    delays = np.asarray(delays)
+    rows = [np.empty((0, 4), dtype=int)]
+    for limit, Alarms in alarms.items():
+        if Alarms is None:
+            continue
+        # alarms with a bucket >= delay are the first num_alarms by bucket
+        order = np.argsort(-Alarms[:, 3], kind="stable")
+        bucket = Alarms[order, 3]
+        alarm_time = (Alarms[:, 1] - Alarms[:, 0] - Alarms[:, 2])[order]
+        num_alarms = np.searchsorted(-bucket, -delays, side="right")
+        time_over_threshold = np.r_[0.0, np.cumsum(alarm_time)][num_alarms]
+        idx = num_alarms > 0
+        rows.append(
+            np.c_[
+                np.full(np.sum(idx), limit, dtype=int),
+                delays[idx],
+                num_alarms[idx],
+                time_over_threshold[idx].astype(int),
+            ]
+        )
+    return np.vstack(rows)
+
+
+def compare_alarm_tables(kind, param, limit_range, delay_range):
+    """Check find_alarm_episodes and alarm_table against running
+    process_aa_limit_fcn and process_aa_delay_fcn limit by limit.
+
+    Returns the (threshold, delay, num_alarms, time_over_threshold) rows
+    found by only one of them; empty when they agree."""
+    limits = range(limit_range[0], limit_range[1] + limit_range[2], limit_range[2])
+    delays = range(delay_range[0], delay_range[1] + delay_range[2], delay_range[2])
+    expected = set()
+    for limit in limits:
+        a = process_aa_limit_fcn(kind, param, limit)
+        for delay in delays:
+            num_alarms, time_over_threshold = process_aa_delay_fcn(a, delay)
+            if num_alarms > 0:
+                expected.add((limit, delay, num_alarms, time_over_threshold))
+    table = alarm_table(find_alarm_episodes(kind, param, limits), delays)
+    found = set(tuple(int(v) for v in row) for row in table)
+    return sorted(expected ^ found)
+
+
+def patient_alarms(pgsql_, hid, site, data, cr_data, writer=None):
     """
     Run Alarms Analysis over Vital Signs
     """
@@ -840,10 +998,10 @@ def patient_alarms(pgsql_, hid, site, data, cr_data):
                     LDR[param][kind]["MAX"],
                     LDR[param][kind]["INC"],
                 )
-                with pgsql_, pgsql_.cursor() as pg_write_cursor:
+                with batch_writer(pgsql_, writer) as batch:
                     if param in ("HR", "PR"):
                         a = find_alarms(
-                            pg_write_cursor,
+                            batch,
                             hid,
                             kind,
                             param,
@@ -857,7 +1015,7 @@ def patient_alarms(pgsql_, hid, site, data, cr_data):
                         )
                         if param == "HR":
                             a = find_alarms(
-                                pg_write_cursor,
+                                batch,
                                 hid,
                                 kind,
                                 "HR_A",
@@ -867,7 +1025,7 @@ def patient_alarms(pgsql_, hid, site, data, cr_data):
                             )
                     else:
                         a = find_alarms(
-                            pg_write_cursor,
+                            batch,
                             hid,
                             kind,
                             param,
@@ -878,11 +1036,17 @@ def patient_alarms(pgsql_, hid, site, data, cr_data):
                 if param in ("HR", "PR"):
                     alarms[param][kind] = a
 
-    sql = """INSERT
-               INTO aa_alarms
-                    (hid, param, alarm_type, threshold,
-                     delay, delay_hr, alarms, time_over_threshold)
-             VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"""
+    table = "aa_alarms"
+    columns = (
+        "hid",
+        "param",
+        "alarm_type",
+        "threshold",
+        "delay",
+        "delay_hr",
+        "alarms",
+        "time_over_threshold",
+    )
 
     seen = {}
     for kind in ["HIGH", "LOW"]:
@@ -927,9 +1091,10 @@ def patient_alarms(pgsql_, hid, site, data, cr_data):
             if cr_alarms is not None:
                 num_alarms = cr_alarms.shape[0]
                 time_over_threshold = int(np.sum(cr_alarms[:, 1] - cr_alarms[:, 0]))
-                with pgsql_, pgsql_.cursor() as pg_write_cursor:
-                    pg_write_cursor.execute(
-                        sql,
+                with batch_writer(pgsql_, writer) as batch:
+                    batch.add(
+                        table,
+                        columns,
                         (
                             hid,
                             "CR",
@@ -958,11 +1123,10 @@ def run_itemfreq(param, MINIM, MAXIM):
     return Hist
 
 
-def patient_numeric_histograms(pgsql_, hid, data):
+def patient_numeric_histograms(pgsql_, hid, data, writer=None):
 
-    sql = """INSERT INTO aa_numeric_histograms
-             (hid, param, bin, frequency)
-             VALUES (%s,%s,%s,%s)"""
+    table = "aa_numeric_histograms"
+    columns = ("hid", "param", "bin", "frequency")
 
     hist_limits = {
         "SPO2": (49.0, 100.0),
@@ -979,7 +1143,7 @@ def patient_numeric_histograms(pgsql_, hid, data):
     Hist = {}
 
     for param in hist_limits.keys():
-        with pgsql_, pgsql_.cursor() as pg_write_cursor:
+        with batch_writer(pgsql_, writer) as batch:
             if param in data.keys():
                 Hist[param] = run_itemfreq(
                     data[param], hist_limits[param][0], hist_limits[param][1]
@@ -987,11 +1151,14 @@ def patient_numeric_histograms(pgsql_, hid, data):
             else:
                 Hist[param] = None
             if Hist[param] is not None:
-                for row in Hist[param]:
-                    pg_write_cursor.execute(sql, (hid, param, int(row[0]), int(row[1])))
+                batch.add_rows(
+                    table,
+                    columns,
+                    ((hid, param, int(row[0]), int(row[1])) for row in Hist[param]),
+                )
 
 
-def patient_time_in_histograms(pgsql_, hid, data, post_combo=False):
+def patient_time_in_histograms(pgsql_, hid, data, post_combo=False, writer=None):
 
     with pgsql_.cursor(cursor_factory=DictCursor) as read_cursor:
         read_cursor.execute("SELECT * FROM aa_site_defaults WHERE code='Sotera'")
@@ -1074,10 +1241,10 @@ def patient_time_in_histograms(pgsql_, hid, data, post_combo=False):
                                 Alarms = process_aa_limit_fcn(
                                     kind, data[name], ALARM_LIMIT
                                 )
-                                with pgsql_, pgsql_.cursor() as pg_write_cursor:
+                                with batch_writer(pgsql_, writer) as batch:
                                     if Alarms is not None:
                                         time_in_alarms_histogram(
-                                            pg_write_cursor, hid, kind, name, Alarms
+                                            batch, hid, kind, name, Alarms
                                         )
                                     if name in param_seen.keys():
                                         pass
@@ -1104,11 +1271,11 @@ def patient_time_in_histograms(pgsql_, hid, data, post_combo=False):
                                             )
                                         if xx_times is not None:
                                             time_in_xx_histogram(
-                                                pg_write_cursor, hid, name, xx_times
+                                                batch, hid, name, xx_times
                                             )
                                         if dropout_times is not None:
                                             time_in_dropout_histogram(
-                                                pg_write_cursor,
+                                                batch,
                                                 hid,
                                                 name,
                                                 dropout_times,
@@ -1164,19 +1331,19 @@ def patient_time_in_histograms(pgsql_, hid, data, post_combo=False):
     else:
         param_times["CR"]["display-percentage"] = -1
 
-    with pgsql_, pgsql_.cursor() as pg_write_cursor:
+    with batch_writer(pgsql_, writer) as batch:
         if xx_times is not None:
-            time_in_xx_histogram(pg_write_cursor, hid, "CR", xx_times)
+            time_in_xx_histogram(batch, hid, "CR", xx_times)
 
         if dropout_times is not None:
-            time_in_dropout_histogram(pg_write_cursor, hid, "CR", dropout_times)
+            time_in_dropout_histogram(batch, hid, "CR", dropout_times)
 
         times, session_dropout_times = find_session_times(
             data["TIME_SYNC"], param_times, update_rates["TIME_SYNC"]
         )
         if session_dropout_times is not None:
             time_in_dropout_histogram(
-                pg_write_cursor, hid, "ALL", session_dropout_times
+                batch, hid, "ALL", session_dropout_times
             )
 
     return times, cr_data
@@ -6,66 +6,142 @@ from sotera.cluster.control import cluster_decorate, add_analysis
 
 @cluster_decorate()
 def cluster_block_convert(pgsql_, aid, jobid, job):
+    from sotera.analysis.convert import convert_blocks
+
+    return convert_blocks(pgsql_, aid, jobid, job)
+
+
+DEFAULT_PACK_BYTES = 64 * 2 ** 20  # chunk bytes converted per job
+
+
+def block_bytes(block):
+    """Total size of the chunks of a block, from its blockmap."""
+    return sum(c.get("size", 0) for c in block["chunks"])
+
+
+def pack_blocks(blocks, max_bytes=DEFAULT_PACK_BYTES):
+    """Split blocks into runs of consecutive blocks of at most max_bytes
+    chunk bytes each. A block larger than that gets a run of its own."""
+    packs = []
+    pack, nbytes = [], 0
+    for block in blocks:
+        size = block_bytes(block)
+        if pack and nbytes + size > max_bytes:
+            packs.append(pack)
+            pack, nbytes = [], 0
+        pack.append(block)
+        nbytes += size
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def convert_block(pgsql_, job, block, tmpdir, s3_client, s3_resource):
+    """Convert one block of a conversion job and upload its arrays. Returns
+    the list of converted files."""
     from uuid import uuid1
     from shutil import rmtree
     from tempfile import mkdtemp
     from os.path import join as joinpath, basename
     from sotera.io import find_tier, make_key
-    from sotera.io.local import save_block
-    from sotera.io.visi.convert import convert_block
+    from sotera.io.visi.convert import convert_block_to_folder
     from sotera.io.cloud import download_file, upload_indexed_file
 
-    fnlist = []
-    dst = None
-    chunk_tmpdir = None
-    blockmap = job["block"].copy()
-    chunk_tmpdir = mkdtemp()
-    for chunk in blockmap["chunks"]:
-        key_name = f"{job['hid']}/{chunk['file']}"
-        localfn = joinpath(chunk_tmpdir, chunk["file"])
-        download_file(job["bucket"], key_name, localfn)
-        chunk["file"] = localfn
-
-    data = convert_block(blockmap)
-    dst = mkdtemp()
-    metafn = f"meta-{uuid1()}.json"
-    fnlist = save_block(dst, data, use_compression=True, metafn=metafn)
-
-    for fn in fnlist:
-        bfn = basename(fn)
-        file_ext = fn.split(".")[-1]
-        tier = find_tier(bfn)
-        key_name = make_key(job["hid"], job["block"]["num"], bfn, tier)
-        upload_indexed_file(
-            fn,
-            job["bucket"],
-            key_name,
-            job["hid"],
-            block=job["block"]["num"],
-            file_class="partial_metadata" if file_ext == "json" else "block_array",
-            pgsql_=pgsql_,
+    blockmap = dict(block, chunks=[dict(c) for c in block["chunks"]])
+    chunk_tmpdir = mkdtemp(dir=tmpdir)
+    dst = mkdtemp(dir=tmpdir)
+    try:
+        for chunk in blockmap["chunks"]:
+            key_name = f"{job['hid']}/{chunk['file']}"
+            localfn = joinpath(chunk_tmpdir, chunk["file"])
+            download_file(job["bucket"], key_name, localfn, client=s3_client)
+            chunk["file"] = localfn
+
+        metafn = f"meta-{uuid1()}.json"
+        fnlist, meta = convert_block_to_folder(
+            blockmap, dst, use_compression=True, metafn=metafn
         )
 
-    if "TIME_SYNC" in data["__meta__"]["ARRAYS"].keys():
-        with pgsql_, pgsql_.cursor() as cursor:
-            cursor.execute(
-                f"""UPDATE aa_blocks
-                        SET device_id={data['__meta__']['DEVICES'][0]},
-                            unix_start={int(data['__meta__']['T0'])},
-                            unix_stop={int(data['__meta__']['T1'])},
-                            session_guid = '{job['session_guid']}'
-                    WHERE hid={job['hid']}
-                        AND block_number={job['block']['num']}"""
+        for fn in fnlist:
+            bfn = basename(fn)
+            file_ext = fn.split(".")[-1]
+            tier = find_tier(bfn)
+            key_name = make_key(job["hid"], block["num"], bfn, tier)
+            upload_indexed_file(
+                fn,
+                job["bucket"],
+                key_name,
+                job["hid"],
+                block=block["num"],
+                file_class="partial_metadata" if file_ext == "json" else "block_array",
+                pgsql_=pgsql_,
+                s3_resource=s3_resource,
             )
 
-    if dst is not None:
+        if "TIME_SYNC" in meta["ARRAYS"].keys():
+            with pgsql_, pgsql_.cursor() as cursor:
+                cursor.execute(
+                    f"""UPDATE aa_blocks
+                            SET device_id={meta['DEVICES'][0]},
+                                unix_start={int(meta['T0'])},
+                                unix_stop={int(meta['T1'])},
+                                session_guid = '{job['session_guid']}'
+                        WHERE hid={job['hid']}
+                            AND block_number={block['num']}"""
+                )
+    finally:
         rmtree(dst, ignore_errors=True)
-    if chunk_tmpdir is not None:
         rmtree(chunk_tmpdir, ignore_errors=True)
 
     return fnlist
 
 
+def convert_blocks(pgsql_, aid, jobid, job):
+    """Convert the block of a conversion job, or each of its "blocks" when
+    several were packed into it. All blocks share the S3 clients and a temp
+    directory. A packed block that fails to convert is moved out of the job
+    into a job of its own in aid, so the failure is reported for that block
+    and the job's "blocks" are the blocks it converted."""
+    import logging
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    from sotera.aws import get_boto3_client, get_boto3_resource
+
+    s3_client = get_boto3_client("s3")
+    s3_resource = get_boto3_resource("s3")
+    tmpdir = mkdtemp()
+    try:
+        if "blocks" not in job:
+            return convert_block(
+                pgsql_, job, job["block"], tmpdir, s3_client, s3_resource
+            )
+        fnlist, converted = [], []
+        for block in job["blocks"]:
+            try:
+                fnlist += convert_block(
+                    pgsql_, job, block, tmpdir, s3_client, s3_resource
+                )
+            except Exception:
+                logging.exception(f"{job['hid']}:{block['num']} conversion failed")
+                pgsql_.rollback()
+                args = {k: v for k, v in job.items() if k != "blocks"}
+                args["block"] = block
+                make_job(pgsql_, aid, args)
+            else:
+                converted.append(block)
+        if len(converted) < len(job["blocks"]):
+            with pgsql_, pgsql_.cursor() as cursor:
+                cursor.execute(
+                    """UPDATE analysis_jobs
+                          SET args = jsonb_set(args, '{blocks}', %s::jsonb)
+                        WHERE jobid = %s""",
+                    (dumps(converted), jobid),
+                )
+        return fnlist
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+
 def get_archived_lucene_index_count(pgsql_):
     with pgsql_, pgsql_.cursor(cursor_factory=DictCursor) as cursor:
         cursor.execute(
@@ -169,7 +245,22 @@ def update_lucene_index_status_only(pgsql_, session_guid, index_class, pds_id, s
         )
 
 
-def add_to_conversion_aid(pgsql_, aid, min_blocks=200, max_blocks=10000000000):
+def make_block_jobs(pgsql_, aid, args, blocks, pack_bytes=None):
+    """Adds the conversion jobs of blocks: one job per block, or with
+    pack_bytes runs of consecutive blocks of up to that many chunk bytes in
+    the "blocks" of a job."""
+    if pack_bytes is None:
+        for block in blocks:
+            make_job(pgsql_, aid, dict(args, block=block))
+    else:
+        args = {k: v for k, v in args.items() if k != "block"}
+        for pack in pack_blocks(blocks, pack_bytes):
+            make_job(pgsql_, aid, dict(args, blocks=pack))
+
+
+def add_to_conversion_aid(
+    pgsql_, aid, min_blocks=200, max_blocks=10000000000, pack_bytes=None
+):
     num_blocks = get_archived_lucene_index_count(pgsql_)
     if num_blocks < min_blocks:
         return None
@@ -200,10 +291,9 @@ def add_to_conversion_aid(pgsql_, aid, min_blocks=200, max_blocks=10000000000):
                 # insert into aa_blocks
                 insert_block(pgsql_, hid=li["hid"], block_number=current_block_num)
                 block["num"] = current_block_num
-                args["block"] = block
-                # create the job in analysis_jobs
-                make_job(pgsql_, aid, args)
                 current_block_num += 1
+            # create the jobs in analysis_jobs
+            make_block_jobs(pgsql_, aid, args, blocks, pack_bytes)
             # update lucene_indexes table
             update_block_numbers(
                 pgsql_, li["session_guid"], "data", li["pds_id"], blocks
@@ -240,8 +330,7 @@ def add_to_conversion_aid(pgsql_, aid, min_blocks=200, max_blocks=10000000000):
             ):
                 for block, companion_block in zip(blocks, companion_data_blocks):
                     block["num"] = companion_block["num"]
-                    args["block"] = block
-                    make_job(pgsql_, aid, args)
+                make_block_jobs(pgsql_, aid, args, blocks, pack_bytes)
                 update_block_numbers(
                     pgsql_, li["session_guid"], "waveform", li["pds_id"], blocks
                 )
@@ -259,15 +348,17 @@ def cluster_make_metadata_merge(pgsql_, aid, name="convert-merge-metadata"):
     aid1 = add_analysis(pgsql_, name=name)
     s = f"""
     with y as ( WITH x AS (
-       SELECT (args->>'hid')::int AS hid, (args->'block'->>'num')::int AS block,
+       SELECT (args->>'hid')::int AS hid, (b->>'num')::int AS block,
               jsonb_array_elements_text("returns") AS fn
-       FROM analysis_jobs
+       FROM analysis_jobs,
+            jsonb_array_elements(
+                COALESCE(args->'blocks', jsonb_build_array(args->'block'))) AS b
        WHERE aid = {aid} AND is_complete=true)
      SELECT x.hid, x.block, min(fi.bucket) as bucket, jsonb_agg(fi.key) as partials
      FROM x
      INNER JOIN file_info fi ON fi.hid = x.hid AND fi.block = x.block
      WHERE x.fn LIKE '%meta%.json'
-     AND  fi.key LIKE '%'||split_part(fn, '/', 4)||'%'
+     AND  fi.key LIKE '%'||regexp_replace(fn, '^.*/', '')||'%'
      AND fi.file_class = 'partial_metadata'
      GROUP BY x.hid, x.block )
     INSERT INTO analysis.analysis_jobs (aid,args)
@@ -1,6 +1,20 @@
-from numpy import empty, where, round as npround, array
+from numpy import (
+    empty,
+    where,
+    round as npround,
+    array,
+    arange,
+    diff,
+    maximum,
+    searchsorted,
+)
 from sotera.cluster.control import cluster_decorate
-from sotera.io import load_session_data
+from sotera.db.batch import BatchWriter, batch_writer
+from sotera.io import (
+    load_session_data,
+    load_session_data_incremental,
+    save_session_state,
+)
 from sotera.analysis.numerics import (
     nibp_points_with_cnibp,
     nibp_points_only,
@@ -25,40 +39,71 @@ def has_all(data, arrs):
     return arrs_set.intersection(set(data.keys())) == arrs_set
 
 
-def mine_nibp(pgsql_, data):
-    sql = """INSERT INTO aa_nibp_values
-             (hid, unixtime, time_from_last, sys, dia, map,
-              cnibp_unixtime, cnibp_sys, cnibp_dia, cnibp_map, pr, error_code)
-              VALUES ({},{},{},{},{},{},{},{},{},{},{},{})"""
+def mine_nibp(pgsql_, data, writer=None):
+    table = "aa_nibp_values"
+    columns = (
+        "hid",
+        "unixtime",
+        "time_from_last",
+        "sys",
+        "dia",
+        "map",
+        "cnibp_unixtime",
+        "cnibp_sys",
+        "cnibp_dia",
+        "cnibp_map",
+        "pr",
+        "error_code",
+    )
     if "BP" in data.keys() and data["BP"].shape[0] > 0:
-        with pgsql_, pgsql_.cursor() as cursor:
-            if "CNIBP" in data.keys() and data["CNIBP"].shape[0] > 0:
-                for p in nibp_points_with_cnibp(data["BP"], data["CNIBP"]):
-                    cursor.execute(sql.format(data["__info__"].hid, *p))
-            else:
-                for p in nibp_points_only(data["BP"]):
-                    cursor.execute(sql.format(data["__info__"].hid, *p))
-
-
-def mine_cnibp_bland_altman(pgsql_, data):
+        if "CNIBP" in data.keys() and data["CNIBP"].shape[0] > 0:
+            points = nibp_points_with_cnibp(data["BP"], data["CNIBP"])
+        else:
+            points = nibp_points_only(data["BP"])
+        with batch_writer(pgsql_, writer) as batch:
+            batch.add_rows(
+                table,
+                columns,
+                ((data["__info__"].hid,) + tuple(p) for p in points),
+                copy=False,
+            )
+
+
+def mine_cnibp_bland_altman(pgsql_, data, writer=None):
+    table = "analytics.aa_cnibp_bland_altman"
+    columns = (
+        "hid",
+        "bp_unixtime",
+        "bp_sys",
+        "bp_dia",
+        "bp_map",
+        "cnibp_unixtime",
+        "cnibp_sys",
+        "cnibp_dia",
+        "cnibp_map",
+        "mean_sys",
+        "mean_dia",
+        "mean_map",
+        "diff_sys",
+        "diff_dia",
+        "diff_map",
+    )
     if "BP" in data.keys() and "CNIBP" in data.keys():
-        with pgsql_, pgsql_.cursor() as cursor:
-            for p in cnibp_bland_altman_points(data["BP"], data["CNIBP"]):
-                cursor.execute(
-                    """INSERT
-                         INTO analytics.aa_cnibp_bland_altman
-                              (hid, bp_unixtime, bp_sys, bp_dia, bp_map,
-                               cnibp_unixtime, cnibp_sys, cnibp_dia,
-                               cnibp_map, mean_sys, mean_dia, mean_map,
-                               diff_sys, diff_dia, diff_map)
-                       VALUES ({},{},{},{},{},{},{},{},{},{},{},{},{},{},{})
-                    """.format(
-                        data["__info__"].hid, *p
-                    )
-                )
-
-
-def mine_cnibp_calibration_times(pgsql_, data):
+        with batch_writer(pgsql_, writer) as batch:
+            batch.add_rows(
+                table,
+                columns,
+                (
+                    (data["__info__"].hid,) + tuple(p)
+                    for p in cnibp_bland_altman_points(data["BP"], data["CNIBP"])
+                ),
+                copy=False,
+            )
+
+
+def mine_cnibp_calibration_times(pgsql_, data, writer=None):
+    table = "analytics.cnibp_calibrations"
+    columns = ("hid", "cal_num", "cal_start", "pie_fill_time", "nibp_inflation_time")
     arrs = (
         "TIME_SYNC",
         "CNIBP_CAL_PKT",
@@ -68,98 +113,190 @@ def mine_cnibp_calibration_times(pgsql_, data):
         "ARM_HT_PKT",
     )
     if has_all(data, arrs):
-        with pgsql_, pgsql_.cursor() as cursor:
-            for p in calculate_calibration_times(
-                data["TIME_SYNC"],
-                data["CNIBP_CAL_PKT"],
-                data["SENSOR_CONNECTION"],
-                data["BP"],
-                data["POSTURE_PKT"],
-                data["ARM_HT_PKT"],
-            ):
-                cursor.execute(
-                    """INSERT
-                         INTO analytics.cnibp_calibrations
-                              (hid, cal_num, cal_start, pie_fill_time,
-                               nibp_inflation_time)
-                       VALUES ({},{},{},{},{})
-                    """.format(
-                        data["__info__"].hid, *p
-                    )
-                )
-
-
-def mine_device_alarms_packets(pgsql_, data):
+        points = calculate_calibration_times(
+            data["TIME_SYNC"],
+            data["CNIBP_CAL_PKT"],
+            data["SENSOR_CONNECTION"],
+            data["BP"],
+            data["POSTURE_PKT"],
+            data["ARM_HT_PKT"],
+        )
+        with batch_writer(pgsql_, writer) as batch:
+            batch.add_rows(
+                table,
+                columns,
+                ((data["__info__"].hid,) + tuple(p) for p in points),
+                copy=False,
+            )
+
+
+def mine_device_alarms_packets(pgsql_, data, writer=None):
     if "ALARMS" in data.keys():
-        with pgsql_, pgsql_.cursor() as cursor:
-            for p in device_alarms_histogram(data["ALARMS"]):
-                cursor.execute(
-                    """INSERT
-                         INTO ih_device_alarms_histograms
-                              (hid, bin, frequency)
-                       VALUES ({},{},{})
-                    """.format(
-                        data["__info__"].hid, *p
-                    )
-                )
-
-            for p in device_alarms_info(data["ALARMS"], data["__info__"].tz):
-                cursor.execute(
-                    """INSERT
-                          INTO analytics.device_alarm_info
-                               (hid, seqnum_sent, utc_timestamp,
-                                alarm, severity, state, seqnum_start,
-                                day_of_week)
-                        VALUES ({},{},'{}',{},{},{},{},{})
-                    """.format(
-                        data["__info__"].hid, *p
-                    )
-                )
-
-
-def mine_spo2_control_histogram(pgsql_, data):
+        hid = data["__info__"].hid
+        with batch_writer(pgsql_, writer) as batch:
+            batch.add_rows(
+                "ih_device_alarms_histograms",
+                ("hid", "bin", "frequency"),
+                ((hid,) + tuple(p) for p in device_alarms_histogram(data["ALARMS"])),
+                copy=False,
+            )
+            # the timestamp goes in as text, like the literal it used to be
+            batch.add_rows(
+                "analytics.device_alarm_info",
+                (
+                    "hid",
+                    "seqnum_sent",
+                    "utc_timestamp",
+                    "alarm",
+                    "severity",
+                    "state",
+                    "seqnum_start",
+                    "day_of_week",
+                ),
+                (
+                    (hid, p[0], str(p[1])) + tuple(p[2:])
+                    for p in device_alarms_info(data["ALARMS"], data["__info__"].tz)
+                ),
+                copy=False,
+            )
+
+
+def _mine_histogram(pgsql_, data, table, points, writer=None):
+    with batch_writer(pgsql_, writer) as batch:
+        batch.add_rows(
+            table,
+            ("hid", "bin", "frequency"),
+            ((data["__info__"].hid,) + tuple(p) for p in points),
+            copy=False,
+        )
+
+
+def mine_spo2_control_histogram(pgsql_, data, writer=None):
     if "SPO2_CTRL" in data.keys():
-        with pgsql_, pgsql_.cursor() as cursor:
-            for p in spo2_control_histogram(data["SPO2_CTRL"]):
-                cursor.execute(
-                    """INSERT
-                         INTO ih_spo2_ctrl_histograms
-                              (hid, bin, frequency)
-                       VALUES ({},{},{})
-                    """.format(
-                        data["__info__"].hid, *p
-                    )
-                )
-
-
-def mine_ppg_beat_class_histogram(pgsql_, data):
+        _mine_histogram(
+            pgsql_,
+            data,
+            "ih_spo2_ctrl_histograms",
+            spo2_control_histogram(data["SPO2_CTRL"]),
+            writer,
+        )
+
+
+def mine_ppg_beat_class_histogram(pgsql_, data, writer=None):
     if "PPG_BEAT_PKT" in data.keys():
-        with pgsql_, pgsql_.cursor() as cursor:
-            for p in ppg_beat_class_histogram(data["PPG_BEAT_PKT"]):
-                cursor.execute(
-                    """INSERT
-                         INTO ih_ppg_beat_class_histograms
-                              (hid, bin, frequency)
-                       VALUES ({},{},{})
-                    """.format(
-                        data["__info__"].hid, *p
-                    )
-                )
-
-
-def mine_ppg_pmi_histogram(pgsql_, data):
+        _mine_histogram(
+            pgsql_,
+            data,
+            "ih_ppg_beat_class_histograms",
+            ppg_beat_class_histogram(data["PPG_BEAT_PKT"]),
+            writer,
+        )
+
+
+def mine_ppg_pmi_histogram(pgsql_, data, writer=None):
     if "HR_SCI" in data.keys() and "PPG_BEAT_PKT" in data.keys():
-        with pgsql_, pgsql_.cursor() as cursor:
-            for p in ppg_pmi_histogram(data["PPG_BEAT_PKT"]):
-                cursor.execute(
-                    """INSERT
-                         INTO ih_ppg_pmi_histograms
-                              (hid, bin, frequency)
-                       VALUES ({},{},{})
-                    """.format(
-                        data["__info__"].hid, *p
-                    )
-                )
+        _mine_histogram(
+            pgsql_,
+            data,
+            "ih_ppg_pmi_histograms",
+            ppg_pmi_histogram(data["PPG_BEAT_PKT"]),
+            writer,
+        )
+
+
+def _hr_a_loop(HR, PR):
+    aHR = empty((len(HR), 3))
+    pdx_track = 0
+    # Step Through the HRs
+    for idx in range(len(HR)):
+        ti = HR[idx][1]  # Time of HR numeric
+        if ti < PR[0][1]:  # If HR starts before PR append HRs to aHR
+            aHR[idx] = HR[idx]
+        else:
+            pdx = None
+            # Find corresponding PR index pdx (if any)
+            if ti >= PR[pdx_track, 1]:
+                # Check if current PR or next PR correspond..
+                if (
+                    PR[pdx_track, 1] == ti
+                ):  # If PR at index pdx_track is equal to ti
+                    pdx = pdx_track
+                else:
+                    if pdx_track < len(PR) - 2:
+                        if (
+                            PR[pdx_track + 1, 1] == ti
+                        ):  # If PR at index pdx_track+1 is equal to ti
+                            pdx = pdx_track + 1
+                        elif (
+                            PR[pdx_track, 1] < ti < PR[pdx_track + 1, 1]
+                        ):  # If HR beat in question is betwen
+                            # pdx_track and pdx_track+1
+                            pdx = pdx_track
+
+            if (
+                not pdx
+            ):  # If the previous PR and the one after do not match up...
+                # (Missing Data/PR or HR removed/etc)
+                if ti in PR[:, 1]:  # If exact HR time is in PR
+                    pdxs = [i for i, x in enumerate(PR[:, 1]) if x == ti]
+                    if len(pdxs) == 1:  # Only One Exact Match
+                        pdx = pdxs[0]
+                    else:
+                        print(idx)
+                        print(pdxs)
+                        # error = Time_Error
+                else:  # Look between ti-3 and ti to find PR
+                    s_ti = ti - 3
+                    ixn = (PR[:, 1] > s_ti) * (PR[:, 1] < ti)
+                    pdxs = where(ixn)[0]
+                    if pdxs.size > 0:
+                        if (
+                            len(pdxs) == 1
+                        ):  # Only One PR value in 3 second window
+                            pdx = pdxs[0]
+                        else:
+                            pdx = pdxs[
+                                len(pdxs) - 1
+                            ]  # Take value closest to HR time
+
+            if pdx:  # Corresponding PR found
+                pdx_track = pdx
+                # print(pdx)
+                if PR[pdx][2] == -1 or PR[pdx][2] == -2:
+                    aHR[idx] = HR[idx]
+                else:
+                    aHR[idx] = [HR[idx][0], HR[idx][1], -3]
+
+            else:  # No Corresponding PR
+                aHR[idx] = HR[idx]
+
+    return aHR
+
+
+def _hr_a_sorted(HR, PR):
+    """_hr_a_loop for HR times in order and PR times strictly increasing.
+
+    Each HR is matched to the last PR at or before it, if that PR is at the
+    same time or less than 3 s earlier. Once an HR has matched, the loop
+    keeps matching the later HRs before the next PR whatever their distance
+    (unless that PR is one of the last two), and a match with the first PR
+    is never used.
+    """
+    aHR = empty((len(HR), 3))
+    aHR[:] = HR
+    ti = HR[:, 1]
+    pr_t = PR[:, 1]
+    p = searchsorted(pr_t, ti, side="right") - 1
+    valid = p >= 0
+    pc = where(valid, p, 0)
+    match = valid & ((pr_t[pc] == ti) | (pr_t[pc] > ti - 3))
+    # index of the last matching HR so far
+    last = maximum.accumulate(where(match, arange(len(HR)), -1))
+    sticky = (last >= 0) & (p[where(last >= 0, last, 0)] == p) & (p < len(PR) - 2)
+    match = (match | (valid & sticky)) & (p > 0)
+    masked = match & (PR[pc, 2] != -1) & (PR[pc, 2] != -2)
+    aHR[masked, 2] = -3
+    return aHR
 
 
 def process_hr_a_data(data):
@@ -169,70 +306,14 @@ def process_hr_a_data(data):
         else:
             PR = data["PR"]
             HR = data["HR"]
-            aHR = empty((len(HR), 3))
-            pdx_track = 0
-            # Step Through the HRs
-            for idx in range(len(HR)):
-                ti = HR[idx][1]  # Time of HR numeric
-                if ti < PR[0][1]:  # If HR starts before PR append HRs to aHR
-                    aHR[idx] = HR[idx]
-                else:
-                    pdx = None
-                    # Find corresponding PR index pdx (if any)
-                    if ti >= PR[pdx_track, 1]:
-                        # Check if current PR or next PR correspond..
-                        if (
-                            PR[pdx_track, 1] == ti
-                        ):  # If PR at index pdx_track is equal to ti
-                            pdx = pdx_track
-                        else:
-                            if pdx_track < len(PR) - 2:
-                                if (
-                                    PR[pdx_track + 1, 1] == ti
-                                ):  # If PR at index pdx_track+1 is equal to ti
-                                    pdx = pdx_track + 1
-                                elif (
-                                    PR[pdx_track, 1] < ti < PR[pdx_track + 1, 1]
-                                ):  # If HR beat in question is betwen
-                                    # pdx_track and pdx_track+1
-                                    pdx = pdx_track
-
-                    if (
-                        not pdx
-                    ):  # If the previous PR and the one after do not match up...
-                        # (Missing Data/PR or HR removed/etc)
-                        if ti in PR[:, 1]:  # If exact HR time is in PR
-                            pdxs = [i for i, x in enumerate(PR[:, 1]) if x == ti]
-                            if len(pdxs) == 1:  # Only One Exact Match
-                                pdx = pdxs[0]
-                            else:
-                                print(idx)
-                                print(pdxs)
-                                # error = Time_Error
-                        else:  # Look between ti-3 and ti to find PR
-                            s_ti = ti - 3
-                            ixn = (PR[:, 1] > s_ti) * (PR[:, 1] < ti)
-                            pdxs = where(ixn)[0]
-                            if pdxs.size > 0:
-                                if (
-                                    len(pdxs) == 1
-                                ):  # Only One PR value in 3 second window
-                                    pdx = pdxs[0]
-                                else:
-                                    pdx = pdxs[
-                                        len(pdxs) - 1
-                                    ]  # Take value closest to HR time
-
-                    if pdx:  # Corresponding PR found
-                        pdx_track = pdx
-                        # print(pdx)
-                        if PR[pdx][2] == -1 or PR[pdx][2] == -2:
-                            aHR[idx] = HR[idx]
-                        else:
-                            aHR[idx] = [HR[idx][0], HR[idx][1], -3]
-
-                    else:  # No Corresponding PR
-                        aHR[idx] = HR[idx]
+            if (
+                PR.shape[0] > 0
+                and (diff(PR[:, 1]) > 0).all()
+                and (diff(HR[:, 1]) >= 0).all()
+            ):
+                aHR = _hr_a_sorted(HR, PR)
+            else:
+                aHR = _hr_a_loop(HR, PR)
 
         data["HR_A"] = aHR
 
@@ -243,7 +324,17 @@ def process_hr_a_data(data):
 def post_session_triage(pgsql_, aid, jobid, job):
 
     hid = job["hid"]
-    data = load_session_data(hid, pgsql_=pgsql_)
+    state = None
+    if job.get("incremental", False):
+        # only blocks converted since the last triage are loaded, the rest of
+        # the session comes from the triage state saved with the last run
+        data, state = load_session_data_incremental(
+            hid, file_class="triage_state", pgsql_=pgsql_
+        )
+        if not state["new_blocks"]:
+            return "no new blocks"
+    else:
+        data = load_session_data(hid, pgsql_=pgsql_)
     data = process_hr_a_data(data)
 
     # dedup alarms
@@ -279,26 +370,35 @@ def post_session_triage(pgsql_, aid, jobid, job):
 
     post_combo = "HR_SCI" in data.keys()
 
-    # alarms analysis
-    times, cr_data = patient_time_in_histograms(pgsql_, hid, data, post_combo)
-    patient_alarms(pgsql_, hid, data["__info__"].site, data, cr_data)
-    patient_numeric_histograms(pgsql_, hid, data)
-
-    session = {
-        "hid": hid,
-        "site": data["__info__"].site,
-        "sw_version": "0.0.0.0",
-        "duration": int(npround(times["WT"]["active"])),  # fixme ?
-    }
-    patient_update_session_data(pgsql_, session, times)
-
-    # other data triage
-    mine_device_alarms_packets(pgsql_, data)
-    mine_cnibp_bland_altman(pgsql_, data)
-    mine_cnibp_calibration_times(pgsql_, data)
-    mine_nibp(pgsql_, data)
-    mine_spo2_control_histogram(pgsql_, data)
-    mine_ppg_beat_class_histogram(pgsql_, data)
-    mine_ppg_pmi_histogram(pgsql_, data)
+    # rows are buffered per table and written when the session is done
+    with BatchWriter(pgsql_) as writer:
+        # alarms analysis
+        times, cr_data = patient_time_in_histograms(
+            pgsql_, hid, data, post_combo, writer
+        )
+        patient_alarms(pgsql_, hid, data["__info__"].site, data, cr_data, writer)
+        patient_numeric_histograms(pgsql_, hid, data, writer)
+
+        session = {
+            "hid": hid,
+            "site": data["__info__"].site,
+            "sw_version": "0.0.0.0",
+            "duration": int(npround(times["WT"]["active"])),  # fixme ?
+        }
+        patient_update_session_data(pgsql_, session, times)
+
+        # other data triage
+        mine_device_alarms_packets(pgsql_, data, writer)
+        mine_cnibp_bland_altman(pgsql_, data, writer)
+        mine_cnibp_calibration_times(pgsql_, data, writer)
+        mine_nibp(pgsql_, data, writer)
+        mine_spo2_control_histogram(pgsql_, data, writer)
+        mine_ppg_beat_class_histogram(pgsql_, data, writer)
+        mine_ppg_pmi_histogram(pgsql_, data, writer)
+    writer.log_stats()
+
+    # only now are the new blocks triaged
+    if state is not None:
+        save_session_state(state, pgsql_)
 
     return "done"
@@ -1,7 +1,10 @@
+import os
 import warnings
+import threading
 import boto3
 import psycopg2
 from time import sleep
+from botocore.config import Config
 from .. import resources as __resources__
 
 try:
@@ -84,6 +87,64 @@ def get_boto3_session(region_name="us-west-1"):
     return session
 
 
+# connections each cached client keeps open, enough for the thread pools that
+# load and upload block arrays concurrently
+MAX_POOL_CONNECTIONS = 64
+
+__boto3_lock__ = threading.Lock()
+__boto3_sessions__ = {}
+__boto3_clients__ = {}
+__boto3_local__ = threading.local()
+
+
+def _cached_boto3_session(region_name, profile):
+    # keyed by pid too, boto3 objects must not be shared with forked children
+    key = (os.getpid(), region_name, profile)
+    with __boto3_lock__:
+        if key not in __boto3_sessions__:
+            if profile is None:
+                __boto3_sessions__[key] = get_boto3_session(region_name)
+            else:
+                __boto3_sessions__[key] = boto3.session.Session(
+                    region_name=region_name, profile_name=profile
+                )
+        return __boto3_sessions__[key]
+
+
+def get_boto3_client(service="s3", region_name="us-west-1", profile=None):
+    """A client shared by the whole process, so its credentials are resolved
+    and its connection pool is warmed up once. Clients are thread safe.
+    profile is a profile in the AWS config, by default the access keys in
+    resources are used."""
+    key = (os.getpid(), service, region_name, profile)
+    client = __boto3_clients__.get(key)
+    if client is None:
+        session = _cached_boto3_session(region_name, profile)
+        with __boto3_lock__:
+            client = __boto3_clients__.get(key)
+            if client is None:
+                client = __boto3_clients__[key] = session.client(
+                    service, config=Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+                )
+    return client
+
+
+def get_boto3_resource(service="s3", region_name="us-west-1", profile=None):
+    """Like get_boto3_client, but resources are not thread safe, so each
+    thread gets a cached resource of its own."""
+    resources = getattr(__boto3_local__, "resources", None)
+    if resources is None:
+        resources = __boto3_local__.resources = {}
+    key = (os.getpid(), service, region_name, profile)
+    if key not in resources:
+        session = _cached_boto3_session(region_name, profile)
+        with __boto3_lock__:
+            resources[key] = session.resource(
+                service, config=Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+            )
+    return resources[key]
+
+
 def get_pgsql_dsn(profile="sciencedb2", style="A"):
     if style == "A":
         dsn = "postgres://{user}:{password}@{host}:{port}?dbname={database}"
@@ -1,4 +1,11 @@
 import gc
+import os
+import time
+import atexit
+import logging
+import socket
+import hashlib
+import threading
 import cloudpickle
 import traceback
 import getpass
@@ -9,6 +16,7 @@ from re import compile as re_compile
 from numpy import __name__ as np__name__, ndarray
 from .. import aws
 from psycopg2.extensions import QuotedString
+from psycopg2.extras import execute_values
 import json
 
 try:
@@ -94,6 +102,135 @@ def job_generator(
             yield aid, r[0]
 
 
+DEFAULT_LEASE = 600  # seconds a claimed job is held without a heartbeat
+MAX_LEASE_ATTEMPTS = 3  # claims of a job whose leases expired before it's an error
+
+
+def add_job_lease_columns(pgsql_):
+    """Adds the columns claim_jobs() needs to analysis_jobs, if missing."""
+    with pgsql_, pgsql_.cursor() as cursor:
+        cursor.execute(
+            """ALTER TABLE analysis_jobs
+                 ADD COLUMN IF NOT EXISTS lease_owner text,
+                 ADD COLUMN IF NOT EXISTS lease_expires timestamptz,
+                 ADD COLUMN IF NOT EXISTS lease_attempts int NOT NULL DEFAULT 0;
+               CREATE INDEX IF NOT EXISTS analysis_jobs_pending_idx
+                   ON analysis_jobs (aid)
+                WHERE NOT is_complete AND NOT is_error"""
+        )
+
+
+def claim_jobs(
+    pgsql_, aid, owner, n=1, lease=DEFAULT_LEASE, max_attempts=MAX_LEASE_ATTEMPTS
+):
+    """Claims up to n unfinished jobs of an analysis for `owner` and returns
+    their jobids. Jobs claimed by someone else are skipped until their lease
+    expires, so the jobs of a worker that died are claimed again. A job whose
+    lease expired after max_attempts claims, e.g. because it kills the engine
+    running it, is marked as an error instead."""
+    with pgsql_, pgsql_.cursor() as cursor:
+        cursor.execute(
+            f"""UPDATE analysis_jobs
+                   SET is_error = true,
+                       traceback = 'lease expired after '
+                                   || lease_attempts || ' claims, last by '
+                                   || lease_owner
+                 WHERE aid = {aid}
+                   AND NOT is_complete
+                   AND NOT is_error
+                   AND lease_expires < now()
+                   AND lease_attempts >= {int(max_attempts)}"""
+        )
+        cursor.execute(
+            f"""UPDATE analysis_jobs
+                   SET lease_owner = '{owner}',
+                       lease_expires = now() + interval '{int(lease)} seconds',
+                       lease_attempts = lease_attempts + 1
+                 WHERE jobid IN (SELECT jobid
+                                   FROM analysis_jobs
+                                  WHERE aid = {aid}
+                                    AND NOT is_complete
+                                    AND NOT is_error
+                                    AND (lease_expires IS NULL
+                                         OR lease_expires < now())
+                                  LIMIT {int(n)}
+                                    FOR UPDATE SKIP LOCKED)
+             RETURNING jobid"""
+        )
+        return [r[0] for r in cursor.fetchall()]
+
+
+def count_leased_jobs(pgsql_, aid):
+    """Number of unfinished jobs of an analysis held by a live lease."""
+    with pgsql_, pgsql_.cursor() as cursor:
+        cursor.execute(
+            f"""SELECT count(*)
+                  FROM analysis_jobs
+                 WHERE aid = {aid}
+                   AND NOT is_complete
+                   AND NOT is_error
+                   AND lease_expires >= now()"""
+        )
+        return cursor.fetchone()[0]
+
+
+def renew_job_leases(pgsql_, jobids, owner, lease=DEFAULT_LEASE):
+    """Extends the leases `owner` holds on jobids."""
+    with pgsql_, pgsql_.cursor() as cursor:
+        cursor.execute(
+            f"""UPDATE analysis_jobs
+                   SET lease_expires = now() + interval '{int(lease)} seconds'
+                 WHERE jobid IN ({','.join(str(j) for j in jobids)})
+                   AND lease_owner = '{owner}'"""
+        )
+
+
+class JobHeartbeat(object):
+    """Renews the leases on jobids every interval seconds (lease / 3 by
+    default) from a background thread, on a connection of its own, while the
+    block runs. on_beat, if given, is called with that connection after every
+    renewal."""
+
+    def __init__(
+        self,
+        pgsql_profile,
+        jobids,
+        owner,
+        lease=DEFAULT_LEASE,
+        interval=None,
+        on_beat=None,
+    ):
+        self.pgsql_profile = pgsql_profile
+        self.jobids = jobids
+        self.owner = owner
+        self.lease = lease
+        self.interval = lease / 3.0 if interval is None else interval
+        self.on_beat = on_beat
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        pgsql_ = None
+        try:
+            while not self.stopped.wait(self.interval):
+                if pgsql_ is None or pgsql_.closed:
+                    pgsql_ = aws.get_pgsql_connection(self.pgsql_profile)
+                renew_job_leases(pgsql_, self.jobids, self.owner, self.lease)
+                if self.on_beat is not None:
+                    self.on_beat(pgsql_)
+        finally:
+            if pgsql_ is not None:
+                pgsql_.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
 def make_job(pgsql_, aid, args):
     """ Adds single job to a given analysis.  Expects args to be json. """
     with pgsql_, pgsql_.cursor() as cursor:
@@ -236,9 +373,168 @@ def dumps(value):
     )
 
 
+class JobResults(object):
+    """Buffers job results to write them with one UPDATE ... FROM (VALUES ...)
+    once flush_jobs of them are buffered or flush_seconds have passed. Safe to
+    flush from another thread than the one adding results."""
+
+    def __init__(self, flush_jobs=100, flush_seconds=30.0):
+        self.flush_jobs = flush_jobs
+        self.flush_seconds = flush_seconds
+        self.rows = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def complete(self, aid, jobid, returns_str):
+        """What job_complete_from_string writes."""
+        with self.lock:
+            self.rows.append((aid, jobid, returns_str, True, False, ""))
+
+    def error(self, aid, jobid, returns):
+        """What job_handle_exception writes; call it while handling the
+        exception."""
+        row = (aid, jobid, json.dumps(returns), False, True, _handle_exception())
+        with self.lock:
+            self.rows.append(row)
+
+    def due(self):
+        return len(self.rows) >= self.flush_jobs or (
+            len(self.rows) > 0 and time.time() - self.last_flush >= self.flush_seconds
+        )
+
+    def flush(self, pgsql_):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if rows:
+            try:
+                self._write(pgsql_, rows)
+            except Exception:
+                # keep them, ahead of anything buffered meanwhile
+                with self.lock:
+                    self.rows[:0] = rows
+                raise
+        self.last_flush = time.time()
+
+    def _write(self, pgsql_, rows):
+        with pgsql_, pgsql_.cursor() as cursor:
+            execute_values(
+                cursor,
+                """UPDATE analysis_jobs AS j
+                      SET returns = v.returns::jsonb,
+                          is_complete = v.is_complete,
+                          is_error = v.is_error,
+                          traceback = v.traceback
+                     FROM (VALUES %s)
+                       AS v (aid, jobid, returns, is_complete, is_error, traceback)
+                    WHERE j.aid = v.aid
+                      AND j.jobid = v.jobid""",
+                rows,
+                page_size=len(rows),
+            )
+
+
+class WorkerContext(object):
+    """State an engine keeps across the jobs it runs: one database connection
+    per profile, reopened only once it has been closed, and the unpickled
+    globals and compiled code of the cluster_decorate setups."""
+
+    GC_EVERY = 100
+
+    def __init__(self):
+        self.connections = {}
+        self.unpickled = {}
+        self.compiled = {}
+        self.namespace = None
+        self.setup_key = None
+        self.jobs = 0
+        self.results = JobResults()
+        self.results_profile = None
+        # set while job_worker runs, the only place results may be buffered
+        self.batching = False
+        atexit.register(self.flush_results)
+
+    def connection(self, profile):
+        pgsql_ = self.connections.get(profile)
+        if pgsql_ is None or pgsql_.closed:
+            pgsql_ = self.connections[profile] = aws.get_pgsql_connection(profile)
+        return pgsql_
+
+    def release(self, pgsql_):
+        # drop anything a job left uncommitted, as closing the connection did
+        if not pgsql_.closed:
+            pgsql_.rollback()
+
+    def compile(self, code):
+        try:
+            return self.compiled[code]
+        except KeyError:
+            return self.compiled.setdefault(code, compile(code, "<cluster>", "exec"))
+
+    def setup(self, key, pickled, code, include_code, namespace, reuse=True):
+        """Put a cluster_decorate setup into `namespace`, unless the last job
+        already did. Without reuse the kwargs are unpickled afresh and the code
+        is run again every time; only its compilation is kept."""
+        if reuse and key == self.setup_key and namespace is self.namespace:
+            return
+        self.setup_key = None
+        if pickled:
+            if not reuse:
+                namespace.update({k: cloudpickle.loads(v) for k, v in pickled.items()})
+            else:
+                if key not in self.unpickled:
+                    self.unpickled[key] = {
+                        k: cloudpickle.loads(v) for k, v in pickled.items()
+                    }
+                namespace.update(self.unpickled[key])
+        if code is not None:
+            exec(self.compile(code), namespace)
+        if include_code is not None:
+            exec(self.compile(include_code), namespace)
+        if reuse:
+            self.setup_key, self.namespace = key, namespace
+
+    def flush_results(self, pgsql_=None):
+        """Writes the buffered job results, on pgsql_ if given (e.g. from the
+        JobHeartbeat thread). If that fails they stay buffered for the next
+        flush."""
+        if not self.results.rows:
+            return True
+        try:
+            if pgsql_ is None:
+                pgsql_ = self.connection(self.results_profile)
+            pgsql_.rollback()
+            self.results.flush(pgsql_)
+        except Exception:
+            logging.exception(f"writing {len(self.results.rows)} job results failed")
+            return False
+        return True
+
+    def job_done(self):
+        self.jobs += 1
+        if self.jobs % self.GC_EVERY == 0:
+            gc.collect()
+
+
+_worker_context = WorkerContext()
+
+
+def get_worker_context():
+    """The WorkerContext of this process. Jobs must get it through here: the
+    job wrappers are shipped to the engines by value, so a global they
+    referenced directly would be a fresh copy for every job."""
+    return _worker_context
+
+
 class cluster_decorate(object):
     def __init__(
-        self, pgsql_profile="pgbouncer", code=None, include=None, **kwargs
+        self,
+        pgsql_profile="pgbouncer",
+        code=None,
+        include=None,
+        reuse_connection=True,
+        batch_results=False,
+        reuse_setup=True,
+        **kwargs,
     ):
         """Initialize cluster_decorate object.
 
@@ -253,6 +549,24 @@ class cluster_decorate(object):
         include (optional): instance or iterable of string, pathlib.Path
             A filename or list of filenames of containing python code to be
             loaded and passed to exec(). Defaults to None
+        reuse_connection (optional): bool
+            Keep the engine's database connection open between jobs instead
+            of connecting for every job. Defaults to True.
+        batch_results (optional): bool
+            When run by job_worker, buffer the job results on the engine and
+            write them in batches (see JobResults) instead of one UPDATE per
+            job. Buffered results are written when a job fails, at least every
+            JobResults.flush_seconds from the heartbeat thread, and when
+            job_worker runs out of jobs. Jobs run any other way, e.g. mapped
+            over job_generator(), write their results one by one.
+            Defaults to False.
+        reuse_setup (optional): bool
+            Unpickle the kwargs and run `code`/`include` once per engine and
+            share them with every later job of this setup, instead of once per
+            job. Jobs must then treat the kwargs as read-only: a job that
+            mutates one (a dict, list or model object) changes it for the
+            jobs that follow. Set to False for jobs that modify them.
+            Defaults to True.
         **kwargs:
             All other keyword arguments will be packaged with cloudpickle and
             sent to the cluster where they will be unpickled.
@@ -268,6 +582,9 @@ class cluster_decorate(object):
             return code
 
         self.pgsql_profile = pgsql_profile
+        self.reuse_connection = reuse_connection
+        self.batch_results = batch_results
+        self.reuse_setup = reuse_setup
         self.code = code
         if self.code is not None:
             exec(self.code)
@@ -278,32 +595,112 @@ class cluster_decorate(object):
         elif isinstance(include, Iterable):
             self.include_code = "\n".join([load_code(fn) for fn in include])
 
+        # identifies the setup, so engines only redo it when it changes
+        sha = hashlib.sha1()
+        for k, v in sorted(self.pickled.items()):
+            sha.update(k.encode())
+            sha.update(v)
+        for c in (self.code, self.include_code):
+            sha.update(b"\0" if c is None else c.encode())
+        self.setup_key = sha.hexdigest()
+
     def __call__(self, func):
         def wrapper(arg):
             aid, jobid = arg
-            pgsql_ = aws.get_pgsql_connection(self.pgsql_profile)
+            worker = get_worker_context()
+            batch = self.batch_results and worker.batching
+            if self.reuse_connection:
+                pgsql_ = worker.connection(self.pgsql_profile)
+            else:
+                pgsql_ = aws.get_pgsql_connection(self.pgsql_profile)
             try:
                 job = get_job(pgsql_, aid, jobid)
-                if self.pickled:
-                    globals().update(
-                        {k: cloudpickle.loads(v) for k, v in self.pickled.items()}
-                    )
-                if self.code is not None:
-                    exec(self.code, globals())
-                if self.include_code is not None:
-                    exec(self.include_code, globals())
+                worker.setup(
+                    self.setup_key,
+                    self.pickled,
+                    self.code,
+                    self.include_code,
+                    globals(),
+                    self.reuse_setup,
+                )
                 return_str = dumps(func(pgsql_, aid, jobid, job))
             except:  # noqa E722
-                job_handle_exception(pgsql_, aid, jobid, None)
-            else:
-                try:
-                    job_complete_from_string(pgsql_, aid, jobid, return_str)
-                except:   # noqa E722
+                if batch:
+                    worker.results_profile = self.pgsql_profile
+                    worker.results.error(aid, jobid, None)
+                    worker.flush_results()
+                else:
                     job_handle_exception(pgsql_, aid, jobid, None)
+            else:
+                if batch:
+                    worker.results_profile = self.pgsql_profile
+                    worker.results.complete(aid, jobid, return_str)
+                else:
+                    try:
+                        job_complete_from_string(pgsql_, aid, jobid, return_str)
+                    except:  # noqa E722
+                        job_handle_exception(pgsql_, aid, jobid, None)
             finally:
                 # do any clean up here
-                pgsql_.close()
-                gc.collect()
+                if worker.results.due():
+                    worker.flush_results()
+                if self.reuse_connection:
+                    worker.release(pgsql_)
+                else:
+                    pgsql_.close()
+                worker.job_done()
             return True
 
         return wrapper
+
+
+def job_worker(
+    func,
+    aid,
+    batch_size=1,
+    lease=DEFAULT_LEASE,
+    pgsql_profile="pgbouncer",
+    poll=30,
+):
+    """Runs func, a cluster_decorate job, on the jobs of analysis aid,
+    claiming batch_size of them at a time, until there are none left.
+    Returns the number of jobs run.
+
+    Start one per engine, e.g. client[:].apply_async(job_worker, func, aid),
+    instead of mapping func over job_generator(): engines that finish early
+    take more work, and the jobs of engines that die are claimed again once
+    their lease expires. While other workers hold leases on unfinished jobs
+    this keeps checking every `poll` seconds, to take over the jobs of any
+    that die. Needs add_job_lease_columns() to have been run.
+
+    Results buffered by batch_results are written by the heartbeat at least
+    every JobResults.flush_seconds, well within the lease of their jobs."""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    worker = get_worker_context()
+    interval = min(lease / 3.0, worker.results.flush_seconds)
+    n = 0
+    worker.batching = True
+    try:
+        while True:
+            pgsql_ = worker.connection(pgsql_profile)
+            jobids = claim_jobs(pgsql_, aid, owner, batch_size, lease)
+            if not jobids:
+                worker.flush_results()
+                if count_leased_jobs(pgsql_, aid) == 0:
+                    return n
+                time.sleep(poll)
+                continue
+            with JobHeartbeat(
+                pgsql_profile,
+                jobids,
+                owner,
+                lease,
+                interval=interval,
+                on_beat=worker.flush_results,
+            ):
+                for jobid in jobids:
+                    func((aid, jobid))
+                    n += 1
+    finally:
+        worker.batching = False
+        worker.flush_results()
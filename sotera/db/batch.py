@@ -0,0 +1,113 @@
+"""Batched inserts.
+
+A BatchWriter buffers rows per table and writes them with one
+COPY ... FROM STDIN per table instead of one INSERT per row. Rows whose
+values rely on the casts of SQL literals (e.g. floats into integer
+columns) are added with copy=False and written with execute_values.
+"""
+import io
+import time
+import logging
+import contextlib
+import numpy as np
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_ROWS = 50000
+
+
+def _copy_value(v):
+    """A value in the COPY text format."""
+    if v is None:
+        return "\\N"
+    if isinstance(v, str):
+        return (
+            v.replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+    return str(v)
+
+
+def _plain(v):
+    return v.item() if isinstance(v, np.generic) else v
+
+
+class BatchWriter:
+    """Buffers rows per (table, columns) and writes them when flushed, or as
+    soon as a table has `flush_rows` rows buffered.
+
+    Used as a context manager the buffered rows are written on a clean exit
+    and dropped if an exception is raised. `stats` has the rows written and
+    the seconds spent writing them per table.
+    """
+
+    def __init__(self, pgsql_, flush_rows=DEFAULT_FLUSH_ROWS):
+        self.pgsql_ = pgsql_
+        self.flush_rows = flush_rows
+        self.stats = {}
+        self._rows = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._rows.clear()
+
+    def add(self, table, columns, row, copy=True):
+        self.add_rows(table, columns, (row,), copy)
+
+    def add_rows(self, table, columns, rows, copy=True):
+        key = (table, tuple(columns), copy)
+        buffered = self._rows.setdefault(key, [])
+        buffered.extend(tuple(_plain(v) for v in row) for row in rows)
+        if len(buffered) >= self.flush_rows:
+            self._flush(key)
+
+    def flush(self):
+        for key in list(self._rows.keys()):
+            self._flush(key)
+
+    def _flush(self, key):
+        rows = self._rows.pop(key, None)
+        if not rows:
+            return
+        table, columns, copy = key
+        t0 = time.time()
+        with self.pgsql_, self.pgsql_.cursor() as cursor:
+            if copy:
+                buf = io.StringIO(
+                    "".join("\t".join(map(_copy_value, row)) + "\n" for row in rows)
+                )
+                cursor.copy_expert(
+                    f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf
+                )
+            else:
+                execute_values(
+                    cursor,
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+                    rows,
+                    page_size=1000,
+                )
+        stats = self.stats.setdefault(table, {"rows": 0, "seconds": 0.0})
+        stats["rows"] += len(rows)
+        stats["seconds"] += time.time() - t0
+
+    def log_stats(self):
+        for table, stats in sorted(self.stats.items()):
+            logger.info(f"{table}: {stats['rows']} rows in {stats['seconds']:.3f} s")
+
+
+@contextlib.contextmanager
+def batch_writer(pgsql_, writer=None):
+    """`writer`, or a new BatchWriter that is flushed on exit."""
+    if writer is not None:
+        yield writer
+    else:
+        with BatchWriter(pgsql_) as writer:
+            yield writer
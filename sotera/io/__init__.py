@@ -1,5 +1,6 @@
 import warnings
 import platform
+from .codecs import codec_extension
 
 is_not_jython = platform.system() != "Java"
 
@@ -113,24 +114,43 @@ def find_tier(fn):
         return "tier2"
 
 
-def array_file(arr):
-    return "{}.npy.xz".format(arr)
+def array_file(arr, codec=None):
+    return "{}{}".format(arr, codec_extension(codec))
 
 
-def array_key(hid, blockno, arr):
-    fn = array_file(arr)
+def frames_file(arr):
+    return "{}.frames".format(arr)
+
+
+def block_array_file(meta, arr):
+    """File name of array `arr` in a block with metadata `meta`."""
+    if "frames" in meta["ARRAYS"].get(arr, {}):
+        return frames_file(arr)
+    return array_file(arr, meta.get("CODEC"))
+
+
+def array_key(hid, blockno, arr, codec=None):
+    fn = array_file(arr, codec)
+    return make_key(hid, blockno, fn, find_tier(fn))
+
+
+def block_array_key(hid, blockno, meta, arr):
+    fn = block_array_file(meta, arr)
     return make_key(hid, blockno, fn, find_tier(fn))
 
 
 if is_not_jython:
     from . import local
+    from .lazy import Block, Session, open_block
 try:
     from . import munge
 except:
     warnings.warn("munge submodule not available")
 try:
     from . import cloud
-    from .cloud import download_session_data, load_session_data
+    from .cloud import download_session_data, load_session_data, open_session_data
+    from .cloud import iter_session_blocks, load_session_data_incremental
+    from .cloud import save_session_state
 except ImportError:
     warnings.warn("Will not be able to load data from cloud")
 try:
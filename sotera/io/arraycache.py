@@ -0,0 +1,71 @@
+"""Process wide cache of loaded block arrays.
+
+Entries hold arrays exactly as the block loaders return them (inflated and
+with timestamps), so a hit skips decompression and all post-processing. The
+cache is bounded by the total bytes of the arrays and evicts the least
+recently used entries. Cached arrays are read-only and handed out as views,
+so callers cannot corrupt them.
+
+The size is set by memory_mb in the [cache] section of ~/.higgins; 0
+disables the cache.
+"""
+import threading
+from collections import OrderedDict
+from sotera import resources
+
+try:
+    MAX_BYTES = int(float(resources["cache"]["memory_mb"]) * 2 ** 20)
+except:  # noqa E722
+    MAX_BYTES = 1024 * 2 ** 20
+
+
+class ArrayCache:
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """A dict of read-only array views and the entry's extra value, or
+        None when `key` is not cached."""
+        with self._lock:
+            try:
+                arrays, extra, nbytes = self._entries[key]
+            except KeyError:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        return {k: v.view() for k, v in arrays.items()}, extra
+
+    def put(self, key, arrays, extra=None):
+        """Cache `arrays` (a dict of arrays) under `key`. The arrays are made
+        read-only, callers should use the returned views from now on."""
+        for arr in arrays.values():
+            arr.setflags(write=False)
+        nbytes = sum(arr.nbytes for arr in arrays.values())
+        if nbytes > self.max_bytes:
+            return {k: v.view() for k, v in arrays.items()}
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[2]
+            self._entries[key] = (dict(arrays), extra, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.stats["evictions"] += 1
+        return {k: v.view() for k, v in arrays.items()}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+array_cache = ArrayCache()
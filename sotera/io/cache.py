@@ -0,0 +1,223 @@
+"""Local disk cache for objects downloaded from S3.
+
+Entries are keyed by bucket, key and ETag. A cached object is revalidated
+with a conditional GET (If-None-Match), so a hit costs one round trip and no
+transfer. The cache is capped in size and evicts the least recently used
+entries. Files are written atomically and eviction is serialized with a lock
+file, so the engines of an instance can share one cache directory.
+
+Configured in the [cache] section of ~/.higgins with dir, size_gb and enabled.
+"""
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from sotera import resources
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+
+    class ClientError(Exception):
+        pass
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    CACHE_DIR = os.path.expanduser(resources["cache"]["dir"])
+except:  # noqa E722
+    CACHE_DIR = os.path.expanduser("~/.cache/sotera/s3")
+
+try:
+    CACHE_SIZE = int(float(resources["cache"]["size_gb"]) * 2 ** 30)
+except:  # noqa E722
+    CACHE_SIZE = 10 * 2 ** 30
+
+try:
+    CACHE_ENABLED = resources["cache"]["enabled"].lower() == "true"
+except:  # noqa E722
+    CACHE_ENABLED = True
+
+stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes_downloaded": 0}
+_lock = threading.Lock()
+_added = [CACHE_SIZE]  # bytes stored since the last size check, check first
+
+
+def cache_stats():
+    with _lock:
+        return dict(stats)
+
+
+def _count(name, n=1):
+    with _lock:
+        stats[name] += n
+
+
+def _entry_dir(bucket, key):
+    digest = hashlib.sha1(f"{bucket}/{key}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, digest[:2], digest)
+
+
+def _etag_name(etag):
+    return etag.strip('"').replace("/", "_")
+
+
+def _cached_etag(entry):
+    """The newest ETag cached for an entry, or None."""
+    try:
+        names = [n for n in os.listdir(entry) if not n.startswith(".")]
+    except FileNotFoundError:
+        return None
+    if not names:
+        return None
+    return max(names, key=lambda n: _mtime(os.path.join(entry, n)))
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def _read_entry(entry, etag):
+    path = os.path.join(entry, etag)
+    with open(path, "rb") as fp:
+        body = fp.read()
+    os.utime(path)  # most recently used
+    return body
+
+
+def _store(entry, etag, write):
+    """Atomically add an entry; write(fp) writes the object to the file."""
+    os.makedirs(entry, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=entry, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            write(fp)
+            size = fp.tell()
+        os.replace(tmp, os.path.join(entry, etag))
+    except:  # noqa E722
+        os.remove(tmp)
+        raise
+    for name in os.listdir(entry):
+        if name != etag and not name.startswith("."):
+            # superseded version of the object
+            try:
+                os.remove(os.path.join(entry, name))
+            except FileNotFoundError:
+                pass
+    with _lock:
+        _added[0] += size
+        check = _added[0] >= CACHE_SIZE // 20
+        if check:
+            _added[0] = 0
+    if check:
+        evict()
+
+
+def evict(max_size=None):
+    """Remove least recently used entries until the cache is under 90% of
+    `max_size` (CACHE_SIZE by default)."""
+    max_size = CACHE_SIZE if max_size is None else max_size
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, ".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        files = []
+        for dirpath, _, names in os.walk(CACHE_DIR):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith(".tmp") and st.st_mtime < time.time() - 3600:
+                    # left behind by a crashed writer
+                    os.remove(path)
+                elif not name.startswith("."):
+                    files.append((st.st_mtime, st.st_size, path))
+        total = sum(f[1] for f in files)
+        if total <= max_size:
+            return
+        for mtime, size, path in sorted(files):
+            if total <= 0.9 * max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            _count("evictions")
+        logger.info(f"Evicted S3 cache entries down to {total} bytes")
+
+
+def _not_modified(e):
+    return e.response.get("Error", {}).get("Code") in ("304", "NotModified")
+
+
+def cached_get(client, bucket, key):
+    """The body of bucket/key, from the cache while its ETag is current."""
+    if not CACHE_ENABLED:
+        return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    entry = _entry_dir(bucket, key)
+    etag = _cached_etag(entry)
+    if etag is not None:
+        try:
+            obj = client.get_object(Bucket=bucket, Key=key, IfNoneMatch=f'"{etag}"')
+        except ClientError as e:
+            if not _not_modified(e):
+                raise
+            try:
+                body = _read_entry(entry, etag)
+            except FileNotFoundError:
+                # evicted by another engine in the meantime
+                obj = client.get_object(Bucket=bucket, Key=key)
+            else:
+                _count("hits")
+                return body
+    else:
+        obj = client.get_object(Bucket=bucket, Key=key)
+    body = obj["Body"].read()
+    _count("misses")
+    _count("bytes_downloaded", len(body))
+    _store(entry, _etag_name(obj["ETag"]), lambda fp: fp.write(body))
+    return body
+
+
+def cached_download(client, bucket, key, filename):
+    """Download bucket/key to filename, through the cache."""
+    if not CACHE_ENABLED:
+        client.download_file(Bucket=bucket, Key=key, Filename=filename)
+        return
+    entry = _entry_dir(bucket, key)
+    etag = _etag_name(client.head_object(Bucket=bucket, Key=key)["ETag"])
+    if _cached_etag(entry) == etag:
+        try:
+            shutil.copyfile(os.path.join(entry, etag), filename)
+        except FileNotFoundError:
+            pass
+        else:
+            os.utime(os.path.join(entry, etag))
+            _count("hits")
+            return
+    # pin the download to the version whose ETag we are caching it under
+    obj = client.get_object(Bucket=bucket, Key=key, IfMatch=f'"{etag}"')
+    with open(filename, "wb") as fp:
+        shutil.copyfileobj(obj["Body"], fp, 2 ** 20)
+    _count("misses")
+    _count("bytes_downloaded", os.path.getsize(filename))
+
+    def write(fp):
+        with open(filename, "rb") as src:
+            shutil.copyfileobj(src, fp)
+
+    _store(entry, etag, write)
@@ -7,12 +7,10 @@ import warnings
 import os
 import json
 import tempfile
+import hashlib
 import io
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    import lzma
-except ImportError:
-    from backports import lzma
 try:
     import scipy.io
 except ImportError:
@@ -26,11 +24,17 @@ import base64
 from sotera import db
 from . import WAVEFORMS
 
-from . import local, arrays_to_get, array_key, array_file
+from . import cache
+from .arraycache import array_cache
+from . import local, arrays_to_get, array_key, block_array_file, block_array_key
+from .codecs import DEFAULT_CODEC, codec_from_filename, decode_array
+from .timesync import TimeIndex
+from .frames import read_frames, sn_window
+from .lazy import Block, Session
 import gzip
 
 try:
-    from sotera.aws import get_boto3_session
+    from sotera.aws import get_boto3_client, get_boto3_resource
     from sotera.db.utils import file_info_add_key, file_info_move_key
 except ImportError:
     pass
@@ -51,26 +55,43 @@ def get_blocks(hid, pgsql_=None):
     return blks
 
 
+def _s3_get(s3resource, bucket, key, byte_range=None):
+    # the resource's low level client is thread safe, the resource is not
+    client = s3resource.meta.client
+    if byte_range is None:
+        return cache.cached_get(client, bucket, key)
+    return client.get_object(Bucket=bucket, Key=key, Range=byte_range)["Body"].read()
+
+
 def cloud_load_json(s3resource, bucket, key):
     logging.info("Loading json {}:{}".format(bucket, key))
-    obj = s3resource.Object(bucket_name=bucket, key=key)
-    with io.BytesIO(obj.get()["Body"].read()) as buffer1:
+    with io.BytesIO(_s3_get(s3resource, bucket, key)) as buffer1:
         data = json.load(buffer1)
     return data
 
 
-def cloud_load_array(s3resource, bucket, key):
+def cloud_load_array(s3resource, bucket, key, codec=None):
     logging.info("Loading array {}:{}".format(bucket, key))
-    obj = s3resource.Object(bucket_name=bucket, key=key)
-    with io.BytesIO(obj.get()["Body"].read()) as buffer1:
-        with io.BytesIO(lzma.LZMAFile(buffer1, "rb").read()) as buffer2:
-            data = np.load(buffer2)
+    if codec is None:
+        codec = codec_from_filename(key) or DEFAULT_CODEC
+    data = decode_array(_s3_get(s3resource, bucket, key), codec)
     return data
 
 
+def cloud_range_reader(s3resource, bucket, key):
+    """read(offset, length) of an S3 object using ranged GETs."""
+
+    def read(offset, length):
+        logging.info(f"Loading {bucket}:{key} bytes {offset}+{length}")
+        byte_range = f"bytes={offset}-{offset + length - 1}"
+        return _s3_get(s3resource, bucket, key, byte_range)
+
+    return read
+
+
 def cloud_numpy_load(bucket, key, s3resource=None):
     if s3resource is None:
-        s3resource = get_boto3_session().resource("s3")
+        s3resource = get_boto3_resource("s3")
     obj = s3resource.Object(bucket_name=bucket, key=key)
     with io.BytesIO(obj.get()["Body"].read()) as buffer:
         tmp = np.load(buffer)
@@ -109,8 +130,7 @@ def download_session_data_v0(
 def download_session_data_v1(
     hid, blockno, dst=None, variable_names=None, exclude_variables=None, pgsql_=None
 ):
-    boto3_ = get_boto3_session()
-    client = boto3_.client("s3")
+    client = get_boto3_client("s3")
 
     bucket_name, key_name = db.db_api.get_key_by_hid(hid, "metadata", blockno, pgsql_)
     if dst is None:
@@ -122,7 +142,7 @@ def download_session_data_v1(
         os.mkdir(dst)
     filelist = []
     metafn = os.path.join(dst, "meta.json")
-    download_file(bucket_name, key_name, metafn, client=client)
+    download_file(bucket_name, key_name, metafn, client=client, use_cache=True)
     filelist.append(metafn)
     with open(metafn) as fp:
         meta = json.load(fp)
@@ -132,8 +152,9 @@ def download_session_data_v1(
         if exclude_variables is not None:
             variable_names = list(set(variable_names) - set(exclude_variables))
         for arr in arrays_to_get(variable_names, meta["ARRAYS"].keys()):
-            fn = os.path.join(dst, array_file(arr))
-            download_file(bucket_name, array_key(hid, blockno, arr), fn, client=client)
+            fn = os.path.join(dst, block_array_file(meta, arr))
+            key_name = block_array_key(hid, blockno, meta, arr)
+            download_file(bucket_name, key_name, fn, client=client, use_cache=True)
             filelist.append(fn)
     return filelist
 
@@ -176,15 +197,45 @@ def load_session_data_v0(
     return data
 
 
-def cloud_load_block_data_v1(
-    hid, block, resource, pgsql_, variable_names=None, exclude_variables=None
-):
+def _cloud_load_block_array(resource, bucket, hid, block, meta, arr, window):
+    if "frames" in meta.get("ARRAYS", {}).get(arr, {}):
+        key = block_array_key(hid, block, meta, arr)
+        read = cloud_range_reader(resource, bucket, key)
+        return read_frames(read, meta["ARRAYS"][arr]["frames"], *window)
+    codec = meta.get("CODEC")
+    return cloud_load_array(resource, bucket, array_key(hid, block, arr, codec), codec)
+
 
+def _block_outputs(meta, arr):
+    """Names of the arrays a loaded block array is inflated into."""
+    if arr in ("ECG", "PPG"):
+        return [arr] + list(meta["ARRAYS"][arr]["columns"])
+    return [arr]
+
+
+def _cloud_load_block(
+    hid,
+    block,
+    resource,
+    bucket,
+    key,
+    block_arrays,
+    variable_names,
+    exclude_variables,
+    window,
+    executor,
+    use_cache=True,
+    meta=None,
+):
+    """Load a block whose keys were looked up in the database. The arrays are
+    fetched and decompressed concurrently by `executor`. Whole arrays are
+    kept in the process wide array cache and returned read-only. Pass the
+    block metadata as `meta` if it was loaded already."""
     logging.info("Loading HID{}: BLOCK{}".format(hid, block))
     data = {}
-    bucket, key = db.db_api.get_key_by_hid(hid, "metadata", block, pgsql_)
-    block_arrays = db.db_api.get_block_arrays(hid, block, pgsql_)
-    data["__meta__"] = cloud_load_json(resource, bucket, key)
+    if meta is None:
+        meta = cloud_load_json(resource, bucket, key)
+    data["__meta__"] = meta
 
     if (
         block_arrays is None
@@ -198,23 +249,93 @@ def cloud_load_block_data_v1(
             variable_names = block_arrays
         if exclude_variables is not None:
             variable_names = list(set(variable_names) - set(exclude_variables))
-        for arr in arrays_to_get(variable_names, block_arrays):
-            tmp = cloud_load_array(resource, bucket, array_key(hid, block, arr))
+        arrays = sorted(
+            arrays_to_get(variable_names, block_arrays), key=lambda a: a != "TIME_SYNC"
+        )
+        meta = data["__meta__"]
+        # windowed loads are partial, only whole arrays are cached
+        use_cache = use_cache and window == (None, None, None, None)
+        cached = {}
+        if use_cache:
+            digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()
+            codec = meta.get("CODEC", DEFAULT_CODEC)
+            for arr in arrays:
+                entry = array_cache.get((hid, block, arr, codec, digest))
+                if entry is not None:
+                    cached[arr] = entry
+        fresh = {}
+        sn0, sn1, t0, t1 = window
+        if t0 is not None or t1 is not None:
+            # TIME_SYNC first, it maps t0/t1 to sequence numbers
+            if "TIME_SYNC" in arrays:
+                fresh["TIME_SYNC"] = _cloud_load_block_array(
+                    resource, bucket, hid, block, meta, "TIME_SYNC", None
+                )
+            sn0, sn1 = sn_window(fresh.get("TIME_SYNC"), sn0, sn1, t0, t1)
+        futures = {
+            arr: executor.submit(
+                _cloud_load_block_array,
+                resource,
+                bucket,
+                hid,
+                block,
+                meta,
+                arr,
+                (sn0, sn1),
+            )
+            for arr in arrays
+            if arr not in fresh.keys() and arr not in cached.keys()
+        }
+        for arr in arrays:
+            if arr in futures.keys():
+                fresh[arr] = futures.pop(arr).result()
+
+        block_data = {"__meta__": meta}
+        spans = {}
+        for arr, tmp in fresh.items():
             if tmp.shape[0] > 0:
                 if local.do_inflate(arr, tmp):
-                    data[arr] = local.inflate_array(tmp)
+                    block_data[arr] = local.inflate_array(tmp)
                 else:
-                    data[arr] = tmp
+                    block_data[arr] = tmp
+                if arr != "TIME_SYNC" and block_data[arr].shape[1] > 1:
+                    spans[arr] = local.array_span(block_data[arr])
+        if "TIME_SYNC" in cached.keys() and len(block_data) > 1:
+            # time syncs for the timestamps of the fresh arrays
+            block_data["TIME_SYNC"] = cached["TIME_SYNC"][0]["TIME_SYNC"]
+
+        if "TIME_SYNC" in block_data.keys():
+            block_data = local.derive_timestamps(block_data)
+            TS = block_data["TIME_SYNC"]
+            if TS.shape[0] > 0 and TS.shape[1] < 4:
+                block_data["TIME_SYNC"] = np.c_[TS, np.zeros((TS.shape[0],))]
+
+        block_data = local.inflate_ppg_arrays(block_data)
+        block_data = local.inflate_ecg_arrays(block_data)
+
+        outputs = {arr: entry[0] for arr, entry in cached.items()}
+        for arr in fresh.keys():
+            outputs[arr] = {
+                k: block_data[k] for k in _block_outputs(meta, arr) if k in block_data
+            }
+            if use_cache:
+                outputs[arr] = array_cache.put(
+                    (hid, block, arr, codec, digest), outputs[arr], spans.get(arr)
+                )
+        for arr, entry in cached.items():
+            if entry[1] is not None:
+                spans[arr] = entry[1]
 
+        for arr in arrays:
+            if arr in outputs[arr].keys():
+                data[arr] = outputs[arr][arr]
         if "TIME_SYNC" in data.keys():
-            data = local.derive_timestamps(data)
-            if data["TIME_SYNC"].shape[0] > 0 and data["TIME_SYNC"].shape[1] < 4:
-                data["TIME_SYNC"] = np.c_[
-                    data["TIME_SYNC"], np.zeros((data["TIME_SYNC"].shape[0],))
-                ]
-
-        data = local.inflate_ppg_arrays(data)
-        data = local.inflate_ecg_arrays(data)
+            index = TimeIndex.from_spans(data["TIME_SYNC"], spans.values())
+            data["T0"] = index.t0
+            data["T1"] = index.t1
+        for arr in ("PPG", "ECG"):
+            if arr in outputs.keys():
+                data.update((k, v) for k, v in outputs[arr].items() if k != arr)
 
     for k in ("HIGGINS", "PWD_VERSION", "FILE_START_TIME", "DEVICES"):
         data[k] = data["__meta__"][k]
@@ -223,38 +344,192 @@ def cloud_load_block_data_v1(
     return data
 
 
+def cloud_load_block_data_v1(
+    hid,
+    block,
+    resource,
+    pgsql_,
+    variable_names=None,
+    exclude_variables=None,
+    sn0=None,
+    sn1=None,
+    t0=None,
+    t1=None,
+    max_concurrency=16,
+    use_cache=True,
+):
+    """Load a block from S3, fetching up to `max_concurrency` arrays at once.
+    Framed waveforms are limited to the window given by sn0/sn1 and/or
+    t0/t1, fetching only the frames it overlaps."""
+    bucket, key = db.db_api.get_key_by_hid(hid, "metadata", block, pgsql_)
+    block_arrays = db.db_api.get_block_arrays(hid, block, pgsql_)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return _cloud_load_block(
+            hid,
+            block,
+            resource,
+            bucket,
+            key,
+            block_arrays,
+            variable_names,
+            exclude_variables,
+            (sn0, sn1, t0, t1),
+            executor,
+            use_cache,
+        )
+
+
+def cloud_load_blocks_data_v1(
+    hid,
+    blocks,
+    resource,
+    pgsql_,
+    variable_names=None,
+    exclude_variables=None,
+    max_concurrency=16,
+    max_blocks=4,
+):
+    """Yield the data of `blocks` in order, loading up to `max_blocks` blocks
+    ahead of the one being consumed and `max_concurrency` arrays at once."""
+    # database lookups stay on this thread, the connection is shared
+    lookups = [
+        (
+            b,
+            db.db_api.get_key_by_hid(hid, "metadata", b, pgsql_),
+            db.db_api.get_block_arrays(hid, b, pgsql_),
+        )
+        for b in blocks
+    ]
+    futures = collections.deque()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        with ThreadPoolExecutor(max_workers=max_blocks) as block_executor:
+            try:
+                for b, (bucket, key), block_arrays in lookups:
+                    futures.append(
+                        block_executor.submit(
+                            _cloud_load_block,
+                            hid,
+                            b,
+                            resource,
+                            bucket,
+                            key,
+                            block_arrays,
+                            variable_names,
+                            exclude_variables,
+                            (None, None, None, None),
+                            executor,
+                        )
+                    )
+                    if len(futures) > max_blocks:
+                        yield futures.popleft().result()
+                while futures:
+                    yield futures.popleft().result()
+            finally:
+                # consumer stopped early, don't load the remaining blocks
+                for future in futures:
+                    future.cancel()
+
+
+def iter_session_blocks(
+    hid,
+    arrays=None,
+    blocks=None,
+    exclude_variables=None,
+    pgsql_=None,
+    resource=None,
+    max_concurrency=16,
+    prefetch=2,
+):
+    """Yield the data of the blocks of a session one at a time and in order,
+    loading the next `prefetch` blocks in the background. `arrays` and
+    `blocks` default to all arrays and blocks. Only v1 sessions have blocks."""
+    hid = int(hid)
+    if hid < 200000:
+        raise ValueError("Only v1 sessions (hid >= 200000) have blocks")
+    if resource is None:
+        resource = get_boto3_resource("s3")
+    all_blocks = get_blocks(hid, pgsql_)
+    if blocks is None:
+        blocks = all_blocks
+    else:
+        blocks = [int(b) for b in blocks if int(b) in all_blocks]
+    return cloud_load_blocks_data_v1(
+        hid,
+        blocks,
+        resource,
+        pgsql_,
+        variable_names=arrays,
+        exclude_variables=exclude_variables,
+        max_concurrency=max_concurrency,
+        max_blocks=max(prefetch, 1),
+    )
+
+
+def cloud_open_block(hid, block, resource, pgsql_, max_concurrency=16):
+    """Lazy version of cloud_load_block_data_v1. Only the metadata is loaded
+    here, each array is loaded from S3 when it is first accessed."""
+    bucket, key = db.db_api.get_key_by_hid(hid, "metadata", block, pgsql_)
+    block_arrays = db.db_api.get_block_arrays(hid, block, pgsql_)
+    meta = cloud_load_json(resource, bucket, key)
+
+    def load(names):
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return _cloud_load_block(
+                hid,
+                block,
+                resource,
+                bucket,
+                key,
+                block_arrays,
+                names,
+                None,
+                (None, None, None, None),
+                executor,
+                meta=meta,
+            )
+
+    return Block(meta, load, block_arrays)
+
+
 def load_session_data_v1(
-    hid, block=None, variable_names=None, resource=None, pgsql_=None
+    hid,
+    block=None,
+    variable_names=None,
+    resource=None,
+    pgsql_=None,
+    max_concurrency=16,
+    max_blocks=4,
 ):
     all_blocks = get_blocks(hid, pgsql_)
     data = {}
     if isinstance(block, six.integer_types) and block in all_blocks:
         data = cloud_load_block_data_v1(
-            hid, block, resource, pgsql_, variable_names=variable_names
+            hid,
+            block,
+            resource,
+            pgsql_,
+            variable_names=variable_names,
+            max_concurrency=max_concurrency,
         )
-    elif isinstance(block, collections.abc.Iterable):
-        for b in block:
-            if isinstance(b, six.integer_types) and b in all_blocks:
-                block_data = cloud_load_block_data_v1(
-                    hid,
-                    b,
-                    resource,
-                    pgsql_,
-                    exclude_variables=WAVEFORMS,
-                    variable_names=variable_names,
-                )
-                data = local.merge_blocks(data, block_data)
-    elif block is None:
-        for b in all_blocks:
-            block_data = cloud_load_block_data_v1(
+    elif isinstance(block, collections.abc.Iterable) or block is None:
+        if block is None:
+            blocks = all_blocks
+        else:
+            blocks = [
+                b for b in block if isinstance(b, six.integer_types) and b in all_blocks
+            ]
+        data = local.merge_all_blocks(
+            cloud_load_blocks_data_v1(
                 hid,
-                b,
+                blocks,
                 resource,
                 pgsql_,
                 exclude_variables=WAVEFORMS,
                 variable_names=variable_names,
+                max_concurrency=max_concurrency,
+                max_blocks=max_blocks,
             )
-            data = local.merge_blocks(data, block_data)
+        )
     else:
         raise ValueError(
             "Requested block number(s) {} could not be resolved".format(block)
@@ -268,6 +543,7 @@ def load_session_data(
     variable_names=None,
     verify_compressed_data_integrity=False,
     pgsql_=None,
+    max_concurrency=16,
 ):
 
     try:
@@ -292,13 +568,14 @@ def load_session_data(
             pgsql_=pgsql_,
         )
     else:
-        s3resource = get_boto3_session().resource("s3")
+        s3resource = get_boto3_resource("s3")
         data = load_session_data_v1(
             hid,
             block=blockno,
             variable_names=variable_names,
             resource=s3resource,
             pgsql_=pgsql_,
+            max_concurrency=max_concurrency,
         )
 
     if pgsql_ is not None:
@@ -307,6 +584,122 @@ def load_session_data(
     return data
 
 
+def session_state_key(hid, file_class):
+    return "tier2/{}/{}.npz".format(hid, file_class)
+
+
+def load_session_data_incremental(
+    hid, file_class="session_state", pgsql_=None, max_concurrency=16
+):
+    """Like load_session_data for a v1 session, but the merged non-waveform
+    arrays of the blocks seen before are kept in S3 as an npz indexed in
+    file_info under `file_class`, so only blocks added since are loaded.
+    Returns the data and the new state; the state is only written by
+    save_session_state, once the data has been processed. state["new_blocks"]
+    are the block numbers that were loaded.
+
+    If a block appears before the last block that was merged the state can't
+    be appended to, and the whole session is loaded again."""
+    hid = int(hid)
+    if hid < 200000:
+        raise ValueError("Only v1 sessions (hid >= 200000) have blocks")
+    s3resource = get_boto3_resource("s3")
+    all_blocks = get_blocks(hid, pgsql_)
+
+    bucket, key = db.db_api.get_key_by_hid(hid, file_class, None, pgsql_)
+    arrays = {} if key is None else cloud_numpy_load(bucket, key, s3resource)
+    done = set(int(b) for b in arrays.pop("__blocks__", ()))
+    blocks = [b for b in all_blocks if b not in done]
+    if done and blocks and min(blocks) < max(done):
+        logging.info(f"{hid}: blocks added out of order, reloading the session")
+        arrays, done, blocks = {}, set(), all_blocks
+
+    data = local.merge_all_blocks(
+        [arrays]
+        + [
+            b
+            for b in cloud_load_blocks_data_v1(
+                hid,
+                blocks,
+                s3resource,
+                pgsql_,
+                exclude_variables=WAVEFORMS,
+                max_concurrency=max_concurrency,
+            )
+            if "TIME_SYNC" in b.keys()
+        ],
+        check=False,
+    )
+
+    if key is None and blocks:
+        bucket, _ = db.db_api.get_key_by_hid(hid, "metadata", blocks[0], pgsql_)
+        key = session_state_key(hid, file_class)
+    state = {
+        "hid": hid,
+        "file_class": file_class,
+        "bucket": bucket,
+        "key": key,
+        "new_blocks": blocks,
+        "blocks": sorted(done.union(blocks)),
+        "arrays": {k: v for k, v in data.items() if isinstance(v, np.ndarray)},
+    }
+
+    if pgsql_ is not None:
+        data["__info__"] = get_session_info(pgsql_, hid)
+
+    return data, state
+
+
+def save_session_state(state, pgsql_=None):
+    """Write a state returned by load_session_data_incremental, so the next
+    call only loads the blocks added after it."""
+    if not state["new_blocks"]:
+        return
+    arrays = dict(state["arrays"])
+    arrays["__blocks__"] = np.array(state["blocks"], dtype=np.int32)
+    fn = tempfile.mktemp(suffix=".npz")
+    try:
+        np.savez_compressed(fn, **arrays)
+        upload_indexed_file(
+            fn,
+            state["bucket"],
+            state["key"],
+            state["hid"],
+            file_class=state["file_class"],
+            pgsql_=pgsql_,
+        )
+    finally:
+        os.remove(fn)
+
+
+def open_session_data(hid, blockno=None, pgsql_=None, max_concurrency=16):
+    """Lazy version of load_session_data: a Block for a single block number,
+    otherwise a Session over the blocks. Arrays are loaded on first access;
+    unlike load_session_data the waveforms of a session can be accessed too.
+    Only v1 sessions can be opened."""
+    hid = int(hid)
+    if hid < 200000:
+        raise ValueError("Only v1 sessions (hid >= 200000) can be opened lazily")
+    s3resource = get_boto3_resource("s3")
+    all_blocks = get_blocks(hid, pgsql_)
+    if isinstance(blockno, collections.abc.Iterable):
+        blocks = [int(b) for b in blockno if int(b) in all_blocks]
+    elif blockno is not None:
+        if int(blockno) not in all_blocks:
+            raise ValueError(
+                "Requested block number(s) {} could not be resolved".format(blockno)
+            )
+        return cloud_open_block(hid, int(blockno), s3resource, pgsql_, max_concurrency)
+    else:
+        blocks = all_blocks
+    session = Session(
+        [cloud_open_block(hid, b, s3resource, pgsql_, max_concurrency) for b in blocks]
+    )
+    if pgsql_ is not None:
+        session["__info__"] = get_session_info(pgsql_, hid)
+    return session
+
+
 def load_log_data(lid, bucket="pwd-remote-logs", device_id="all"):
     dst = tempfile.mkdtemp()
     fn = str(lid) + ".gz"
@@ -332,14 +725,19 @@ def load_log_data_raw(lid, bucket="pwd-remote-logs", device_id="all"):
     return gzip.open(dst + "/" + fn, "rb")
 
 
-def download_file(bucket, key, filename, client=None):
+def download_file(bucket, key, filename, client=None, use_cache=False):
     """ download the file at bucket/key to filename.
         filename should contain the full path as well.
-        key should contain all 'sub-directories' in S3 hierarchy. """
+        key should contain all 'sub-directories' in S3 hierarchy.
+        With use_cache the file goes through the local S3 cache, for files
+        that are downloaded again. """
     # try direct connection to s3 first
     if client is None:
-        client = get_boto3_session().client("s3")
-    client.download_file(Bucket=bucket, Key=key, Filename=filename)
+        client = get_boto3_client("s3")
+    if use_cache:
+        cache.cached_download(client, bucket, key, filename)
+    else:
+        client.download_file(Bucket=bucket, Key=key, Filename=filename)
 
 
 def upload_file(filename, bucket, key, client=None):
@@ -347,14 +745,13 @@ def upload_file(filename, bucket, key, client=None):
         filename should contain the full path to the file.
         key should contain all 'sub-directories' in S3 hierarchy. """
     if client is None:
-        client = get_boto3_session().client("s3")
+        client = get_boto3_client("s3")
     client.upload_file(Filename=filename, Bucket=bucket, Key=key)
 
 
 def show_files(bucket, prefix=""):
     """ show files at given bucket and prefix."""
-    boto3_ = get_boto3_session()
-    client = boto3_.client("s3")
+    client = get_boto3_client("s3")
     response = client.list_objects(Bucket=bucket, Prefix=prefix)
     print("{:30}  {:>14}  {}".format("file", "size(bytes)", "storage class"))
     print("-" * 61)
@@ -371,10 +768,11 @@ def upload_indexed_file(
     file_class="misc",
     notes=None,
     pgsql_=None,
+    s3_resource=None,
 ):
     """ upload a file to s3 and insert info about it into the pgsql file_info table"""
-    boto_ = get_boto3_session()
-    s3_resource = boto_.resource("s3")
+    if s3_resource is None:
+        s3_resource = get_boto3_resource("s3")
     key_obj = s3_resource.Object(bucket_name, key_name)
     for i in range(5):  # try to upload 5 times
         try:
@@ -0,0 +1,184 @@
+"""Compression codecs for saved block arrays.
+
+A codec is named by a string with an optional compression level, e.g. "xz",
+"zstd:9" or "blosc-lz4:5". Arrays are stored as .npy bytes compressed with
+the codec in files named <array><extension>. The codec of a block is recorded
+as CODEC in its metadata; blocks without one were written with xz.
+"""
+import io
+import warnings
+
+try:
+    import numpy as np
+except ImportError:  # jython
+    np = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+    warnings.warn("zstandard not available, zstd array codec disabled", ImportWarning)
+try:
+    import blosc
+except ImportError:
+    blosc = None
+    warnings.warn("blosc not available, blosc-lz4 array codec disabled", ImportWarning)
+
+DEFAULT_CODEC = "xz"
+CODECS = {}
+# bytes of array data handed to a streaming compressor at a time
+STREAM_CHUNK = 2 ** 24
+
+
+def register_codec(name, extension, compress, decompress, compressobj=None):
+    """compress(raw, level, typesize) and decompress(raw) work on bytes.
+    compressobj(level, size), if given, returns an object with compress(data)
+    and flush() methods to compress arrays of size bytes in a stream."""
+    CODECS[name] = dict(
+        extension=extension,
+        compress=compress,
+        decompress=decompress,
+        compressobj=compressobj,
+    )
+
+
+def _require(module, name):
+    if module is None:
+        raise ImportError(f"the {name} array codec is not available")
+
+
+def _xz_compress(raw, level, typesize):
+    _require(lzma, "xz")
+    return lzma.compress(raw, preset=6 if level is None else level)
+
+
+def _xz_compressobj(level, size):
+    _require(lzma, "xz")
+    return lzma.LZMACompressor(preset=6 if level is None else level)
+
+
+def _xz_decompress(raw):
+    _require(lzma, "xz")
+    return lzma.decompress(raw)
+
+
+def _zstd_compress(raw, level, typesize):
+    _require(zstandard, "zstd")
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress(raw)
+
+
+def _zstd_compressobj(level, size):
+    _require(zstandard, "zstd")
+    # the content size goes into the frame header, as with compress()
+    cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+    return cctx.compressobj(size=size)
+
+
+def _zstd_decompress(raw):
+    _require(zstandard, "zstd")
+    # decompress() needs the content size in the frame header, which streamed
+    # frames written without one lack
+    return zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+
+
+def _blosc_lz4_compress(raw, level, typesize):
+    _require(blosc, "blosc-lz4")
+    return blosc.compress(
+        raw,
+        typesize=typesize,
+        clevel=5 if level is None else level,
+        shuffle=blosc.SHUFFLE,
+        cname="lz4",
+    )
+
+
+def _blosc_lz4_decompress(raw):
+    _require(blosc, "blosc-lz4")
+    return blosc.decompress(raw)
+
+
+register_codec("xz", ".npy.xz", _xz_compress, _xz_decompress, _xz_compressobj)
+register_codec("zstd", ".npy.zst", _zstd_compress, _zstd_decompress, _zstd_compressobj)
+register_codec("blosc-lz4", ".npy.blosc", _blosc_lz4_compress, _blosc_lz4_decompress)
+
+
+def parse_codec(codec=None):
+    """Split a codec string into its registered name and level (or None)."""
+    if codec is None:
+        codec = DEFAULT_CODEC
+    name, _, level = codec.partition(":")
+    if name not in CODECS:
+        raise ValueError(f"Unknown array codec {codec}")
+    return name, int(level) if level else None
+
+
+def codec_name(codec=None):
+    return parse_codec(codec)[0]
+
+
+def codec_extension(codec=None):
+    return CODECS[codec_name(codec)]["extension"]
+
+
+def codec_from_filename(fn):
+    for name, spec in CODECS.items():
+        if fn.endswith(spec["extension"]):
+            return name
+    return None
+
+
+def _npy_header(arr):
+    d = np.lib.format.header_data_from_array_1_0(arr)
+    with io.BytesIO() as buffer:
+        try:
+            np.lib.format.write_array_header_1_0(buffer, d)
+        except ValueError:
+            np.lib.format.write_array_header_2_0(buffer, d)
+        return buffer.getvalue()
+
+
+def write_array(fp, arr, codec=None):
+    """Writes what encode_array(arr, codec) returns to the binary file fp. With
+    a streaming codec the array data is compressed straight from arr, a chunk
+    at a time, rather than from a copy of the whole .npy."""
+    name, level = parse_codec(codec)
+    arr = np.asarray(arr)
+    compressobj = CODECS[name]["compressobj"]
+    if compressobj is None or arr.dtype.hasobject:
+        fp.write(encode_array(arr, codec))
+        return
+    if not arr.flags.c_contiguous:
+        arr = arr.copy(order="C")
+    header = _npy_header(arr)
+    cobj = compressobj(level, len(header) + arr.nbytes)
+    fp.write(cobj.compress(header))
+    data = memoryview(arr.reshape(-1).view(np.uint8))
+    for i in range(0, len(data), STREAM_CHUNK):
+        fp.write(cobj.compress(data[i : i + STREAM_CHUNK]))
+    fp.write(cobj.flush())
+
+
+def encode_array(arr, codec=None):
+    name, level = parse_codec(codec)
+    arr = np.asarray(arr)
+    if CODECS[name]["compressobj"] is not None and not arr.dtype.hasobject:
+        with io.BytesIO() as buffer:
+            write_array(buffer, arr, codec)
+            return buffer.getvalue()
+    with io.BytesIO() as buffer:
+        np.save(buffer, arr)
+        raw = buffer.getvalue()
+    # the npy header is padded so the data stays aligned for the blosc shuffle
+    return CODECS[name]["compress"](raw, level, arr.dtype.itemsize)
+
+
+def decode_array(raw, codec=None):
+    name, _ = parse_codec(codec)
+    with io.BytesIO(CODECS[name]["decompress"](raw)) as buffer:
+        return np.load(buffer)
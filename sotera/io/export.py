@@ -57,6 +57,61 @@ def ltaa_value(arr, t, WINDOW, col):
     return val
 
 
+def window_bounds(arr, times, WINDOW):
+    """arr sorted by time and the rows [lo, hi) of it in each window
+    [t, t + WINDOW) of `times`."""
+    if arr.shape[0] > 1 and (np.diff(arr[:, 1]) < 0).any():
+        arr = arr[np.argsort(arr[:, 1], kind="stable")]
+    lo = np.searchsorted(arr[:, 1], times, side="left")
+    hi = np.searchsorted(arr[:, 1], times + WINDOW, side="left")
+    return arr, lo, hi
+
+
+def numeric_values(arr, lo, hi, col):
+    """numeric_value of every window [lo, hi) of arr at once."""
+    n = len(lo)
+    counts = hi - lo
+    w = np.repeat(np.arange(n), counts)
+    rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    sub = arr[rows + np.repeat(lo, counts)]
+
+    # median of the measurements of each window
+    valid = sub[:, 2] > -1
+    nvalid = np.bincount(w[valid], minlength=n)
+    v = sub[valid, col]
+    v = v[np.lexsort((v, w[valid]))]
+    start = np.cumsum(nvalid) - nvalid
+    has = nvalid > 0
+    medians = np.zeros(n)
+    medians[has] = (
+        v[start[has] + (nvalid[has] - 1) // 2] + v[start[has] + nvalid[has] // 2]
+    ) / 2
+
+    xx = np.bincount(w, (sub[:, col] < 0) * (sub[:, col] > -4), minlength=n) > 0
+    plus = np.bincount(w, sub[:, 2] == -4, minlength=n) > 0
+
+    vals = [None] * n
+    for k in np.flatnonzero(counts):
+        if has[k]:
+            vals[k] = f"{int(medians[k])}"
+        elif xx[k]:
+            vals[k] = "XX"
+        else:
+            vals[k] = "++" if plus[k] else "--"
+    return vals
+
+
+def window_values(arr, times, WINDOW, col, func):
+    """func(arr, t, WINDOW, col) for every t in times, binning arr once."""
+    arr, lo, hi = window_bounds(arr, times, WINDOW)
+    if func is numeric_value:
+        return numeric_values(arr, lo, hi, col)
+    return [
+        func(arr[a:b], t, WINDOW, col) if b > a else None
+        for t, a, b in zip(times, lo, hi)
+    ]
+
+
 def export_columns(device=True, alarms=True, posture=True, ltaa=True):
     cols = OrderedDict()
     cols["Time"] = None
@@ -128,10 +183,18 @@ def numerics_export(data, columns=None, WINDOW=15, timezone=None, add_header=Tru
     else:
         devices = None
 
+    # each array is binned into the windows once, per column not per row
+    values = {}
+    for col_name, c in columns.items():
+        if c is not None and c["array"] in arrays_in_data:
+            values[col_name] = window_values(
+                data[c["array"]], times, WINDOW, c["col"], c["func"]
+            )
+
     if add_header:
         yield list(columns.keys())
 
-    for t in times:
+    for k, t in enumerate(times):
         row = [None] * len(columns)
         for i, col_name in enumerate(columns.keys()):
             if col_name == "Time":
@@ -141,14 +204,11 @@ def numerics_export(data, columns=None, WINDOW=15, timezone=None, add_header=Tru
                     row[i] = f"{int(t+WINDOW/2.)}"
                 continue
             elif col_name == "Device" and devices is not None:
-                idx = (times >= t) * (times < t + WINDOW)
-                row[i] = f"{int(devices[idx][0])}"
+                row[i] = f"{int(devices[k])}"
                 continue
 
-            array_name = columns[col_name]["array"]
-            if array_name in arrays_in_data:
-                func_ = columns[col_name]["func"]
-                val = func_(data[array_name], t, WINDOW, columns[col_name]["col"])
+            if col_name in values:
+                val = values[col_name][k]
                 row[i] = val.strip() if type(val) is str else val
 
         if row[2:] != [None] * 2 * len(columns):
@@ -0,0 +1,121 @@
+"""Seekable storage for waveform arrays.
+
+A framed array is split on fixed sequence number ranges (column 0) into
+frames that are compressed independently and written back to back into one
+file. The frame index is kept with the array in the block metadata, so a
+window of the block can be loaded by fetching and decompressing only the
+frames it overlaps.
+"""
+import numpy as np
+from sotera.io import frames_file
+from sotera.io.codecs import codec_name, encode_array, decode_array
+from sotera.io.timesync import TimeIndex
+
+DEFAULT_FRAME_SN = 15000  # 30 seconds
+
+
+def can_frame(arr):
+    """Only 2-d arrays sorted on the sequence numbers in column 0 are framed."""
+    return (
+        isinstance(arr, np.ndarray)
+        and arr.ndim == 2
+        and arr.shape[1] > 0
+        and arr.dtype.kind in "iuf"
+        and bool(np.all(np.diff(arr[:, 0]) >= 0))
+    )
+
+
+def write_frames(fp, arr, frame_sn=DEFAULT_FRAME_SN, codec=None):
+    """Write `arr` to the open file `fp` as frames of `frame_sn` sequence
+    numbers each and return the frame metadata.
+
+    Each index entry is [first sn, last sn, byte offset, byte length].
+    """
+    index = []
+    offset = 0
+    if arr.shape[0] > 0:
+        bins = arr[:, 0] // frame_sn
+        for rows in np.split(arr, np.flatnonzero(np.diff(bins)) + 1):
+            raw = encode_array(rows, codec)
+            fp.write(raw)
+            index.append([int(rows[0, 0]), int(rows[-1, 0]), offset, len(raw)])
+            offset += len(raw)
+    return {
+        "codec": codec_name(codec),
+        "frame_sn": frame_sn,
+        "dtype": arr.dtype.str,
+        "columns": arr.shape[1],
+        "index": index,
+    }
+
+
+def save_frames(folder, name, arr, frame_sn=DEFAULT_FRAME_SN, codec=None):
+    fn = "{}/{}".format(folder, frames_file(name))
+    with open(fn, "wb") as fp:
+        frames = write_frames(fp, arr, frame_sn, codec)
+    return fn, frames
+
+
+def select_frames(frames, sn0=None, sn1=None):
+    """The index entries of the frames overlapping [sn0, sn1]."""
+    return [
+        f
+        for f in frames["index"]
+        if (sn0 is None or f[1] >= sn0) and (sn1 is None or f[0] <= sn1)
+    ]
+
+
+def read_frames(read, frames, sn0=None, sn1=None):
+    """Load the rows of a framed array with sn0 <= sn <= sn1.
+
+    read(offset, length) returns bytes of the frames file; the selected frames
+    are contiguous so they are fetched with a single read.
+    """
+    selected = select_frames(frames, sn0, sn1)
+    if not selected:
+        return np.empty((0, frames["columns"]), dtype=frames["dtype"])
+    start = selected[0][2]
+    raw = memoryview(read(start, selected[-1][2] + selected[-1][3] - start))
+    arr = np.concatenate(
+        [
+            decode_array(raw[offset - start : offset - start + length], frames["codec"])
+            for _, _, offset, length in selected
+        ]
+    )
+    keep = np.ones((arr.shape[0],), dtype=bool)
+    if sn0 is not None:
+        keep &= arr[:, 0] >= sn0
+    if sn1 is not None:
+        keep &= arr[:, 0] <= sn1
+    return arr[keep]
+
+
+def file_reader(fn):
+    def read(offset, length):
+        with open(fn, "rb") as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+    return read
+
+
+def time_to_sn(time_sync, t):
+    """Sequence number at unix time `t` from a TIME_SYNC array, extrapolated
+    at 500 sequence numbers per second outside the time syncs."""
+    return TimeIndex(time_sync).to_sn(t, extrapolate=True)
+
+
+def sn_window(time_sync, sn0=None, sn1=None, t0=None, t1=None):
+    """Sequence number range of a window given in sequence numbers and/or
+    unix times; the times are mapped with the block's TIME_SYNC."""
+    if t0 is None and t1 is None:
+        return sn0, sn1
+    if time_sync is None or time_sync.shape[0] == 0:
+        raise ValueError("Time window requested for a block without TIME_SYNC")
+    if t0 is not None:
+        sn = time_to_sn(time_sync, t0)
+        sn0 = sn if sn0 is None else max(sn0, sn)
+    if t1 is not None:
+        sn = time_to_sn(time_sync, t1)
+        sn1 = sn if sn1 is None else min(sn1, sn)
+    return sn0, sn1
@@ -0,0 +1,178 @@
+"""Block and session data that load their arrays on first access.
+
+Block and Session behave like the dicts returned by load_block and
+load_session_data, but only the metadata is read up front. An array is
+fetched, decompressed and inflated the first time its key is accessed, so
+code that only touches numerics never pulls the waveforms.
+"""
+from collections.abc import MutableMapping
+from .local import load_block, load_metadata, merge_all_blocks
+
+
+class Block(MutableMapping):
+    """Lazy block data.
+
+    `meta` is the block metadata and load(names) loads the listed stored
+    arrays, returning a dict like load_block does. T0 and T1 cover the arrays
+    loaded so far, as they do for an eager load of the same arrays.
+    """
+
+    def __init__(self, meta, load, arrays=None):
+        self._load = load
+        self._data = {"__meta__": meta}
+        for k in ("HIGGINS", "PWD_VERSION", "FILE_START_TIME", "DEVICES"):
+            self._data[k] = meta[k]
+        for k in meta["CONSTANTS"]:
+            self._data[k] = meta["CONSTANTS"][k]
+        # key -> stored array it is loaded from
+        self._sources = {}
+        stored = meta.get("ARRAYS", {})
+        for arr in stored.keys() if arrays is None else arrays:
+            self._sources[arr] = arr
+            if arr in ("ECG", "PPG") and arr in stored.keys():
+                for lead in stored[arr]["columns"]:
+                    self._sources[lead] = arr
+        if "TIME_SYNC" in self._sources.keys():
+            self._sources["T0"] = "TIME_SYNC"
+            self._sources["T1"] = "TIME_SYNC"
+
+    def array_keys(self):
+        """Keys of the arrays in the block, loaded or not."""
+        return [k for k in self._sources.keys() if k not in ("T0", "T1")]
+
+    def load_arrays(self, keys):
+        """Load the arrays for `keys` at once, if not loaded already."""
+        names = []
+        for k in keys:
+            if k not in self._data.keys() and k in self._sources.keys():
+                if self._sources[k] not in names:
+                    names.append(self._sources[k])
+        if not names:
+            return
+        loaded = self._load(names)
+        for k, v in loaded.items():
+            if k == "T0" and "T0" in self._data.keys():
+                self._data["T0"] = min(self._data["T0"], v)
+            elif k == "T1" and "T1" in self._data.keys():
+                self._data["T1"] = max(self._data["T1"], v)
+            elif k not in self._data.keys():
+                self._data[k] = v
+        for k, arr in list(self._sources.items()):
+            if arr in names and k not in self._data.keys():
+                # empty in this block
+                del self._sources[k]
+
+    def __getitem__(self, key):
+        if key not in self._data.keys():
+            if key not in self._sources.keys():
+                raise KeyError(key)
+            self.load_arrays([key])
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        found = False
+        if key in self._data.keys():
+            del self._data[key]
+            found = True
+        if key in self._sources.keys():
+            del self._sources[key]
+            found = True
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._data.keys() or key in self._sources.keys()
+
+    def __iter__(self):
+        yield from self._data.keys()
+        for k in list(self._sources.keys()):
+            if k not in self._data.keys():
+                yield k
+
+    def __len__(self):
+        return len(self._data) + len(
+            [k for k in self._sources.keys() if k not in self._data.keys()]
+        )
+
+    def __repr__(self):
+        keys = self.array_keys()
+        loaded = [k for k in keys if k in self._data.keys()]
+        return f"<Block {len(keys)} arrays, loaded {loaded}>"
+
+
+class Session(MutableMapping):
+    """Lazy session data over a list of Blocks. An array is loaded from every
+    block and merged with merge_all_blocks on first access. Blocks without time
+    syncs are skipped, as they are by load_session_data."""
+
+    def __init__(self, blocks):
+        self.blocks = [b for b in blocks if "TIME_SYNC" in b.array_keys()]
+        self._data = {"__metas__": [b["__meta__"] for b in self.blocks]}
+        self._keys = []
+        for b in self.blocks:
+            for k in b.array_keys():
+                if k not in self._keys:
+                    self._keys.append(k)
+
+    def load_arrays(self, keys):
+        """Load and merge the arrays for `keys`, if not loaded already."""
+        keys = [k for k in keys if k not in self._data.keys() and k in self._keys]
+        if not keys:
+            return
+        for b in self.blocks:
+            b.load_arrays(keys)
+        data = merge_all_blocks(
+            ({k: b[k] for k in keys if k in b} for b in self.blocks), check=False
+        )
+        del data["__metas__"]
+        for k in keys:
+            if k not in data.keys():
+                self._keys.remove(k)
+        self._data.update(data)
+
+    def __getitem__(self, key):
+        if key not in self._data.keys():
+            if key not in self._keys:
+                raise KeyError(key)
+            self.load_arrays([key])
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        found = False
+        if key in self._data.keys():
+            del self._data[key]
+            found = True
+        if key in self._keys:
+            self._keys.remove(key)
+            found = True
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._data.keys() or key in self._keys
+
+    def __iter__(self):
+        yield from list(self._data.keys())
+        for k in list(self._keys):
+            if k not in self._data.keys():
+                yield k
+
+    def __len__(self):
+        return len(self._data) + len([k for k in self._keys if k not in self._data])
+
+    def __repr__(self):
+        return f"<Session {len(self.blocks)} blocks, {len(self._keys)} arrays>"
+
+
+def open_block(folder, metafn="meta.json"):
+    """Lazy version of load_block."""
+    return Block(
+        load_metadata(folder, fn=metafn),
+        lambda names: load_block(folder, arrays=names, metafn=metafn),
+    )
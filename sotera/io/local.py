@@ -1,11 +1,18 @@
 import os
 import numpy as np
-import lzma
 import json
 import gzip
 import re
 import datetime
-from sotera.io import OTHER_KEYS, ECG_KEYS, PPG_KEYS, INTONLY, arrays_to_get
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sotera.io import OTHER_KEYS, ECG_KEYS, PPG_KEYS, INTONLY, WAVEFORMS
+from sotera.io import arrays_to_get, frames_file
+from sotera.io.codecs import CODECS, codec_extension, codec_name
+from sotera.io.codecs import decode_array, write_array
+from sotera.io.frames import can_frame, save_frames, read_frames, file_reader
+from sotera.io.frames import sn_window
+from sotera.io.timesync import TimeIndex
 
 
 def save_metadata(folder, meta, fn="meta.json"):
@@ -39,34 +46,127 @@ def merge_metadata(partial_meta, meta=None):
     return meta
 
 
-def save_arrays(folder, data, use_compression=True):
+def save_array(folder, name, arr, use_compression=True, codec=None):
+    if use_compression:
+        fn = "{}/{}{}".format(folder, name, codec_extension(codec))
+        with open(fn, "wb") as fp:
+            write_array(fp, arr, codec)
+    else:
+        fn = "{}/{}.npy".format(folder, name)
+        with open(fn, "wb") as fp:
+            np.save(fp, arr)
+    return fn
+
+
+def _save_block_array(folder, name, arr, use_compression, codec, frame_sn):
+    """Save a block array, as frames when it is a waveform and `frame_sn` is
+    given. Returns the file and the frame metadata (None when not framed)."""
+    if (
+        frame_sn is not None
+        and use_compression
+        and name in WAVEFORMS
+        and can_frame(arr)
+    ):
+        return save_frames(folder, name, arr, frame_sn, codec)
+    return save_array(folder, name, arr, use_compression, codec), None
+
+
+def save_arrays(folder, data, use_compression=True, codec=None, frame_sn=None):
     fn_list = []
+    if "__meta__" not in data.keys():
+        # the frame index is kept in the metadata
+        frame_sn = None
     for name in data.keys():
         if name == "__meta__":
             continue
-
-        if use_compression:
-            fn = "{}/{}.npy.xz".format(folder, name)
-            with lzma.open(fn, "wb") as fp:
-                np.save(fp, data[name])
-        else:
-            fn = "{}/{}.npy".format(folder, name)
-            with open(fn, "wb") as fp:
-                np.save(fp, data[name])
-
+        fn, frames = _save_block_array(
+            folder, name, data[name], use_compression, codec, frame_sn
+        )
+        if frames is not None:
+            data["__meta__"]["ARRAYS"].setdefault(name, {})["frames"] = frames
         fn_list.append(fn)
     return fn_list
 
 
-def load_array(folder, name):
-    try:
-        fn = "{}/{}.npy.xz".format(folder, name)
-        with lzma.open(fn, "rb") as cfp:
-            arr = np.load(cfp)
-    except IOError:
-        fn = "{}/{}.npy".format(folder, name)
-        with open(fn, "rb") as cfp:
-            arr = np.load(cfp)
+class BlockWriter:
+    """Save the arrays of a block while the caller is still producing them.
+
+    Arrays are compressed and written by background threads (the codecs
+    release the GIL). At most `max_pending` arrays are held waiting to be written;
+    write() blocks until a slot frees up, which bounds the memory held by
+    the writer. With `frame_sn` waveforms are saved as frames, indexed in the
+    metadata passed to close().
+    """
+
+    def __init__(
+        self,
+        folder,
+        use_compression=True,
+        workers=1,
+        max_pending=2,
+        codec=None,
+        frame_sn=None,
+    ):
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        self.folder = folder
+        self.use_compression = use_compression
+        self.codec = codec
+        self.frame_sn = frame_sn
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.Semaphore(max(max_pending, workers))
+        self._futures = []
+
+    def write(self, name, arr):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                _save_block_array,
+                self.folder,
+                name,
+                arr,
+                self.use_compression,
+                self.codec,
+                self.frame_sn,
+            )
+        except:  # noqa E722
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append((name, future))
+
+    def close(self, meta=None, metafn="meta.json"):
+        """Wait for all pending writes, save `meta` and return the files."""
+        fn_list = []
+        for name, future in self._futures:
+            fn, frames = future.result()
+            if frames is not None and meta is not None:
+                meta["ARRAYS"].setdefault(name, {})["frames"] = frames
+            fn_list.append(fn)
+        self._executor.shutdown()
+        if meta is not None:
+            if self.use_compression:
+                meta["CODEC"] = codec_name(self.codec)
+            fn_list.append(save_metadata(self.folder, meta, fn=metafn))
+        return fn_list
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._executor.shutdown()
+
+
+def load_array(folder, name, codec=None):
+    # without a codec try every registered one, xz first
+    for c in CODECS if codec is None else (codec,):
+        fn = "{}/{}{}".format(folder, name, codec_extension(c))
+        if os.path.exists(fn):
+            with open(fn, "rb") as cfp:
+                return decode_array(cfp.read(), c)
+    fn = "{}/{}.npy".format(folder, name)
+    with open(fn, "rb") as cfp:
+        arr = np.load(cfp)
     return arr
 
 
@@ -99,23 +199,52 @@ def load_log_file(folder, name, device_id):
     return data
 
 
-def save_block(folder, data, use_compression=True, metafn="meta.json"):
+def save_block(
+    folder, data, use_compression=True, metafn="meta.json", codec=None, frame_sn=None
+):
     if not os.path.isdir(folder):
         os.mkdir(folder)
-    fn_list = save_arrays(folder, data, use_compression=use_compression)
+    fn_list = save_arrays(
+        folder, data, use_compression=use_compression, codec=codec, frame_sn=frame_sn
+    )
     if "__meta__" in data.keys():
+        if use_compression:
+            data["__meta__"]["CODEC"] = codec_name(codec)
         fn_list.append(save_metadata(folder, data["__meta__"], fn=metafn))
     return fn_list
 
 
-def load_block(folder, arrays=None, metafn="meta.json", exclude_variables=None):
+def load_block(
+    folder,
+    arrays=None,
+    metafn="meta.json",
+    exclude_variables=None,
+    sn0=None,
+    sn1=None,
+    t0=None,
+    t1=None,
+):
+    """Load a saved block. Framed waveforms are limited to the window given by
+    sn0/sn1 and/or t0/t1 and only the frames it overlaps are read."""
     data = dict(__meta__=load_metadata(folder, fn=metafn))
     if arrays is None:
         arrays = list(data["__meta__"]["ARRAYS"].keys())
     if exclude_variables is not None:
         arrays = list(set(arrays) - set(exclude_variables))
-    for array_name in arrays_to_get(arrays, data["__meta__"]["ARRAYS"].keys()):
-        arr = load_array(folder, array_name)
+    window = None
+    arrays = arrays_to_get(arrays, data["__meta__"]["ARRAYS"].keys())
+    # TIME_SYNC first, it maps t0/t1 to sequence numbers
+    for array_name in sorted(arrays, key=lambda a: a != "TIME_SYNC"):
+        spec = data["__meta__"]["ARRAYS"][array_name]
+        if "frames" in spec:
+            if window is None:
+                window = sn_window(data.get("TIME_SYNC"), sn0, sn1, t0, t1)
+            fn = "{}/{}".format(folder, frames_file(array_name))
+            arr = read_frames(file_reader(fn), spec["frames"], *window)
+            if arr.shape[0] == 0:
+                continue
+        else:
+            arr = load_array(folder, array_name, codec=data["__meta__"].get("CODEC"))
         if do_inflate(array_name, arr):
             data[array_name] = inflate_array(arr)
         else:
@@ -179,6 +308,53 @@ def merge_blocks(data, block_data, check=True):
     return data
 
 
+def merge_all_blocks(blocks, check=True):
+    """Merge an iterable of block data like repeated merge_blocks calls do,
+    but concatenate each array once at the end instead of for every block."""
+    parts = {}
+    metas = []
+    for block_data in blocks:
+        if check and "TIME_SYNC" not in block_data.keys():
+            continue
+        for var in block_data.keys():
+            if type(block_data[var]) is np.ndarray:
+                if (
+                    len(block_data[var].shape) > 1
+                    and block_data[var].shape[1] > 1
+                    and block_data[var].shape[0] > 0
+                ):
+                    arr = var
+                    if (
+                        var == "CNIBP_CAL_PKT"
+                        and "CNIBP_CAL_PKT" in parts.keys()
+                        and block_data[var].shape[1] != parts[var][0].shape[1]
+                    ):
+                        arr = "CNIBP_CAL_PKT_V2"
+                    parts.setdefault(arr, []).append(block_data[var])
+        parts.setdefault("__metas__", metas)
+        try:
+            metas.append(block_data["__meta__"])
+        except KeyError:
+            if check:
+                raise
+
+    data = {}
+    for arr, arrays in parts.items():
+        if arr == "__metas__":
+            data[arr] = arrays
+        elif len(arrays) == 1:
+            # the block arrays may be read-only cached views; like
+            # np.concatenate, always hand back a writable copy
+            data[arr] = arrays[0].copy()
+        else:
+            data[arr] = np.concatenate(arrays)
+    if "BP" in data.keys() and data["BP"].shape[0]:
+        # exclude dubplicate BP readings from the same inflation
+        idx = np.r_[True, np.diff(data["BP"][:, 5]) != 0]
+        data["BP"] = data["BP"][idx, :]
+    return data
+
+
 def do_inflate(arr, data):
     if arr == "TIME_SYNC":
         return False
@@ -194,43 +370,27 @@ def inflate_array(opt):
     return arr
 
 
+def array_span(arr):
+    """First and last sequence numbers of a block array."""
+    return int(arr[0, 0]), int(arr[-1, 0])
+
+
 def derive_timestamps(data):
     TS = data["TIME_SYNC"]
-    # find first and last sqn in an array in block
-    sqn0 = int(TS[0, 0])
-    sqnN = int(TS[-1, 0])
     t0 = float(TS[0, 1])
-    if sqnN < sqn0:
-        # reset or device swap, remove last time sync because
-        # it is from the next segment
-        TS = TS[:-1, :]
-    for k in data.keys():
-        # scan the rest of the arrays for sequence numbers before and after
-        # the time-sync packets first and last
-        if k[0] != "_" and k != "TIME_SYNC" and data[k].shape[1] > 1:
-            sqnN = int(data[k][-1, 0]) if int(data[k][-1, 0]) > sqnN else sqnN
-            sqn0 = int(data[k][0, 0]) if int(data[k][0, 0]) < sqn0 else sqn0
-    # create a time sync array augmented for any sequence number that fall
-    # before
-    # time <-> sqn mapping using time syncs and
-    if sqnN > TS[-1, 0]:
-        # tack on extra points to time
-        times = np.r_[TS[:, 1], TS[-1, 1] + 2 * (sqnN - TS[-1, 0]) / 1000.0]
-        sqnums = np.r_[TS[:, 0], sqnN]
-    else:
-        times = TS[:, 1].copy()
-        sqnums = TS[:, 0].copy()
-    if sqn0 < TS[0, 0]:
-        times = np.r_[TS[0, 1] + 2 * (sqn0 - TS[0, 0]) / 1000.0, times]
-        sqnums = np.r_[sqn0, sqnums]
-    for k in data.keys():
-        if k[0] != "_" and k != "TIME_SYNC" and data[k].shape[1] > 1:
-            data[k][:, 1] = np.interp(data[k][:, 0].astype(float), sqnums, times)
-            # exclude data that is > 30 sec before the first time sync packet
-            i = data[k][:, 1].astype(float) > t0 - 30
-            data[k] = data[k][i, :]
-    data["T0"] = times[0]
-    data["T1"] = times[-1]
+    keys = [
+        k
+        for k in data.keys()
+        if k[0] != "_" and k != "TIME_SYNC" and data[k].shape[1] > 1
+    ]
+    index = TimeIndex.from_spans(TS, [array_span(data[k]) for k in keys])
+    for k in keys:
+        data[k][:, 1] = index.to_time(data[k][:, 0])
+        # exclude data that is > 30 sec before the first time sync packet
+        i = data[k][:, 1] > t0 - 30
+        data[k] = data[k][i, :]
+    data["T0"] = index.t0
+    data["T1"] = index.t1
     return data
 
 
@@ -265,60 +425,75 @@ def deflate_array(data, name):
     return opt, meta
 
 
-def deflate_ecg_arrays(data, keys):
+def sn_offsets(sn, sn_min):
+    """Rows `sn - sn_min` of the samples `sn` in a dense array starting at
+    sn_min, and the indices of the samples to copy there. For duplicate
+    sequence numbers only the first sample is kept."""
+    rows = np.asarray(sn).astype(np.intp) - int(sn_min)
+    if rows.shape[0] > 1 and not np.all(rows[1:] > rows[:-1]):
+        # duplicate or out of order sample(s)!
+        rows, i = np.unique(rows, return_index=True)
+        return rows, i
+    return rows, slice(None)
+
+
+def deflate_waveform_arrays(data, keys, order):
+    """int32 array of the waveforms `keys` in `order` as columns, one row per
+    sequence number, with INT_MIN where a waveform has no sample."""
     meta = dict(columns={})
-    sn_min = min([data[k][:, 0].min().astype(np.int32) for k in keys])
-    sn_max = max([data[k][:, 0].max().astype(np.int32) for k in keys])
-    ecg = np.ones((sn_max - sn_min + 1, len(keys) + 1)) * np.iinfo(np.int32).min
-    ecg[:, 0] = np.arange(sn_min, sn_max + 1)
+    sn_min = int(min([data[k][:, 0].min() for k in keys]))
+    sn_max = int(max([data[k][:, 0].max() for k in keys]))
+    wfm = np.full(
+        (sn_max - sn_min + 1, len(keys) + 1), np.iinfo(np.int32).min, dtype=np.int32
+    )
+    wfm[:, 0] = np.arange(sn_min, sn_max + 1)
     c = 1
-    for k in ECG_KEYS:
-        try:
-            if np.sum(np.diff(data[k][:, 0]) == 0):
-                # duplicate sample(s)!
-                sn, i = np.unique(data[k][:, 0], return_index=True)
-                idx = np.in1d(ecg[:, 0], sn)
-                ecg[idx, c] = data[k][i, 2]
-            else:
-                idx = np.in1d(ecg[:, 0], data[k][:, 0])
-                ecg[idx, c] = data[k][:, 2]
-            meta["columns"][k] = c
-            del idx
-        except KeyError:
-            pass
-        else:
-            c += 1
-    ecg = ecg.astype(np.int32)
-    meta["shape"] = ecg.shape
-    return ecg, meta
+    for k in order:
+        if k not in keys:
+            continue
+        rows, i = sn_offsets(data[k][:, 0], sn_min)
+        wfm[rows, c] = data[k][i, 2]
+        meta["columns"][k] = c
+        c += 1
+    meta["shape"] = wfm.shape
+    return wfm, meta
+
+
+def deflate_ecg_arrays(data, keys):
+    return deflate_waveform_arrays(data, keys, ECG_KEYS)
 
 
 def deflate_ppg_arrays(data, keys):
-    meta = dict(columns={})
-    sn_min = min([data[k][:, 0].min().astype(np.int32) for k in keys])
-    sn_max = max([data[k][:, 0].max().astype(np.int32) for k in keys])
-    ppg = np.ones((sn_max - sn_min + 1, len(keys) + 1)) * np.iinfo(np.int32).min
-    ppg[:, 0] = np.arange(sn_min, sn_max + 1)
-    c = 1
-    for k in PPG_KEYS:
-        try:
-            if np.sum(np.diff(data[k][:, 0]) == 0):
-                # duplicate sample(s)!
-                sn, i = np.unique(data[k][:, 0], return_index=True)
-                idx = np.in1d(ppg[:, 0], sn)
-                ppg[idx, c] = data[k][i, 2]
-            else:
-                idx = np.in1d(ppg[:, 0], data[k][:, 0])
-                ppg[idx, c] = data[k][:, 2]
-            meta["columns"][k] = c
-            del idx
-        except KeyError:
-            pass
+    return deflate_waveform_arrays(data, keys, PPG_KEYS)
+
+
+def iter_optimized(data):
+    """Like optimize, but yield (name, array) pairs ready to be saved,
+    removing the source arrays from `data` as soon as they are consumed."""
+    if "TIME_SYNC" in data.keys():
+        data["__meta__"]["ARRAYS"]["TIME_SYNC"] = {"shape": data["TIME_SYNC"].shape}
+    ecg_arrays = [k for k in data.keys() if k in ECG_KEYS]
+    if len(ecg_arrays):
+        ecg, data["__meta__"]["ARRAYS"]["ECG"] = deflate_ecg_arrays(data, ecg_arrays)
+        for k in ecg_arrays:
+            del data[k]
+        yield "ECG", ecg
+        del ecg
+    ppg_arrays = [k for k in data.keys() if k in PPG_KEYS]
+    if len(ppg_arrays):
+        ppg, data["__meta__"]["ARRAYS"]["PPG"] = deflate_ppg_arrays(data, ppg_arrays)
+        for k in ppg_arrays:
+            del data[k]
+        yield "PPG", ppg
+        del ppg
+    keys = [k for k in data.keys() if k != "__meta__"]
+    for key in keys:
+        if key in OTHER_KEYS:
+            arr, data["__meta__"]["ARRAYS"][key] = deflate_array(data, key)
+            del data[key]
+            yield key, arr
         else:
-            c += 1
-    ppg = ppg.astype(np.int32)
-    meta["shape"] = ppg.shape
-    return ppg, meta
+            yield key, data.pop(key)
 
 
 def optimize(data):
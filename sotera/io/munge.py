@@ -1,6 +1,7 @@
 import numpy as np
 import scipy.interpolate
 import bisect
+from sotera.io.local import sn_offsets
 
 PPG_SAT_LOW = 25000000
 PPG_SAT_HIGH = 645000000
@@ -48,26 +49,24 @@ def preprocess_ppg(
         for k in WAVEFORMS:
             if k in _data_.keys():
                 if s0 is None:
-                    s0 = int(_data_[k][0, 0])
+                    s0 = int(_data_[k][:, 0].min())
                 else:
-                    s0 = min(s0, int(_data_[k][0, 0]))
+                    s0 = min(s0, int(_data_[k][:, 0].min()))
 
                 if s1 is None:
-                    s1 = int(_data_[k][-1, 0])
+                    s1 = int(_data_[k][:, 0].max())
                 else:
-                    s1 = max(s1, int(_data_[k][-1, 0]))
+                    s1 = max(s1, int(_data_[k][:, 0].max()))
 
-        PPG = np.ones((s1 - s0 + 1, len(WAVEFORMS) + 2)) * np.iinfo(np.int32).min
+        PPG = np.full((s1 - s0 + 1, len(WAVEFORMS) + 2), np.iinfo(np.int32).min, float)
         PPG[:, 0] = np.arange(s0, s1 + 1)
         c = 2
         for k in WAVEFORMS:
             try:
                 # copy data into merged PPG waveform remove duplicate points
-                sqn, idx0 = np.unique(_data_[k][:, 0], return_index=True)
-                tmp = _data_[k][idx0, :]
-                idx = np.in1d(PPG[:, 0], tmp[:, 0])
-                PPG[idx, 1] = tmp[:, 1]
-                PPG[idx, c] = tmp[:, 2]
+                rows, idx0 = sn_offsets(_data_[k][:, 0], s0)
+                PPG[rows, 1] = _data_[k][idx0, 1]
+                PPG[rows, c] = _data_[k][idx0, 2]
                 idx = np.isnan(PPG[:, c])
                 PPG[idx, c] = PPG_SAT_HIGH
             except KeyError:
@@ -148,30 +147,28 @@ def preprocess_ecg(
         if k in _data_.keys():
             num_available_leads += 1
             if s0 is None:
-                s0 = int(_data_[k][0, 0])
+                s0 = int(_data_[k][:, 0].min())
             else:
-                s0 = min(s0, int(_data_[k][0, 0]))
+                s0 = min(s0, int(_data_[k][:, 0].min()))
 
             if s1 is None:
-                s1 = int(_data_[k][-1, 0])
+                s1 = int(_data_[k][:, 0].max())
             else:
-                s1 = max(s1, int(_data_[k][-1, 0]))
+                s1 = max(s1, int(_data_[k][:, 0].max()))
     if num_available_leads > 0:
         if s1 - s0 > 5400000:
             metadata["errors"] = "Block too long"
         else:
-            ECG = np.ones((s1 - s0 + 1, num_available_leads + 2)) * np.nan
+            ECG = np.full((s1 - s0 + 1, num_available_leads + 2), np.nan)
             ECG[:, 0] = np.arange(s0, s1 + 1)
             for i, k in enumerate(leads):
                 if k in _data_.keys():
                     # remove duplicate points
-                    sqn, idx0 = np.unique(_data_[k][:, 0], return_index=True)
-                    metadata["dups"][k] = (_data_[k].shape[0] - idx0.shape[0]) / 500
-                    tmp = _data_[k][idx0, :]
+                    rows, idx0 = sn_offsets(_data_[k][:, 0], s0)
+                    metadata["dups"][k] = (_data_[k].shape[0] - rows.shape[0]) / 500
                     # copy data into merged ECG waveform
-                    idx1 = np.in1d(ECG[:, 0], tmp[:, 0])
-                    ECG[idx1, 1] = tmp[:, 1]
-                    ECG[idx1, 2 + i] = tmp[:, 2]
+                    ECG[rows, 1] = _data_[k][idx0, 1]
+                    ECG[rows, 2 + i] = _data_[k][idx0, 2]
             idx = ECG[:, 2:] >= ECG_UPPER_RAIL
             ECG[:, 2:][idx] = ECG_MISSING_DATA
             idx = ECG[:, 2:] <= ECG_LOWER_RAIL
@@ -239,12 +236,12 @@ def preprocess_scg(data):
     min_sn = data["SCG"][:, 0].min()
     max_sn = data["SCG"][:, 0].max()
 
-    SCG = np.ones((int(max_sn - min_sn + 1), data["SCG"].shape[1])) * np.nan
+    SCG = np.full((int(max_sn - min_sn + 1), data["SCG"].shape[1]), np.nan)
     SCG[:, 0] = np.arange(min_sn, max_sn + 1)
-    idx = np.in1d(SCG[:, 0], data["SCG"][:, 0])
-    if np.sum(idx) > 0:
+    rows, idx = sn_offsets(data["SCG"][:, 0], min_sn)
+    if rows.shape[0] > 0:
         for i in range(1, SCG.shape[1]):
-            SCG[idx, i] = data["SCG"][:, i]
+            SCG[rows, i] = data["SCG"][idx, i]
             SCG[np.isnan(SCG[:, i]), i] = SCG_MISSING_DATA
     idx = np.isnan(SCG[:, 1])
     if np.sum(idx) > 0:
@@ -260,12 +257,12 @@ def preprocess_pres(data):
     min_sn = data["PRES"][:, 0].min()
     max_sn = data["PRES"][:, 0].max()
 
-    PRES = np.ones((int(max_sn - min_sn + 1), data["PRES"].shape[1])) * np.nan
+    PRES = np.full((int(max_sn - min_sn + 1), data["PRES"].shape[1]), np.nan)
     PRES[:, 0] = np.arange(min_sn, max_sn + 1)
-    idx = np.in1d(PRES[:, 0], data["PRES"][:, 0])
-    if np.sum(idx) > 0:
+    rows, idx = sn_offsets(data["PRES"][:, 0], min_sn)
+    if rows.shape[0] > 0:
         for i in range(1, PRES.shape[1]):
-            PRES[idx, i] = data["PRES"][:, i]
+            PRES[rows, i] = data["PRES"][idx, i]
             PRES[np.isnan(PRES[:, i]), i] = PRES_MISSING_DATA
     idx = np.isnan(PRES[:, 1])
     if np.sum(idx) > 0:
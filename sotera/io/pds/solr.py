@@ -11,11 +11,12 @@ import sqlite3
 import aiosqlite
 import time
 import contextlib
-from numpy import array, interp
+from numpy import array, zeros, ones, flatnonzero
 from intervaltree.interval import Interval
 from io import BytesIO
 from binascii import a2b_base64
 from sotera.io import visi
+from sotera.io.timesync import TimeIndex
 from sotera.util.time import get_timestamp
 
 logger = logging.getLogger(__name__)
@@ -336,7 +337,7 @@ async def aio_retrieve_session_logs(session, pds, export_path):
     return log_cachedb
 
 
-def spool_raw_from_logdb(cursor, session, timesyncs):
+def spool_raw_from_logdb(cursor, session, timesyncs, batch_size=10000):
     sql_ = f"""SELECT DISTINCT id, sn, tm, device, segment, raw
                  FROM packets
                 WHERE device  = {session['deviceID']}
@@ -344,14 +345,24 @@ def spool_raw_from_logdb(cursor, session, timesyncs):
                       AND tm <= {session['t1']}
              ORDER BY tm, sn """
     cursor.execute(sql_)
-    for id, _sn, tm, device, _segment, raw in cursor:
-        sn = None
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        tm = array([row[2] for row in rows], dtype=float)
+        sn = zeros(tm.shape, dtype=int)
+        segments = [None] * len(rows)
+        todo = ones(tm.shape, dtype=bool)
         for v in timesyncs.values():
-            if v["interval"].contains_point(tm):
-                sn = int(interp(tm, v["array"][:, 1], v["array"][:, 0]))
-                break
-        if sn is not None:
-            yield id, sn, tm, device, v["segment"], raw
+            # first segment whose time syncs contain the packet time
+            i = todo & (tm >= v["interval"].begin) & (tm < v["interval"].end)
+            if i.any():
+                sn[i] = v["index"].to_sn(tm[i])
+                for j in flatnonzero(i):
+                    segments[j] = v["segment"]
+                todo &= ~i
+        for j, (id, _sn, tm_, device, _segment, raw) in enumerate(rows):
+            if segments[j] is not None:
+                yield id, int(sn[j]), tm_, device, segments[j], raw
+        rows = cursor.fetchmany(batch_size)
 
 
 async def make_timestamp_mapping(sqlite_, session):
@@ -375,6 +386,7 @@ async def make_timestamp_mapping(sqlite_, session):
             "array": tmp,
             "segment": seg,
             "interval": Interval(tmp[0, 1], tmp[-1, 1]),
+            "index": TimeIndex(tmp),
         }
 
     return timesyncs, device_id
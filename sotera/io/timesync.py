@@ -0,0 +1,90 @@
+"""Sequence number <-> unix time mapping from TIME_SYNC packets.
+
+A TimeIndex is built once from the [sn, time, ...] rows of a TIME_SYNC array
+and maps whole vectors of sequence numbers to times and back with a single
+searchsorted and a linear interpolation between the time syncs. Outside the
+time syncs the device runs at 500 sequence numbers per second.
+"""
+import numpy as np
+
+SN_RATE = 500.0  # sequence numbers per second
+
+
+def _slopes(xp, fp):
+    # repeated breakpoints get a flat segment, as np.interp does
+    dx = np.diff(xp)
+    return np.where(dx != 0, np.diff(fp) / np.where(dx != 0, dx, 1), 0.0)
+
+
+def _interp(x, xp, fp, slopes, edge_slope=None):
+    """np.interp(x, xp, fp) with precomputed segment slopes. With edge_slope,
+    points outside the breakpoints are extrapolated at that slope instead of
+    clamped."""
+    x = np.asarray(x)
+    xc = np.clip(x, xp[0], xp[-1])
+    i = np.clip(np.searchsorted(xp, xc, side="right") - 1, 0, len(slopes) - 1)
+    out = fp[i] + (xc - xp[i]) * slopes[i]
+    if edge_slope is not None:
+        out = out + (x - xc) * edge_slope
+    return out[()] if out.ndim == 0 else out
+
+
+class TimeIndex:
+    """Breakpoints of the sn -> time mapping of one segment.
+
+    If the last time sync has a lower sequence number than the first, the
+    device was reset or swapped and that time sync belongs to the next
+    segment, so it is dropped. The breakpoints are extended to sn0 and sn1
+    at SN_RATE when they fall outside the time syncs.
+    """
+
+    def __init__(self, time_sync, sn0=None, sn1=None):
+        TS = np.asarray(time_sync)
+        if TS.ndim != 2 or TS.shape[0] == 0:
+            raise ValueError("TimeIndex: no time sync available")
+        if TS.shape[0] > 1 and TS[-1, 0] < TS[0, 0]:
+            TS = TS[:-1, :]
+        sqnums = TS[:, 0].astype(float)
+        times = TS[:, 1].astype(float)
+        if sn1 is not None and sn1 > sqnums[-1]:
+            times = np.r_[times, times[-1] + (sn1 - sqnums[-1]) / SN_RATE]
+            sqnums = np.r_[sqnums, sn1]
+        if sn0 is not None and sn0 < sqnums[0]:
+            times = np.r_[times[0] + (sn0 - sqnums[0]) / SN_RATE, times]
+            sqnums = np.r_[sn0, sqnums]
+        self.sqnums = sqnums
+        self.times = times
+        if sqnums.shape[0] > 1:
+            self._time_slopes = _slopes(sqnums, times)
+            self._sn_slopes = _slopes(times, sqnums)
+        else:
+            self._time_slopes = self._sn_slopes = np.zeros((1,))
+
+    @classmethod
+    def from_spans(cls, time_sync, spans=()):
+        """Index covering the (first, last) sequence number `spans` of the
+        arrays of a block."""
+        sn0 = sn1 = None
+        for first, last in spans:
+            sn0 = first if sn0 is None or first < sn0 else sn0
+            sn1 = last if sn1 is None or last > sn1 else sn1
+        return cls(time_sync, sn0, sn1)
+
+    @property
+    def t0(self):
+        return self.times[0]
+
+    @property
+    def t1(self):
+        return self.times[-1]
+
+    def to_time(self, sn, extrapolate=False):
+        """Unix times of the sequence numbers `sn`; outside the breakpoints
+        they are clamped, or extrapolated at SN_RATE with extrapolate."""
+        edge = 1.0 / SN_RATE if extrapolate else None
+        return _interp(sn, self.sqnums, self.times, self._time_slopes, edge)
+
+    def to_sn(self, t, extrapolate=False):
+        """Sequence numbers (not rounded) at the unix times `t`."""
+        edge = SN_RATE if extrapolate else None
+        return _interp(t, self.times, self.sqnums, self._sn_slopes, edge)
@@ -1,4 +1,5 @@
 import os
+import mmap
 import logging
 
 logger = logging.getLogger(__name__)
@@ -91,3 +92,56 @@ class VisiChunker:
         self._next_chunk(get_next=False)
         if self.fp:
             self.fp.close()
+
+
+class VisiChunkReader:
+    """Read only, memory mapped access to a .vchk chunk file.
+
+    `view` is a memoryview over the mapped file, slicing it does not copy.
+    Any slices handed out must be released before close() is called.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, "rb")
+        self.mm = None
+        if os.fstat(self.fp.fileno()).st_size > 0:
+            self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mm)
+        else:
+            self.view = memoryview(b"")
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, key):
+        return self.view[key]
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except BufferError:
+            # the traceback still holds arrays over the view; leave the map to
+            # be closed when they are collected so the original error is raised
+            self.view = None
+            self.mm = None
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
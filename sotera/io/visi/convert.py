@@ -1,13 +1,17 @@
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
 import logging
 from datetime import datetime
 from . import packet_map, analytics_map
 from . import packets
 from . import logs
+from .chunks import VisiChunkReader
 from .constants import k_ppg_dc, k_ppg_filt, k_ecg, k_ip, k_ambient, replace_constants
-from ..local import optimize
+from ..local import optimize, iter_optimized, sn_offsets, BlockWriter
+from ..timesync import TimeIndex
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +35,99 @@ def is_analytics_with_sn(k):
     return k in (("SPO2_CTRL2", 99),)
 
 
+class ArrayBuffer:
+    """Growable 2-d array of a fixed dtype.
+
+    Rows are appended in place and the capacity doubles whenever it runs
+    out. Storage is allocated on the first append, once the number of
+    columns is known. np.asarray(buffer) returns the filled rows.
+    """
+
+    # finalize() copies the filled rows out when more than this fraction of
+    # the capacity is spare, otherwise it returns a view of them
+    SHRINK_SPARE = 0.25
+
+    def __init__(self, dtype=np.float64, capacity=1024):
+        self.dtype = np.dtype(dtype)
+        self.capacity = max(int(capacity), 1)
+        self.arr = None
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __array__(self, dtype=None, copy=None):
+        if self.arr is None:
+            arr = np.empty((0, 0), dtype=self.dtype)
+        else:
+            arr = self.arr[: self.n]
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    def _reserve(self, n, ncols):
+        if self.arr is None:
+            self.capacity = max(self.capacity, n)
+            self.arr = np.empty((self.capacity, ncols), dtype=self.dtype)
+        elif self.n + n > self.arr.shape[0]:
+            capacity = self.arr.shape[0]
+            while capacity < self.n + n:
+                capacity *= 2
+            arr = np.empty((capacity, self.arr.shape[1]), dtype=self.dtype)
+            arr[: self.n] = self.arr[: self.n]
+            self.arr = arr
+
+    def append(self, row):
+        self._reserve(1, len(row))
+        self.arr[self.n] = row
+        self.n += 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows)
+        if rows.shape[0] == 0:
+            return
+        self._reserve(rows.shape[0], rows.shape[1])
+        self.arr[self.n : self.n + rows.shape[0]] = rows  # noqa: E203
+        self.n += rows.shape[0]
+
+    def finalize(self):
+        """Return the filled rows and reset the buffer.
+
+        A full buffer is returned as is. Otherwise the rows are copied out,
+        releasing the storage, only if more than SHRINK_SPARE of it is
+        spare; with less the result is a view that keeps the spare rows
+        allocated, which is cheaper than doubling peak memory with a copy.
+        """
+        arr, n = self.arr, self.n
+        self.arr = None
+        self.n = 0
+        if arr is None:
+            return np.empty((0, 0), dtype=self.dtype)
+        if n == arr.shape[0]:
+            return arr
+        if arr.shape[0] - n > self.SHRINK_SPARE * arr.shape[0]:
+            return arr[:n].copy()
+        return arr[:n]
+
+
+def _capacity_hint(blockmap, spec):
+    """Rows to reserve for the packets of `spec` in a block.
+
+    The chunk byte counts bound the number of packets of any one id; for
+    waveforms the sequence number span of the block gives a tighter bound.
+    """
+    default = 1024
+    if blockmap is None or spec.get("size", 0) == 0:
+        return default
+    nbytes = sum(c.get("size", 0) for c in blockmap["chunks"])
+    if nbytes == 0:
+        return default
+    hint = nbytes // spec["size"] + 1
+    if "waveform" in spec.keys() and "rows" in spec["waveform"].keys():
+        sn_per_packet = spec["waveform"]["rows"] * 500 / spec["waveform"]["sf"]
+        span = int(blockmap["max_sn"]) - int(blockmap["min_sn"]) + 1
+        return min(hint, int(span / sn_per_packet) + 2)
+    return min(hint, 4 * default)
+
+
 def data_initialize():
     data = {
         "packet_counts": {},
@@ -53,31 +150,38 @@ def data_initialize():
     return data
 
 
-def data_populate_for_conversion(data):
+def data_populate_for_conversion(data, blockmap=None):
     for spec in packet_map.values():
         if "array" in spec.keys():
             is_waveform = "waveform" in spec.keys()
             key = (spec["array"], spec["id"])
-            data[key] = []
-            if is_waveform:
-                data["_sn"][key] = []
+            capacity = _capacity_hint(blockmap, spec)
+            if key == ("LOGS", 42):
+                data[key] = []
+            elif is_waveform:
+                # waveform samples are at most 32 bit integers
+                data[key] = ArrayBuffer(np.int32, capacity)
+                # (sn, samples per packet, rows) per packet
+                data["_sn"][key] = ArrayBuffer(np.float64, capacity)
+            else:
+                data[key] = ArrayBuffer(np.float64, capacity)
     for spec in analytics_map.values():
         if "array" in spec.keys():
             key = (spec["array"], spec["id"])
-            data[key] = []
+            data[key] = ArrayBuffer(np.float64)
     return data
 
 
 def _data_consume_waveform_v0(sn, data, content, key, spp, rows):
-    data["_sn"][key].append(sn + np.arange(start=0, stop=rows * spp, step=spp))
-    data[key].append(list(content[2:]))
+    data["_sn"][key].append((sn, spp, rows))
+    data[key].append(content[2:])
 
 
 def _data_consume_waveform_v1(sn, data, content, key, spp, rows):
     if content[2] > 0:
         spp = (500 * rows) / content[2]
-    data["_sn"][key].append(sn + np.arange(start=0, stop=rows * spp, step=spp))
-    data[key].append(list(content[4:]))
+    data["_sn"][key].append((sn, spp, rows))
+    data[key].append(content[4:])
 
 
 def _data_consume_waveform_v2(sn, data, content, key, id_):
@@ -86,10 +190,10 @@ def _data_consume_waveform_v2(sn, data, content, key, id_):
         header[4] / packet_map[id_]["waveform"]["channels"]
     )
     packet_map[id_]["waveform"]["sf"] = header[3]
-    spp = 500 / header[3]
-    stop = header[4] * spp / packet_map[id_]["waveform"]["channels"]
-    data["_sn"][key].append(sn + np.arange(start=0, stop=stop, step=spp))
-    data[key].append(list(samples))
+    channels = packet_map[id_]["waveform"]["channels"]
+    data["_sn"][key].append((sn, 500 / header[3], header[4] // channels))
+    # numsamp may change between packets, so keep samples one row per sample
+    data[key].extend(np.reshape(samples, (-1, channels)))
 
 
 def _data_consume_numeric(sn, data, content, key):
@@ -166,6 +270,62 @@ def _init_data_consume_func_dict():
     return dict_
 
 
+def _bulk_fields(arr, start, stop=None):
+    names = arr.dtype.names[1:]
+    return structured_to_unstructured(arr[list(names[start:stop])])
+
+
+def _data_bulk_consume_waveform_v0(arr, data, key, spp, rows):
+    data["_sn"][key].extend(np.c_[arr["f1"], np.full((len(arr), 2), (spp, rows))])
+    data[key].extend(_bulk_fields(arr, 2))
+
+
+def _data_bulk_consume_waveform_v1(arr, data, key, spp, rows):
+    spp_ = np.where(arr["f2"] > 0, (500 * rows) / np.maximum(arr["f2"], 1), spp)
+    data["_sn"][key].extend(np.c_[arr["f1"], spp_, np.full(len(arr), rows)])
+    data[key].extend(_bulk_fields(arr, 4))
+
+
+def _data_bulk_consume_numeric(arr, data, key):
+    data[key].extend(_bulk_fields(arr, 0))
+
+
+def _data_bulk_consume_pass_thru_numeric(arr, data, key):
+    data[key].extend(np.delete(_bulk_fields(arr, 0), 2, 1))
+
+
+def _data_bulk_consume_timesync(arr, data, key):
+    data[key].extend(np.c_[arr["f0"], arr["f1"], arr["f2"], arr["f1"]])
+
+
+def _init_data_bulk_consume_func_dict():
+    """Consumers for whole structured arrays from packets.decode_chunk. They
+    append exactly what the per packet consumers would have."""
+    dict_ = {}
+    for id_ in packets.bulk_dtypes:
+        spec = packet_map[id_]
+        if "array" in spec.keys():
+            key = (spec["array"], spec["id"])
+            if "waveform" in spec.keys():
+                rows = spec["waveform"]["rows"]
+                spp = 500 / spec["waveform"]["sf"]
+                if spec["waveform"]["version"] == 0:
+                    dict_[id_] = partial(
+                        _data_bulk_consume_waveform_v0, key=key, spp=spp, rows=rows
+                    )
+                elif spec["waveform"]["version"] == 1:
+                    dict_[id_] = partial(
+                        _data_bulk_consume_waveform_v1, key=key, spp=spp, rows=rows
+                    )
+            elif id_ == 4:  # time sycn
+                dict_[id_] = partial(_data_bulk_consume_timesync, key=key)
+            elif 2999 < id_ < 4000:
+                dict_[id_] = partial(_data_bulk_consume_pass_thru_numeric, key=key)
+            else:
+                dict_[id_] = partial(_data_bulk_consume_numeric, key=key)
+    return dict_
+
+
 def data_consume_packet(data, pid, content):
     try:
         data["packet_counts"][pid] += 1
@@ -173,25 +333,32 @@ def data_consume_packet(data, pid, content):
         data["packet_counts"][pid] = 1
 
 
+def _expand_waveform_sn(packet_sn):
+    """Per sample sequence numbers from (sn, spp, rows) rows, one per packet."""
+    sn, spp, rows = packet_sn[:, 0], packet_sn[:, 1], packet_sn[:, 2].astype(np.int64)
+    if rows.min() == rows.max():
+        return (sn[:, None] + np.arange(rows[0]) * spp[:, None]).ravel()
+    # variable number of samples per packet
+    step = np.arange(rows.sum()) - np.repeat(np.cumsum(rows) - rows, rows)
+    return np.repeat(sn, rows) + step * np.repeat(spp, rows)
+
+
 def _data_reshape_waveform(data, key, rows, channels):
     logger.info(f"data reshape waveform {key}")
-    tmp = data["_sn"][key]
-    tmp = np.array(tmp, dtype="<f8").astype(np.int32)
-    tmp = tmp.reshape((tmp.shape[0] * tmp.shape[1],))
-    data[key] = np.array(data[key], dtype="<f8")
+    tmp = _expand_waveform_sn(data["_sn"][key].finalize()).astype(np.int32)
+    samples = data[key].finalize()
     # reshape data array
-    if channels > 1:
-        length = int(data[key].shape[0] * rows)
-        data[key] = data[key].reshape((length, channels))
-    else:
-        data[key] = data[key].reshape((data[key].shape[0] * data[key].shape[1],))
+    samples = samples.reshape((-1, channels))
     # merge sequence number, time, and data vectors
-    data[key] = np.c_[tmp, np.zeros_like(tmp), data[key]]
+    data[key] = np.empty((tmp.shape[0], channels + 2), dtype="<f8")
+    data[key][:, 0] = tmp
+    data[key][:, 1] = 0
+    data[key][:, 2:] = samples
 
 
 def _data_reshape_misc(data, key):
     logger.info(f"data reshape misc {key}")
-    data[key] = np.array(data[key], dtype="<f8")
+    data[key] = data[key].finalize().astype("<f8", copy=False)
     tmp = data[key][:, 1].copy()
     data[key][:, 1] = data[key][:, 0]
     data[key][:, 0] = tmp
@@ -205,7 +372,7 @@ def _data_reshape_logs(data, key):
 
 def _data_reshape_analytics(data, key):
     logger.info(f"data reshape analytics {key}")
-    data[key] = np.array(data[key], dtype="<f8")
+    data[key] = data[key].finalize().astype("<f8", copy=False)
     data[key] = np.c_[np.zeros((data[key].shape[0],)), data[key]]
 
 
@@ -311,35 +478,16 @@ def data_finalize_merge_pres_waveforms(data):
     except KeyError:
         return
 
-    min_sqn = min(
-        OSC[0, 0].astype(np.int32), P1[0, 0].astype(np.int32), P2[0, 0].astype(np.int32)
-    )
-    max_sqn = max(
-        OSC[-1, 0].astype(np.int32),
-        P1[-1, 0].astype(np.int32),
-        P2[-1, 0].astype(np.int32),
-    )
+    min_sqn = int(min(OSC[:, 0].min(), P1[:, 0].min(), P2[:, 0].min()))
+    max_sqn = int(max(OSC[:, 0].max(), P1[:, 0].max(), P2[:, 0].max()))
 
     PRES = -1 * np.ones((max_sqn - min_sqn + 1, 5))
     PRES[:, 0] = np.arange(min_sqn, max_sqn + 1)
 
-    vals, i = np.unique(OSC[:, 0], return_index=True)  # remove dups
-    OSC = OSC[i, :]
-    i = np.in1d(PRES[:, 0], OSC[:, 0])
-    PRES[i, 1] = OSC[:, 1]
-    PRES[i, 2] = OSC[:, 2]
-
-    vals, i = np.unique(P1[:, 0], return_index=True)  # remove dups
-    P1 = P1[i, :]
-    i = np.in1d(PRES[:, 0], P1[:, 0])
-    PRES[i, 1] = P1[:, 1]
-    PRES[i, 3] = P1[:, 2]
-
-    vals, i = np.unique(P2[:, 0], return_index=True)  # remove dups
-    P2 = P2[i, :]
-    i = np.in1d(PRES[:, 0], P2[:, 0])
-    PRES[i, 1] = P2[:, 1]
-    PRES[i, 4] = P2[:, 2]
+    for arr, c in ((OSC, 2), (P1, 3), (P2, 4)):
+        rows, i = sn_offsets(arr[:, 0], min_sqn)  # remove dups
+        PRES[rows, 1] = arr[i, 1]
+        PRES[rows, c] = arr[i, 2]
 
     i = (
         (PRES[:, 1] == -1)
@@ -362,6 +510,13 @@ def data_finalize_replace_values(data):
             data[key] = replace_constants(data[key], (2, 3, 4))
 
 
+def sort_rows(arr, col):
+    """Rows of `arr` ordered on column `col`; sorted arrays are returned as is."""
+    if np.all(arr[1:, col] >= arr[:-1, col]):
+        return arr
+    return arr[np.argsort(arr[:, col], kind="stable"), :]
+
+
 def data_finalize_time_conversions(data, min_sn, max_sn, time_sync=None):
     """Creating time vectors"""
     # re-arrange TIME_SYNC columns
@@ -393,8 +548,7 @@ def data_finalize_time_conversions(data, min_sn, max_sn, time_sync=None):
             tmp[:, 0] = data[k][:, 2]
             tmp[:, 2:] = data[k][:, 3:]
             data[k] = tmp
-            idx = np.argsort(data[k][:, 0])  # sort on sequence numbers
-            data[k] = data[k][idx, :]  # in the block
+            data[k] = sort_rows(data[k], 0)  # sort on sequence numbers in the block
             idx = data[k][:, 0] > 0
             data[k] = data[k][idx, :]  # exclude bad sqn
             if data[k].shape[0] > 1:
@@ -404,15 +558,13 @@ def data_finalize_time_conversions(data, min_sn, max_sn, time_sync=None):
 
         elif is_analytics(k):
             logger.debug("Finalizing time for ANALYTICS {}".format(k))
-            idx = np.argsort(data[k][:, 1])  # sort on timestamps
-            data[k] = data[k][idx, :]  # in the block
+            data[k] = sort_rows(data[k], 1)  # sort on timestamps in the block
 
         # scan the rest of the arrays for sequence numbers before and after
         # the time-sync packets first and last
         elif k != time_sync_key and data[k].shape[1] > 1:
             logger.debug("Finalizing time for {}".format(k))
-            idx = np.argsort(data[k][:, 0])  # sort on sequence numbers
-            data[k] = data[k][idx, :]  # in the block
+            data[k] = sort_rows(data[k], 0)  # sort on sequence numbers in the block
             idx = data[k][:, 0] > 0
             data[k] = data[k][idx, :]  # exclude bad sqn
             if data[k].shape[0] > 1:
@@ -432,26 +584,16 @@ def data_finalize_time_conversions(data, min_sn, max_sn, time_sync=None):
     if sqnN > max_sn:
         max_sn = sqnN
 
-    # create a time sync array augmented for any sequence number that fall before
-    # time <-> sqn mapping using time syncs and
-    if max_sn > tsync[-1, 0]:
-        # tack on extra points to time
-        times = np.r_[tsync[:, 1], tsync[-1, 1] + 2 * (max_sn - tsync[-1, 0]) / 1000.0]
-        sqnums = np.r_[tsync[:, 0], max_sn]
-    else:
-        times = tsync[:, 1].copy()
-        sqnums = tsync[:, 0].copy()
-
-    if min_sn < tsync[0, 0]:
-        times = np.r_[tsync[0, 1] + 2 * (min_sn - tsync[0, 0]) / 1000.0, times]
-        sqnums = np.r_[min_sn, sqnums]
+    # time <-> sqn mapping using time syncs, extended to cover any sequence
+    # numbers that fall before or after them
+    index = TimeIndex(tsync, min_sn, max_sn)
 
     for k in data.keys():
         if not_array(k):
             continue
         if is_analytics(k) and data[k].shape[1] > 1:
-            tm = data[k][:, 1].astype(float) / 1000.0
-            sn = np.round(np.interp(tm, times, sqnums)).astype(int)
+            tm = data[k][:, 1] / 1000.0
+            sn = np.round(index.to_sn(tm)).astype(int)
             data[k][:, 0] = sn
             data[k][:, 1] = tm
             # get rid of rows outsite the time range of this block
@@ -459,12 +601,12 @@ def data_finalize_time_conversions(data, min_sn, max_sn, time_sync=None):
         elif is_analytics_with_sn(k) and data[k].shape[1] > 1:
             # get rid of rows outsite the time range of this block
             sn = data[k][:, 0]
-            data[k][:, 1] = np.interp(data[k][:, 0], sqnums, times)
+            data[k][:, 1] = index.to_time(sn)
             data[k] = data[k][(sn >= min_sn) * (sn <= max_sn), :]
 
         elif k != time_sync_key and data[k].shape[1] > 1:
-            data[k][:, 1] = np.interp(data[k][:, 0], sqnums, times)
-    return times[0], times[-1]
+            data[k][:, 1] = index.to_time(data[k][:, 0])
+    return index.t0, index.t1
 
 
 def data_finalize_fake_time(data, min_sn, max_sn):
@@ -518,38 +660,157 @@ def packet_ok(pid, sn, device, min_sn, max_sn):
     return False
 
 
-def convert_block(
-    blockmap, time_sync=None, do_optimize=True, chunk_path=None, blocknum=-1
-):
+def _consume_chunk_bulk(buf, data, devices, min_sn, max_sn, consume, bulk_consume):
+    fixed, variable = packets.decode_chunk(buf)
+    first_seen = {}
+    for pid, (offsets, arr) in fixed.items():
+        sn = arr["f1"]
+        idx = (sn >= min_sn) * (sn <= max_sn)
+        if pid in bulk_consume.keys() and np.sum(idx) > 0:
+            bulk_consume[pid](arr[idx], data)
+        device = arr["f0"] >> 8
+        vals, first, counts = np.unique(device, return_index=True, return_counts=True)
+        for d, i, c in zip(vals.tolist(), first.tolist(), counts.tolist()):
+            if d:
+                seen = first_seen.setdefault(d, [offsets[i], 0])
+                seen[0] = min(seen[0], offsets[i])
+                seen[1] += c
+
+    for offset, (pid, sn, tm, device, segment, content, string) in variable:
+        if packet_ok(pid, sn, device, min_sn, max_sn):
+            try:
+                func = consume[pid]
+            except KeyError:
+                pass
+            else:
+                if content is not None:
+                    func(sn if sn is not None else tm, data, content)
+        if device:
+            seen = first_seen.setdefault(device, [offset, 0])
+            seen[0] = min(seen[0], offset)
+            seen[1] += 1
+
+    # keep devices in the order they first appear in the stream
+    for device, (offset, count) in sorted(first_seen.items(), key=lambda x: x[1][0]):
+        try:
+            devices[device] += count
+        except KeyError:
+            devices[device] = count
+
+
+def _consume_chunk(fn, data, devices, min_sn, max_sn, consume, bulk_consume, bulk):
+    if bulk:
+        with VisiChunkReader(fn) as chunk_reader:
+            _consume_chunk_bulk(
+                chunk_reader.view, data, devices, min_sn, max_sn, consume, bulk_consume
+            )
+        return
+    with open(fn, "rb") as fp:
+        for (
+            pid,
+            sn,
+            tm,
+            device,
+            segment,
+            content,
+            string,
+        ) in packets.spool_packets(fp, keep_string=False):
+            if packet_ok(pid, sn, device, min_sn, max_sn):
+                try:
+                    func = consume[pid]
+                except KeyError:
+                    pass
+                else:
+                    if content is not None:
+                        func(sn if sn is not None else tm, data, content)
+            if device:
+                try:
+                    devices[device] += 1
+                except KeyError:
+                    devices[device] = 1
+
+
+def _decode_chunk_partial(fn, min_sn, max_sn, bulk=True):
+    """Decode a single chunk in a worker process.
+
+    Returns the compact per key arrays and sequence numbers, the metadata
+    and v2 waveform layouts set by the chunk's packets, and the devices seen.
+    """
+    data = data_populate_for_conversion(data_initialize())
+    data["__meta__"] = {}
+    devices = {}
+    _consume_chunk(
+        fn,
+        data,
+        devices,
+        min_sn,
+        max_sn,
+        _init_data_consume_func_dict(),
+        _init_data_bulk_consume_func_dict(),
+        bulk,
+    )
+    arrays = {}
+    for key in data.keys():
+        if type(key) == tuple and len(data[key]) > 0:
+            arrays[key] = (
+                data[key] if type(data[key]) == list else np.asarray(data[key]).copy()
+            )
+    sn = {key: np.asarray(buf).copy() for key, buf in data["_sn"].items() if len(buf)}
+    # v2 waveform layouts are discovered from the packets themselves
+    waveforms = {
+        key[1]: packet_map[key[1]]["waveform"]
+        for key in sn.keys()
+        if packet_map[key[1]]["waveform"]["version"] == 2
+    }
+    return arrays, sn, data["__meta__"], waveforms, devices
+
+
+def _merge_chunk_partial(data, devices, partial_):
+    arrays, sn, meta, waveforms, chunk_devices = partial_
+    for key, arr in arrays.items():
+        data[key].extend(arr)
+    for key, arr in sn.items():
+        data["_sn"][key].extend(arr)
+    data["__meta__"].update(meta)
+    for id_, waveform in waveforms.items():
+        packet_map[id_]["waveform"].update(waveform)
+    for device, count in chunk_devices.items():
+        try:
+            devices[device] += count
+        except KeyError:
+            devices[device] = count
+
+
+def _convert_block_data(blockmap, time_sync, chunk_path, blocknum, bulk, workers):
     data_consume_function_dict = _init_data_consume_func_dict()
+    data_bulk_consume_function_dict = _init_data_bulk_consume_func_dict()
     data = data_initialize()
-    data = data_populate_for_conversion(data)
+    data = data_populate_for_conversion(data, blockmap)
     max_sn = int(blockmap["max_sn"])
     min_sn = 0 if blocknum == 0 else int(blockmap["min_sn"])
     devices = {}
-    for chunk in blockmap["chunks"]:
-        fn = (
-            chunk["file"]
-            if chunk_path is None
-            else os.path.join(chunk_path, chunk["file"])
-        )
-        with open(fn, "rb") as fp:
-            for pid, sn, tm, device, segment, content, string in packets.spool_packets(
-                fp
-            ):
-                if packet_ok(pid, sn, device, min_sn, max_sn):
-                    try:
-                        func = data_consume_function_dict[pid]
-                    except KeyError:
-                        pass
-                    else:
-                        if content is not None:
-                            func(sn if sn is not None else tm, data, content)
-                if device:
-                    try:
-                        devices[device] += 1
-                    except KeyError:
-                        devices[device] = 1
+    fns = [
+        chunk["file"] if chunk_path is None else os.path.join(chunk_path, chunk["file"])
+        for chunk in blockmap["chunks"]
+    ]
+    if workers is not None and workers > 1 and len(fns) > 1:
+        # decode chunks in parallel, merge them back in blockmap order
+        decode = partial(_decode_chunk_partial, min_sn=min_sn, max_sn=max_sn, bulk=bulk)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for partial_ in pool.map(decode, fns):
+                _merge_chunk_partial(data, devices, partial_)
+    else:
+        for fn in fns:
+            _consume_chunk(
+                fn,
+                data,
+                devices,
+                min_sn,
+                max_sn,
+                data_consume_function_dict,
+                data_bulk_consume_function_dict,
+                bulk,
+            )
 
     data_finalize_reshape(data)
     data_finalize_unmangle_ecg_waveforms(data)
@@ -573,7 +834,66 @@ def convert_block(
         del data["_sn"]
     data = data_finalize_array_names(data)
     data = data_finalize_meta_data(data, min_time, max_time, devices)
+    return data
+
+
+def convert_block(
+    blockmap,
+    time_sync=None,
+    do_optimize=True,
+    chunk_path=None,
+    blocknum=-1,
+    bulk=True,
+    workers=None,
+):
+    """Convert the chunks of a block into arrays.
+
+    With workers > 1 the chunks are decoded in a pool of that many processes.
+    """
+    data = _convert_block_data(
+        blockmap, time_sync, chunk_path, blocknum, bulk, workers
+    )
     if do_optimize:
         data = optimize(data)
 
     return data
+
+
+def convert_block_to_folder(
+    blockmap,
+    folder,
+    time_sync=None,
+    do_optimize=True,
+    chunk_path=None,
+    blocknum=-1,
+    bulk=True,
+    use_compression=True,
+    metafn="meta.json",
+    workers=None,
+    codec=None,
+    frame_sn=None,
+):
+    """Convert a block and save it to `folder`, like convert_block followed by
+    save_block.
+
+    Each array is handed to a background writer as soon as it is final and
+    dropped from memory, so compression overlaps with optimizing the rest
+    of the block. Arrays are compressed with `codec` (see sotera.io.codecs)
+    and, given `frame_sn`, waveforms are saved seekable (see sotera.io.frames).
+    Returns the list of files written and the block metadata.
+    """
+    data = _convert_block_data(
+        blockmap, time_sync, chunk_path, blocknum, bulk, workers
+    )
+    if do_optimize:
+        arrays = iter_optimized(data)
+    else:
+        arrays = ((k, data.pop(k)) for k in list(data.keys()) if k != "__meta__")
+    with BlockWriter(
+        folder, use_compression=use_compression, codec=codec, frame_sn=frame_sn
+    ) as writer:
+        for name, arr in arrays:
+            writer.write(name, arr)
+            del arr
+        fn_list = writer.close(data["__meta__"], metafn=metafn)
+    return fn_list, data["__meta__"]
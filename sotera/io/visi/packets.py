@@ -1,8 +1,14 @@
+import re
 import logging
-from struct import unpack, error
+from struct import unpack, unpack_from, calcsize, error
 from . import packet_map, analytics_map
 from io import BytesIO
 
+try:
+    import numpy as np
+except ImportError:  # jython
+    np = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -10,7 +16,7 @@ def get_device_and_segment(val):
     return (int(val) >> 8, int(val) & 0xFF)
 
 
-def decode_packet(stream):
+def decode_packet(stream, keep_string=True):
     string = stream.read(2)
     if len(string) < 1:
         return 0, None, None, None, None, (None, None), string
@@ -23,11 +29,12 @@ def decode_packet(stream):
     device = None
     segment = None
     content = None
-    packet_string = string
+    packet_string = string if keep_string else None
 
     if packet_def["size"] > 0:  # this packet has a fixed size
         string = stream.read(packet_def["size"] - 2)
-        packet_string += string
+        if keep_string:
+            packet_string += string
         if "struct" in packet_def.keys():
             # this packets content can be decoded
             try:
@@ -41,18 +48,21 @@ def decode_packet(stream):
 
     elif packet_id == 42:  # log packet
         string = stream.read(packet_def["header"]["size"])
-        packet_string += string
+        if keep_string:
+            packet_string += string
         header = unpack(packet_def["header"]["struct"], string)
         device, segment = get_device_and_segment(header[1])
         tm = header[2]
         string = stream.read(header[4])
-        packet_string += string
+        if keep_string:
+            packet_string += string
         data = string.decode("utf-8").strip()
         content = (header, data)
 
     elif packet_id == 257:  # analytics data
         string = stream.read(2)
-        packet_string += string
+        if keep_string:
+            packet_string += string
         if len(string) < 1:
             logger.error("Packet type 257: too short to read total packet size")
             return 0, None, None, None, (None, None), string
@@ -62,7 +72,8 @@ def decode_packet(stream):
                 "Packet type 257: given packet size == {} too short".format(packet_size)
             )
             string = stream.read(packet_size - 4)
-            packet_string += string
+            if keep_string:
+                packet_string += string
             return (
                 257,
                 None,
@@ -73,7 +84,8 @@ def decode_packet(stream):
                 string,
             )
         string = stream.read(packet_def["header"]["size"])
-        packet_string += string
+        if keep_string:
+            packet_string += string
         header = unpack(packet_def["header"]["struct"], string)
         device, segment = get_device_and_segment(header[0])
         data_size = packet_size - packet_def["header"]["size"] - 4
@@ -83,7 +95,8 @@ def decode_packet(stream):
             log_def = analytics_map[header[2]]
             if data_size == log_def["size"]:
                 string = stream.read(log_def["size"])
-                packet_string += string
+                if keep_string:
+                    packet_string += string
                 data = unpack(log_def["struct"], string)
         if data is None:
             pass
@@ -93,12 +106,14 @@ def decode_packet(stream):
 
     elif "waveform" in packet_def.keys() and packet_def["waveform"]["version"] == 2:
         string = stream.read(13)
-        packet_string += string
+        if keep_string:
+            packet_string += string
         header = unpack("<H2IHB", string)
         device, segment = get_device_and_segment(header[1])
         sn = header[2]
         string = stream.read(header[0] - 15)
-        packet_string += string
+        if keep_string:
+            packet_string += string
         structdef = packet_def["struct"].format(numsamp=header[4])
         try:
             data = unpack(structdef, string)
@@ -111,27 +126,31 @@ def decode_packet(stream):
 
     elif packet_id == 184:  # ALARM_STATE_DATA2_TYPE (variable length packet)
         string = stream.read(packet_def["header"]["size"])
-        packet_string += string
+        if keep_string:
+            packet_string += string
         header = unpack(packet_def["header"]["struct"], string)
         device, segment = get_device_and_segment(header[1])
         sn = header[2]
         elements = []
         for k in range(header[6]):
             string = stream.read(8)
-            packet_string += string
+            if keep_string:
+                packet_string += string
             elements.append(unpack("<H2BI", string))
         content = (header, elements)
 
     elif packet_id == 186:  # ALARM_LIMITS2_TYPE (variable length packet)
         string = stream.read(packet_def["header"]["size"])
-        packet_string += string
+        if keep_string:
+            packet_string += string
         header = unpack(packet_def["header"]["struct"], string)
         device, segment = get_device_and_segment(header[1])
         sn = header[2]
         elements = []
         for k in range(header[3]):
             string = stream.read(4)
-            packet_string += string
+            if keep_string:
+                packet_string += string
             elements.append(unpack("<HH", string))
         content = (header, elements)
 
@@ -152,11 +171,179 @@ def decode_packet_from_raw(raw):
     return vals
 
 
-def spool_packets(stream):
+def spool_packets(stream, keep_string=True):
     packet_id = 1
     while packet_id:
         packet_id, sn, tm, device, segment, content, packet_string = decode_packet(
-            stream
+            stream, keep_string=keep_string
         )
         if packet_id > 0:
             yield packet_id, sn, tm, device, segment, content, packet_string
+
+
+_struct_item = re.compile(r"(\d*)([xcbB?hHiIlLqQefds])")
+_struct_codes = {
+    "c": "S1",
+    "b": "i1",
+    "B": "u1",
+    "?": "?",
+    "h": "<i2",
+    "H": "<u2",
+    "i": "<i4",
+    "I": "<u4",
+    "l": "<i4",
+    "L": "<u4",
+    "q": "<i8",
+    "Q": "<u8",
+    "e": "<f2",
+    "f": "<f4",
+    "d": "<f8",
+}
+
+
+def struct_dtype(fmt):
+    """Packed numpy dtype for a whole fixed size packet described by `fmt`.
+
+    The 2 byte packet id is field "pid", and field "f<n>" holds element n of
+    the tuple struct.unpack(fmt, ...) would return.
+    """
+    if fmt[0] not in "<=":
+        raise ValueError(f"only little-endian struct formats are supported: {fmt}")
+    names, formats, offsets = ["pid"], ["<u2"], [0]
+    offset = 2
+    for count, code in _struct_item.findall(fmt[1:]):
+        count = int(count) if count else 1
+        if code == "x":
+            offset += count
+        elif code == "s":
+            names.append(f"f{len(names) - 1}")
+            formats.append(f"S{count}")
+            offsets.append(offset)
+            offset += count
+        else:
+            for _ in range(count):
+                names.append(f"f{len(names) - 1}")
+                formats.append(_struct_codes[code])
+                offsets.append(offset)
+                offset += np.dtype(_struct_codes[code]).itemsize
+    return np.dtype(
+        {"names": names, "formats": formats, "offsets": offsets, "itemsize": offset}
+    )
+
+
+def _init_bulk_dtypes():
+    dtypes = {}
+    for id_, spec in packet_map.items():
+        if spec["size"] > 0 and "struct" in spec.keys():
+            if calcsize(spec["struct"]) + 2 != spec["size"]:
+                logger.warning(f"struct does not match size for packet {id_}")
+                continue
+            dtypes[id_] = struct_dtype(spec["struct"])
+    return dtypes
+
+
+_fixed_sizes = {k: v["size"] for k, v in packet_map.items() if v["size"] > 0}
+bulk_dtypes = _init_bulk_dtypes() if np is not None else {}
+
+
+def packet_length(buf, offset):
+    """Return (packet_id, length) of the packet starting at buf[offset]
+    without decoding its content. Lengths match what decode_packet consumes."""
+    packet_id = unpack_from("<H", buf, offset)[0]
+    try:
+        return packet_id, _fixed_sizes[packet_id]
+    except KeyError:
+        pass
+
+    packet_def = packet_map[packet_id]
+    if packet_id == 42:  # log packet
+        size = packet_def["header"]["size"]
+        header = unpack_from(packet_def["header"]["struct"], buf, offset + 2)
+        return packet_id, 2 + size + header[4]
+
+    elif packet_id == 257:  # analytics data
+        packet_size = unpack_from("<H", buf, offset + 2)[0]
+        if packet_size < 20:
+            return packet_id, packet_size
+        size = packet_def["header"]["size"]
+        header = unpack_from(packet_def["header"]["struct"], buf, offset + 4)
+        data_size = packet_size - size - 4
+        length = 4 + size
+        if header[2] in analytics_map.keys():
+            if data_size == analytics_map[header[2]]["size"]:
+                length += data_size
+        return packet_id, length
+
+    elif "waveform" in packet_def.keys() and packet_def["waveform"]["version"] == 2:
+        return packet_id, unpack_from("<H", buf, offset + 2)[0]
+
+    elif packet_id == 184:  # ALARM_STATE_DATA2_TYPE (variable length packet)
+        size = packet_def["header"]["size"]
+        header = unpack_from(packet_def["header"]["struct"], buf, offset + 2)
+        return packet_id, 2 + size + 8 * header[6]
+
+    elif packet_id == 186:  # ALARM_LIMITS2_TYPE (variable length packet)
+        size = packet_def["header"]["size"]
+        header = unpack_from(packet_def["header"]["struct"], buf, offset + 2)
+        return packet_id, 2 + size + 4 * header[3]
+
+    return packet_id, 2
+
+
+def index_packets(buf):
+    """Single pass over a chunk buffer to find packet boundaries.
+
+    Returns arrays of packet ids, offsets and lengths in stream order.
+    """
+    ids = []
+    offsets = []
+    lengths = []
+    offset = 0
+    end = len(buf)
+    while offset < end:
+        packet_id, length = packet_length(buf, offset)
+        if offset + length > end:
+            raise error(f"truncated packet {packet_id} at offset {offset}")
+        ids.append(packet_id)
+        offsets.append(offset)
+        lengths.append(length)
+        offset += length
+    return (
+        np.array(ids, dtype=np.int64),
+        np.array(offsets, dtype=np.int64),
+        np.array(lengths, dtype=np.int64),
+    )
+
+
+def decode_chunk(buf, keep_string=False):
+    """Decode a whole chunk buffer at once.
+
+    Fixed size packets that have a struct definition are decoded per packet
+    id into structured arrays (see struct_dtype), returned as
+    {packet_id: (offsets, array)}. Every other packet is decoded with
+    decode_packet and returned as a list of (offset, decoded tuple) in stream
+    order. The packet string of those tuples is None unless keep_string is
+    set, in which case it is a slice of buf (a memoryview slice when buf is
+    a memoryview, so it must be released before the buffer is closed).
+    """
+    ids, offsets, lengths = index_packets(buf)
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    fixed = {}
+    bulk = np.zeros(ids.shape, dtype=bool)
+    for packet_id in np.unique(ids).tolist():
+        if packet_id not in bulk_dtypes.keys():
+            continue
+        dtype = bulk_dtypes[packet_id]
+        idx = ids == packet_id
+        bulk |= idx
+        packet_offsets = offsets[idx]
+        rows = raw[packet_offsets[:, None] + np.arange(dtype.itemsize)]
+        fixed[packet_id] = (packet_offsets, np.frombuffer(rows, dtype=dtype))
+
+    variable = []
+    for offset, length in zip(offsets[~bulk].tolist(), lengths[~bulk].tolist()):
+        packet = buf[offset : offset + length]  # noqa: E203
+        with BytesIO(packet) as stream_:
+            vals = decode_packet(stream_, keep_string=False)
+        variable.append((offset, vals[:-1] + (packet if keep_string else None,)))
+    return fixed, variable
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from sotera.io.visi.chunks import VisiChunkReader
+
+
+@pytest.fixture
+def chunk(tmp_path):
+    fn = tmp_path / "0.vchk"
+    fn.write_bytes(bytes(range(64)))
+    return str(fn)
+
+
+def test_reader_closes(chunk):
+    with VisiChunkReader(chunk) as reader:
+        assert len(reader) == 64
+        assert bytes(reader[:4]) == b"\x00\x01\x02\x03"
+    assert reader.view is None and reader.mm is None and reader.fp is None
+
+
+def test_decode_error_is_not_replaced(chunk):
+    def decode(reader):
+        words = np.frombuffer(reader.view, dtype=np.uint32)  # noqa: F841
+        raise ValueError("bad chunk")
+
+    with pytest.raises(ValueError, match="bad chunk"):
+        with VisiChunkReader(chunk) as reader:
+            decode(reader)
+    assert reader.fp is None
@@ -0,0 +1,111 @@
+import io
+import lzma
+
+import numpy as np
+import pytest
+
+from sotera.io import local
+from sotera.io.codecs import CODECS, codec_extension, decode_array, encode_array
+from sotera.io.frames import file_reader, read_frames, save_frames
+
+CODEC_MODULES = {"xz": "lzma", "zstd": "zstandard", "blosc-lz4": "blosc"}
+
+
+@pytest.fixture(params=sorted(CODECS))
+def codec(request):
+    pytest.importorskip(CODEC_MODULES[request.param])
+    return request.param
+
+
+def waveform(n=40000, sn0=1000):
+    rng = np.random.default_rng(0)
+    arr = np.empty((n, 3), dtype=np.int32)
+    arr[:, 0] = np.arange(sn0, sn0 + n)
+    arr[:, 1] = arr[:, 0] // 125
+    arr[:, 2] = rng.integers(-(2 ** 20), 2 ** 20, n)
+    return arr
+
+
+ARRAYS = [
+    waveform(),
+    np.random.default_rng(1).random((300, 7)),
+    np.asfortranarray(np.random.default_rng(2).random((300, 7))),
+    np.array(5.0),
+    np.zeros((0, 3), dtype=np.int32),
+    np.array(["2020-01-01", "2020-01-02"], dtype="M8[ms]"),
+    np.zeros(3, dtype=[("a", "<i4"), ("b", "<f8")]),
+]
+
+
+def assert_same(out, arr):
+    assert out.dtype == arr.dtype
+    assert out.shape == arr.shape
+    np.testing.assert_array_equal(out, arr)
+
+
+@pytest.mark.parametrize("arr", ARRAYS, ids=range(len(ARRAYS)))
+def test_encode_decode(codec, arr):
+    assert_same(decode_array(encode_array(arr, codec), codec), arr)
+
+
+@pytest.mark.parametrize("arr", ARRAYS, ids=range(len(ARRAYS)))
+def test_encode_decode_level(codec, arr):
+    codec = codec + ":1"
+    assert_same(decode_array(encode_array(arr, codec), codec), arr)
+
+
+def test_decode_memoryview(codec):
+    arr = waveform()
+    raw = memoryview(encode_array(arr, codec))
+    assert_same(decode_array(raw, codec), arr)
+
+
+def test_streamed_in_chunks(codec, monkeypatch):
+    monkeypatch.setattr("sotera.io.codecs.STREAM_CHUNK", 1000)
+    arr = waveform()
+    assert_same(decode_array(encode_array(arr, codec), codec), arr)
+
+
+def test_save_load_array(codec, tmp_path):
+    arr = waveform()
+    fn = local.save_array(str(tmp_path), "ECG_II", arr, codec=codec)
+    assert fn.endswith(codec_extension(codec))
+    assert_same(local.load_array(str(tmp_path), "ECG_II", codec), arr)
+    # without a codec every registered one is tried
+    assert_same(local.load_array(str(tmp_path), "ECG_II"), arr)
+
+
+def test_save_load_uncompressed(tmp_path):
+    arr = waveform()
+    local.save_array(str(tmp_path), "ECG_II", arr, use_compression=False)
+    assert_same(local.load_array(str(tmp_path), "ECG_II"), arr)
+
+
+def test_frames(codec, tmp_path):
+    arr = waveform()
+    fn, frames = save_frames(str(tmp_path), "ECG_II", arr, 15000, codec)
+    assert len(frames["index"]) > 1
+    read = file_reader(fn)
+    assert_same(read_frames(read, frames), arr)
+    window = read_frames(read, frames, 20000, 31000)
+    assert_same(window, arr[(arr[:, 0] >= 20000) & (arr[:, 0] <= 31000)])
+
+
+def test_xz_matches_whole_file_compression():
+    for arr in ARRAYS:
+        with io.BytesIO() as buffer:
+            np.save(buffer, np.ascontiguousarray(arr) if arr.ndim else arr)
+            raw = buffer.getvalue()
+        assert lzma.decompress(encode_array(arr, "xz")) == raw
+
+
+def test_load_existing_xz_file(tmp_path):
+    # written as blocks were before arrays were streamed through the codec
+    arr = waveform()
+    with io.BytesIO() as buffer:
+        np.save(buffer, arr)
+        raw = lzma.compress(buffer.getvalue(), preset=6)
+    with open(tmp_path / "ECG_II.npy.xz", "wb") as fp:
+        fp.write(raw)
+    assert_same(local.load_array(str(tmp_path), "ECG_II"), arr)
+    assert_same(local.load_array(str(tmp_path), "ECG_II", "xz"), arr)
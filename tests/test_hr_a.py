@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from sotera.analysis.triage import _hr_a_loop, _hr_a_sorted, process_hr_a_data
+
+
+def random_session(rng, n_pr, n_hr):
+    """HR/PR numerics with gaps in PR, HR rows at exactly the PR times and
+    -1/-2 PR codes, HR times in order and PR times strictly increasing."""
+    pr_t = np.cumsum(rng.choice([0.5, 1, 2, 2.5, 3, 4, 7, 30], size=n_pr))
+    pr_t += rng.integers(0, 5)
+    hr_t = np.round(rng.uniform(0, pr_t[-1] + 8, size=n_hr) * 2) / 2
+    if rng.random() < 0.5:
+        k = min(n_hr, n_pr)
+        hr_t[:k] = pr_t[rng.choice(n_pr, size=k, replace=False)]
+    hr_t.sort()
+    PR = np.c_[np.arange(n_pr), pr_t, rng.choice([-2, -1, 60, 70], size=n_pr)]
+    HR = np.c_[np.arange(n_hr), hr_t, rng.choice([-1, 60, 80], size=n_hr)]
+    return HR.astype(float), PR.astype(float)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_sorted_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(1000):
+        HR, PR = random_session(
+            rng, int(rng.integers(1, 12)), int(rng.integers(1, 25))
+        )
+        np.testing.assert_array_equal(_hr_a_sorted(HR, PR), _hr_a_loop(HR, PR))
+
+
+def test_sorted_matches_loop_long_session():
+    HR, PR = random_session(np.random.default_rng(10), 2000, 3000)
+    np.testing.assert_array_equal(_hr_a_sorted(HR, PR), _hr_a_loop(HR, PR))
+
+
+def test_masked_codes():
+    PR = np.array([[0, 10, 60], [1, 11, -1], [2, 12, 70], [3, 13, -2], [4, 20, 60]])
+    HR = np.array([[0, 9, 80], [1, 11, 80], [2, 12.5, 80], [3, 13, 80], [4, 17, 80]])
+    aHR = _hr_a_sorted(HR.astype(float), PR.astype(float))
+    np.testing.assert_array_equal(aHR[:, 2], [80, 80, -3, 80, 80])
+    np.testing.assert_array_equal(aHR, _hr_a_loop(HR.astype(float), PR.astype(float)))
+
+
+def test_process_hr_a_data_unordered_pr_uses_loop():
+    HR, PR = random_session(np.random.default_rng(20), 50, 80)
+    PR = PR[::-1].copy()
+    data = process_hr_a_data({"HR": HR, "PR": PR})
+    np.testing.assert_array_equal(data["HR_A"], _hr_a_loop(HR, PR))
+
+
+def test_process_hr_a_data_without_pr():
+    HR, _ = random_session(np.random.default_rng(30), 5, 10)
+    assert process_hr_a_data({"HR": HR})["HR_A"] is HR